@@ -0,0 +1,610 @@
+import asyncio
+import math
+import pickle
+import random
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.locmem import LocMemCache
+
+from .metrics import METRICS
+
+import logging
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = "ledger_gen_{}"
+LOCK_KEY = "lock_{}"
+
+RAW_PAYLOAD = b"r"
+COMPRESSED_PAYLOAD = b"z"
+UUID_COLUMN = "u"
+
+
+def normalize_user_id(user_id):
+    '''Returns canonical string of user id so every spelling of a UUID shares keys'''
+
+    try:
+        return str(uuid.UUID(str(user_id)))
+    except ValueError:
+        return str(user_id)
+
+
+class RowCodec:
+    '''
+    Encodes lists of row tuples as compact columnar cache payloads
+
+    Rows are transposed to columns of plain values and UUID columns are stored
+    as 16 byte strings, so the pickle carries no model instances, _state or
+    UUID objects. Payloads above the compression threshold are zlib compressed.
+
+    '''
+
+    def __init__(self, compress_threshold: int = None):
+        self.compress_threshold = compress_threshold
+
+    def encode(self, rows: list):
+        '''Returns bytes payload of rows'''
+
+        columns = [list(column) for column in zip(*rows)]
+        kinds = []
+        for index, column in enumerate(columns):
+            sample = next(
+                (value for value in column if value is not None), None)
+            if isinstance(sample, uuid.UUID):
+                columns[index] = [
+                    value.bytes if value is not None else None for value in column]
+                kinds.append(UUID_COLUMN)
+            else:
+                kinds.append(None)
+
+        payload = pickle.dumps((kinds, columns), pickle.HIGHEST_PROTOCOL)
+        threshold = self.compress_threshold
+        if threshold is None:
+            threshold = getattr(
+                settings, "LEDGER_CACHE_COMPRESS_THRESHOLD", 4096)
+        if len(payload) > threshold:
+            return COMPRESSED_PAYLOAD + zlib.compress(payload, 1)
+        return RAW_PAYLOAD + payload
+
+    def decode(self, payload: bytes):
+        '''Returns list of row tuples from payload'''
+
+        if payload[:1] == COMPRESSED_PAYLOAD:
+            kinds, columns = pickle.loads(zlib.decompress(payload[1:]))
+        else:
+            kinds, columns = pickle.loads(payload[1:])
+
+        for index, kind in enumerate(kinds):
+            if kind == UUID_COLUMN:
+                columns[index] = [uuid.UUID(bytes=value) if value is not None else None
+                                  for value in columns[index]]
+
+        return list(zip(*columns))
+
+
+class LocalCache:
+    '''
+    Bounded in-process LRU cache with per-entry expiry
+
+    Holds decoded values, so a hit costs neither a cache round trip nor a
+    decode. Least recently used entries are evicted beyond max_entries, and
+    max_entries of 0 disables the tier.
+
+    '''
+
+    def __init__(self, max_entries: int = None):
+        if max_entries is None:
+            max_entries = getattr(
+                settings, "LEDGER_LOCAL_CACHE_MAX_ENTRIES", 1024)
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str):
+        '''Returns value of key, None if it is missing or expired'''
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value, ttl: float):
+        if self.max_entries <= 0 or ttl <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class CacheCounters:
+    '''Thread safe hit/miss counters of every cache tier in this process'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def record(self, tier: str, hit: bool):
+        with self.lock:
+            counts = self.counts.setdefault(tier, [0, 0])
+            counts[0 if hit else 1] += 1
+
+    def snapshot(self):
+        '''Returns hits, misses and hit ratio of every tier'''
+
+        with self.lock:
+            counts = {tier: list(values) for tier, values in self.counts.items()}
+
+        return {tier: {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / (hits + misses) if hits + misses else 0.0
+        } for tier, (hits, misses) in counts.items()}
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}
+
+
+# Per process tiers, shared by every LedgerCache of the worker
+LOCAL_CACHE = LocalCache()
+CACHE_COUNTERS = CacheCounters()
+
+
+class LedgerCache:
+    '''
+    Per-user generational cache for ledger reads
+
+    Every cached entry of a user is keyed with the user's current generation,
+    so a write invalidates all of them by replacing one generation stamp
+    instead of deleting each key. A missing entry is recomputed by a single
+    worker holding a lock while the others wait for its result, and entries
+    are refreshed early with a probability that grows towards their expiry
+    (XFetch), so hot keys do not expire under load all at once.
+
+    Entries and generation stamps are also kept in a bounded in-process LRU
+    tier in front of the shared cache. A bump replaces the local stamps of
+    this worker at once, other workers pick up the new generation when their
+    local stamp expires after LEDGER_LOCAL_CACHE_GENERATION_TTL seconds.
+    Shared stamps expire after LEDGER_CACHE_GENERATION_TTL seconds, so stamps
+    of inactive users do not stay in the cache forever.
+
+    '''
+
+    def __init__(self, backend=None, local: LocalCache = None, counters: CacheCounters = None):
+        self.backend = backend or cache
+        self.local = local if local is not None else LOCAL_CACHE
+        self.counters = counters if counters is not None else CACHE_COUNTERS
+
+    def normalize_user_id(self, user_id):
+        return normalize_user_id(user_id)
+
+    def get_generations(self, user_ids: list):
+        '''
+        Returns current generation stamp of every user
+
+        Parameters:
+        user_ids (list): User ids from Users model
+
+        Returns:
+        Dict: Generation keyed by normalized user id
+
+        '''
+
+        generations = {}
+        keys = {}
+        for user_id in user_ids:
+            user_id = self.normalize_user_id(user_id)
+            key = GENERATION_KEY.format(user_id)
+            generation = self.local.get(key)
+            if generation is None:
+                keys[key] = user_id
+            else:
+                generations[user_id] = generation
+        if not keys:
+            return generations
+
+        stored = self.backend.get_many(list(keys))
+        generation_ttl = getattr(
+            settings, "LEDGER_LOCAL_CACHE_GENERATION_TTL", 1.0)
+        for key, user_id in keys.items():
+            generation = stored.get(key)
+            if generation is None:
+                # First reader creates the stamp, concurrent readers adopt the winner's
+                generation = uuid.uuid4().hex[:12]
+                if not self.backend.add(key, generation, self.get_generation_timeout()):
+                    generation = self.backend.get(key) or generation
+            self.local.set(key, generation, generation_ttl)
+            generations[user_id] = generation
+
+        return generations
+
+    def get_generation_timeout(self):
+        '''Returns seconds generation stamps stay in the shared cache, an expired stamp acts as a fresh generation'''
+
+        return getattr(settings, "LEDGER_CACHE_GENERATION_TTL", 86400)
+
+    def bump_generations(self, user_ids: list):
+        '''Invalidates every cached entry of the users with one set_many of fresh generation stamps'''
+
+        generations = {
+            GENERATION_KEY.format(self.normalize_user_id(user_id)): uuid.uuid4().hex[:12]
+            for user_id in user_ids
+        }
+        self.backend.set_many(generations, self.get_generation_timeout())
+
+        generation_ttl = getattr(
+            settings, "LEDGER_LOCAL_CACHE_GENERATION_TTL", 1.0)
+        for key, generation in generations.items():
+            self.local.set(key, generation, generation_ttl)
+
+    def update_entries(self, user_id: str, updates: dict, ttl: int, codec: RowCodec = None):
+        '''Applies updates to cached entries of one user, see update_entries_many'''
+
+        user_id = self.normalize_user_id(user_id)
+        return user_id in self.update_entries_many({user_id: updates}, ttl, codec)
+
+    def update_entries_many(self, user_updates: dict, ttl: int, codec: RowCodec = None):
+        '''
+        Applies updates to cached entries of users and publishes them under new generations
+
+        Writers of the same user are serialized with a lock, entries that are
+        not cached are left to be computed by the next read. Users whose lock
+        can not be taken in time or whose generation changed meanwhile are
+        invalidated with a plain bump instead. Apart from one lock per user,
+        the whole batch costs a fixed number of get_many/set_many/delete_many
+        round trips.
+
+        Parameters:
+        user_updates (dict): Updates of every user id, callable by family that takes current value and returns updated value
+        ttl (int): Seconds the updated entries stay cached
+        codec (RowCodec): Encodes values in the cache, values are stored as is without it
+
+        Returns:
+        Set: Normalized ids of the users whose entries were updated, the others were invalidated
+
+        '''
+
+        updates_by_key = {}
+        for user_id, updates in user_updates.items():
+            user_id = self.normalize_user_id(user_id)
+            updates_by_key[GENERATION_KEY.format(user_id)] = (user_id, updates)
+
+        locked = []
+        invalidated = []
+        for generation_key, (user_id, _) in updates_by_key.items():
+            if self.wait_for_lock(generation_key):
+                locked.append(generation_key)
+            else:
+                logger.warning(
+                    "LedgerCache - UpdateEntries - Lock busy, invalidating - %s", user_id)
+                invalidated.append(user_id)
+
+        published = {}
+        values = {}
+        expires_at = time.time() + ttl
+        try:
+            if locked:
+                generations = self.backend.get_many(locked)
+                invalidated.extend(
+                    updates_by_key[key][0] for key in locked if key not in generations)
+
+                keys = {}
+                for generation_key, generation in generations.items():
+                    user_id, updates = updates_by_key[generation_key]
+                    for family in updates:
+                        keys[self.make_key(family, user_id, generation)] = (generation_key, family)
+                entries = self.backend.get_many(list(keys))
+
+                new_generations = {key: uuid.uuid4().hex[:12] for key in generations}
+                new_entries = {}
+                for key, (value, _, delta) in entries.items():
+                    generation_key, family = keys[key]
+                    user_id, updates = updates_by_key[generation_key]
+                    value = updates[family](codec.decode(value) if codec else value)
+                    new_key = self.make_key(family, user_id, new_generations[generation_key])
+                    values[new_key] = (generation_key, value)
+                    new_entries[new_key] = (
+                        codec.encode(value) if codec else value, expires_at, delta)
+                if new_entries:
+                    self.backend.set_many(new_entries, ttl)
+
+                # A writer that gave up waiting for the lock may have bumped meanwhile, its bump must win
+                current = self.backend.get_many(list(generations))
+                for generation_key, generation in generations.items():
+                    if current.get(generation_key) == generation:
+                        published[generation_key] = new_generations[generation_key]
+                    else:
+                        invalidated.append(updates_by_key[generation_key][0])
+                if published:
+                    self.backend.set_many(published, self.get_generation_timeout())
+        except Exception as e:
+            logger.error(
+                "LedgerCache - UpdateEntries - ERROR - Exception - %s", e)
+            invalidated = [user_id for user_id, _ in updates_by_key.values()]
+            published = {}
+        finally:
+            if locked:
+                self.backend.delete_many([LOCK_KEY.format(key) for key in locked])
+
+        if invalidated:
+            self.bump_generations(invalidated)
+
+        generation_ttl = getattr(
+            settings, "LEDGER_LOCAL_CACHE_GENERATION_TTL", 1.0)
+        for generation_key, generation in published.items():
+            self.local.set(generation_key, generation, generation_ttl)
+        for key, (generation_key, value) in values.items():
+            if generation_key in published:
+                self.set_local(key, value, expires_at)
+        return {updates_by_key[key][0] for key in published}
+
+    def make_key(self, family: str, user_id: str, generation: str):
+        '''Returns cache key of family entry for user at generation'''
+
+        return "{}_user_id_{}_{}".format(family, user_id, generation)
+
+    def get_or_compute(self, family: str, user_id: str, compute, ttl: int, codec: RowCodec = None):
+        '''
+        Returns cached family entry of user, computing it on miss
+
+        Parameters:
+        family (str): Key family like trans_lend/trans_borrow/trans_history
+        user_id (str): User id from Users model
+        compute (callable): Returns fresh value of the entry
+        ttl (int): Seconds the entry stays cached
+        codec (RowCodec): Encodes value in the cache, value is stored as is without it
+
+        Returns:
+        Any: Cached or computed value
+
+        '''
+
+        user_id = self.normalize_user_id(user_id)
+        generation = self.get_generations([user_id])[user_id]
+        key = self.make_key(family, user_id, generation)
+
+        value = self.local.get(key)
+        self.counters.record("local", value is not None)
+        METRICS.record_cache(family, "local", value is not None)
+        if value is not None:
+            logger.debug("LedgerCache - %s - Cache - LOCAL HIT", family)
+            return value
+
+        entry = self.backend.get(key)
+        self.counters.record("remote", entry is not None)
+        METRICS.record_cache(family, "remote", entry is not None)
+        if entry is not None:
+            value, expires_at, delta = entry
+            if not self.should_refresh_early(expires_at, delta):
+                logger.debug("LedgerCache - %s - Cache - HIT", family)
+                return self.set_local(key, codec.decode(value) if codec else value, expires_at)
+            # Refresh ahead of expiry if no other worker is doing it, else serve current value
+            if not self.acquire_lock(key):
+                return self.set_local(key, codec.decode(value) if codec else value, expires_at)
+            logger.debug("LedgerCache - %s - Cache - EARLY REFRESH", family)
+            try:
+                return self.compute_and_set(key, compute, ttl, codec)
+            finally:
+                self.release_lock(key)
+
+        logger.debug("LedgerCache - %s - Cache - MISS", family)
+        if self.acquire_lock(key):
+            try:
+                return self.compute_and_set(key, compute, ttl, codec)
+            finally:
+                self.release_lock(key)
+
+        entry = self.wait_for_entry(key)
+        if entry is not None:
+            return self.set_local(key, codec.decode(entry[0]) if codec else entry[0], entry[1])
+        # Lock holder did not finish in time, compute without waiting any longer
+        return self.compute_and_set(key, compute, ttl, codec)
+
+    async def aget_or_compute(self, family: str, user_id: str, acompute, ttl: int, codec: RowCodec = None):
+        '''
+        Async get_or_compute for ASGI views, acompute is a coroutine function
+
+        The local tier is read in the event loop. The cache backends have no
+        async client, so remote calls run in the default executor instead of
+        Django's thread-sensitive one, which would serve them one at a time.
+
+        '''
+
+        user_id = self.normalize_user_id(user_id)
+        generation = self.local.get(GENERATION_KEY.format(user_id))
+        if generation is None:
+            generation = (await self.run_in_executor(self.get_generations, [user_id]))[user_id]
+        key = self.make_key(family, user_id, generation)
+
+        value = self.local.get(key)
+        self.counters.record("local", value is not None)
+        METRICS.record_cache(family, "local", value is not None)
+        if value is not None:
+            logger.debug("LedgerCache - %s - Cache - LOCAL HIT", family)
+            return value
+
+        entry = await self.run_in_executor(self.backend.get, key)
+        self.counters.record("remote", entry is not None)
+        METRICS.record_cache(family, "remote", entry is not None)
+        if entry is not None:
+            value, expires_at, delta = entry
+            if not self.should_refresh_early(expires_at, delta):
+                logger.debug("LedgerCache - %s - Cache - HIT", family)
+                return self.set_local(key, codec.decode(value) if codec else value, expires_at)
+            if not await self.run_in_executor(self.acquire_lock, key):
+                return self.set_local(key, codec.decode(value) if codec else value, expires_at)
+            logger.debug("LedgerCache - %s - Cache - EARLY REFRESH", family)
+            try:
+                return await self.acompute_and_set(key, acompute, ttl, codec)
+            finally:
+                await self.run_in_executor(self.release_lock, key)
+
+        logger.debug("LedgerCache - %s - Cache - MISS", family)
+        if await self.run_in_executor(self.acquire_lock, key):
+            try:
+                return await self.acompute_and_set(key, acompute, ttl, codec)
+            finally:
+                await self.run_in_executor(self.release_lock, key)
+
+        entry = await self.await_entry(key)
+        if entry is not None:
+            return self.set_local(key, codec.decode(entry[0]) if codec else entry[0], entry[1])
+        return await self.acompute_and_set(key, acompute, ttl, codec)
+
+    async def acompute_and_set(self, key: str, acompute, ttl: int, codec: RowCodec = None):
+        '''Async compute_and_set, acompute is a coroutine function'''
+
+        start_time = time.time()
+        value = await acompute()
+        delta = time.time() - start_time
+        expires_at = time.time() + ttl
+        await self.run_in_executor(
+            self.backend.set, key, (codec.encode(value) if codec else value, expires_at, delta), ttl)
+        return self.set_local(key, value, expires_at)
+
+    async def run_in_executor(self, func, *args):
+        '''Runs blocking cache call in a worker thread without holding up the event loop'''
+
+        return await sync_to_async(func, thread_sensitive=False)(*args)
+
+    async def await_entry(self, key: str):
+        '''Async wait_for_entry, sleeps in the event loop between polls'''
+
+        deadline = time.time() + getattr(settings, "LEDGER_CACHE_LOCK_WAIT", 2.0)
+        while time.time() < deadline:
+            await asyncio.sleep(0.01)
+            entry = await self.run_in_executor(self.backend.get, key)
+            if entry is not None:
+                return entry
+        return None
+
+    def compute_and_set(self, key: str, compute, ttl: int, codec: RowCodec = None):
+        '''Computes value and caches it with its expiry and compute time'''
+
+        start_time = time.time()
+        value = compute()
+        delta = time.time() - start_time
+        expires_at = time.time() + ttl
+        self.backend.set(
+            key, (codec.encode(value) if codec else value, expires_at, delta), ttl)
+        return self.set_local(key, value, expires_at)
+
+    def set_local(self, key: str, value, expires_at: float):
+        '''Keeps value in the local tier until the shared entry expires at the latest, returns value'''
+
+        ttl = min(getattr(settings, "LEDGER_LOCAL_CACHE_TTL", 5),
+                  expires_at - time.time())
+        self.local.set(key, value, ttl)
+        return value
+
+    def get_stats(self):
+        '''Returns hit/miss counters and hit ratio of the local and remote tiers in this process'''
+
+        return self.counters.snapshot()
+
+    def should_refresh_early(self, expires_at: float, delta: float):
+        '''XFetch, refresh becomes more likely as expiry nears and the slower the value is to compute'''
+
+        beta = getattr(settings, "LEDGER_CACHE_EARLY_REFRESH_BETA", 1.0)
+        return time.time() - delta * beta * math.log(1.0 - random.random()) >= expires_at
+
+    def acquire_lock(self, key: str):
+        '''Returns True if this worker now owns the recompute lock of key'''
+
+        return self.backend.add(LOCK_KEY.format(key), 1, getattr(settings, "LEDGER_CACHE_LOCK_TIMEOUT", 10))
+
+    def release_lock(self, key: str):
+        self.backend.delete(LOCK_KEY.format(key))
+
+    def wait_for_lock(self, key: str):
+        '''Polls for the lock of key, returns False if it is not released in time'''
+
+        deadline = time.time() + getattr(settings, "LEDGER_CACHE_LOCK_WAIT", 2.0)
+        while not self.acquire_lock(key):
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def wait_for_entry(self, key: str):
+        '''Polls for entry computed by lock holder, returns None if it does not show up in time'''
+
+        deadline = time.time() + getattr(settings, "LEDGER_CACHE_LOCK_WAIT", 2.0)
+        while time.time() < deadline:
+            time.sleep(0.01)
+            entry = self.backend.get(key)
+            if entry is not None:
+                return entry
+        return None
+
+
+class SlowLocMemCache(LocMemCache):
+    '''
+    Local memory cache that sleeps before every call, a stand-in for a remote cache in benchmarks
+
+    The delay comes from OPTIONS DELAY in seconds, see ledger/benchmark_settings.py.
+
+    '''
+
+    def __init__(self, name, params):
+        super().__init__(name, params)
+        self.delay = float(params.get("OPTIONS", {}).get("DELAY", 0.0))
+
+    def get(self, *args, **kwargs):
+        time.sleep(self.delay)
+        return super().get(*args, **kwargs)
+
+    def set(self, *args, **kwargs):
+        time.sleep(self.delay)
+        return super().set(*args, **kwargs)
+
+    def add(self, *args, **kwargs):
+        time.sleep(self.delay)
+        return super().add(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        time.sleep(self.delay)
+        return super().delete(*args, **kwargs)
+
+    def get_many(self, keys, version=None):
+        time.sleep(self.delay)
+        values = {}
+        for key in keys:
+            value = super().get(key, version=version)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        time.sleep(self.delay)
+        for key, value in data.items():
+            super().set(key, value, timeout, version=version)
+        return []
+
+    def delete_many(self, keys, version=None):
+        time.sleep(self.delay)
+        for key in keys:
+            super().delete(key, version=version)
@@ -0,0 +1,105 @@
+import contextvars
+import json
+import logging
+import queue
+import random
+import uuid
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from logging.handlers import QueueHandler, QueueListener
+
+from django.conf import settings
+
+# Route of the request being served and whether its debug lines are kept, set by LogContextMiddleware
+LOG_ROUTE = contextvars.ContextVar("ledger_log_route", default=None)
+LOG_DEBUG_SAMPLED = contextvars.ContextVar(
+    "ledger_log_debug_sampled", default=True)
+
+
+# Log arguments of these types can not change after the call, so they are formatted in the listener thread
+IMMUTABLE_LOG_ARG_TYPES = (str, bytes, int, float, type(None), uuid.UUID, date, Decimal)
+
+
+def should_sample_debug(route: str):
+    '''Returns True if debug lines of a request to route are kept, per LEDGER_LOG_DEBUG_SAMPLE_RATES'''
+
+    rates = getattr(settings, "LEDGER_LOG_DEBUG_SAMPLE_RATES", {})
+    rate = rates.get(route, rates.get("*", 1.0))
+    return rate >= 1.0 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    '''Formats records as one JSON object per line'''
+
+    def format(self, record):
+        payload = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        route = getattr(record, "route", None)
+        if route:
+            payload["route"] = route
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            payload["exc_info"] = record.exc_text
+        return json.dumps(payload, default=str)
+
+
+class RouteContextFilter(logging.Filter):
+    '''Drops debug records of requests that were not sampled and tags records with the request route'''
+
+    def filter(self, record):
+        if record.levelno <= logging.DEBUG and not LOG_DEBUG_SAMPLED.get():
+            return False
+        record.route = LOG_ROUTE.get()
+        return True
+
+
+class QueueLogHandler(QueueHandler):
+    '''
+    Hands records to a background thread that formats and writes them
+
+    The calling thread only enqueues the record, message formatting and the
+    JSON encoding happen in the listener thread. Messages with a mutable
+    argument, like a list or an exception, and tracebacks are rendered by the
+    calling thread, as their objects may change before the listener gets to
+    them. Closing the handler, as logging does at exit, writes the queued
+    records and stops the listener.
+
+    '''
+
+    def __init__(self, stream=None, json_format: bool = True):
+        super().__init__(queue.SimpleQueue())
+        target = logging.StreamHandler(stream)
+        target.setFormatter(JsonFormatter() if json_format else logging.Formatter(
+            "[%(asctime)s] [%(levelname)s] %(message)s"))
+        self.listener = QueueListener(
+            self.queue, target, respect_handler_level=True)
+        self.listener.start()
+        self.exception_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        '''Returns record safe to format in the listener thread'''
+
+        args = record.args
+        if args:
+            values = args.values() if isinstance(args, dict) else args
+            if not all(isinstance(value, IMMUTABLE_LOG_ARG_TYPES) for value in values):
+                record.msg = record.getMessage()
+                record.args = None
+        if record.exc_info:
+            # Like QueueHandler.prepare, the traceback keeps live frames, only its text crosses threads
+            if not record.exc_text:
+                record.exc_text = self.exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        super().close()
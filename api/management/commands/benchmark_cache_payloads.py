@@ -0,0 +1,113 @@
+import json
+import pickle
+import random
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction as db_transaction
+from django.utils import timezone
+
+from api.caching import RowCodec
+from api.money import MINOR_UNITS
+from api.models import Transactions, Users
+from api.utils import TRANSACTION_ROW_FIELDS, TransactionUtility
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares cache payloads of one user in the pickled QuerySet format and the compact "
+        "RowCodec format: bytes per cached user and encode/decode time. Sample data is created "
+        "inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--transactions", type=int, default=10000,
+                            help="Transactions of the sample user")
+        parser.add_argument("--counterparties", type=int, default=50,
+                            help="Distinct users the sample user deals with")
+        parser.add_argument("--repeat", type=int, default=20,
+                            help="Encode/decode rounds to average")
+        parser.add_argument("--json", action="store_true",
+                            help="Print results as JSON")
+
+    def handle(self, *args, **options):
+        with db_transaction.atomic():
+            results = self.run_benchmark(options)
+            db_transaction.set_rollback(True)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        for name, result in results.items():
+            self.stdout.write("{:<10} {:>12} bytes/user  encode {:>9.3f} ms  decode {:>9.3f} ms".format(
+                name, result["bytes"], result["encode_ms"], result["decode_ms"]))
+        self.stdout.write("Compact payload is {:.1f}x smaller".format(
+            results["queryset"]["bytes"] / max(results["compact"]["bytes"], 1)))
+
+    def run_benchmark(self, options):
+        rand = random.Random(0)
+        user = Users.objects.create(
+            name="Benchmark", username="benchmark_cache_user", password="benchmark")
+        counterparties = Users.objects.bulk_create([
+            Users(name="Benchmark {}".format(index), username="benchmark_cache_user_{}".format(index),
+                  password="benchmark")
+            for index in range(options["counterparties"])])
+        start_date = timezone.make_aware(datetime(2020, 1, 1))
+        new_transactions = []
+        for index in range(options["transactions"]):
+            counterparty = rand.choice(counterparties)
+            lender, borrower = (user, counterparty) if index % 2 else (
+                counterparty, user)
+            new_transactions.append(Transactions(
+                transaction_from=lender, transaction_with=borrower,
+                transaction_amount=rand.randint(1, 1000) * MINOR_UNITS,
+                transaction_status=rand.choice(("paid", "unpaid")),
+                transaction_date=start_date + timedelta(minutes=index),
+                reason=rand.choice(("food", "travel", "rent", None))))
+        Transactions.objects.bulk_create(new_transactions, batch_size=1000)
+
+        # Entries cached for one user: login, lend and borrow transactions (history in compact format only)
+        queryset_values = [
+            Users.objects.filter(id=user.id),
+            Transactions.objects.filter(transaction_from=user),
+            Transactions.objects.filter(transaction_with=user),
+        ]
+        for queryset in queryset_values:
+            len(queryset)
+        compact_values = [
+            list(Users.objects.filter(id=user.id).values_list(
+                "id", "name", "balance")),
+            list(Transactions.objects.filter(transaction_from=user).values_list(
+                *TRANSACTION_ROW_FIELDS)),
+            list(Transactions.objects.filter(transaction_with=user).values_list(
+                *TRANSACTION_ROW_FIELDS)),
+            [row for queryset in TransactionUtility().get_history_querysets(user.id) for row in queryset],
+        ]
+
+        codec = RowCodec()
+        return {
+            "queryset": self.measure(queryset_values, lambda value: pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                                     pickle.loads, options["repeat"]),
+            "compact": self.measure(compact_values, codec.encode, codec.decode, options["repeat"]),
+        }
+
+    def measure(self, values, encode, decode, repeat):
+        '''Returns total payload size and average encode/decode time of values'''
+
+        payloads = [encode(value) for value in values]
+
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            for value in values:
+                encode(value)
+        encode_ms = (time.perf_counter() - start_time) * 1000 / repeat
+
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            for payload in payloads:
+                decode(payload)
+        decode_ms = (time.perf_counter() - start_time) * 1000 / repeat
+
+        return {"bytes": sum(len(payload) for payload in payloads), "encode_ms": encode_ms, "decode_ms": decode_ms}
@@ -0,0 +1,153 @@
+import json
+import platform
+import statistics
+import subprocess
+import time
+
+import django
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db import transaction as db_transaction
+
+from api.caching import LOCAL_CACHE
+from api.models import Transactions
+from api.synthetic import SyntheticLedger
+from api.utils import TransactionUtility, UsersUtility
+
+BENCHMARK_PREFIX = "benchmark"
+
+
+class Command(BaseCommand):
+    help = (
+        "Times UsersUtility and TransactionUtility functions on synthetic ledgers of each size and "
+        "writes JSON results for comparison between commits. Every ledger is generated inside a "
+        "transaction that is rolled back, so after-commit cache refreshes are not part of the timings."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="1000,10000,100000",
+                            help="Comma separated transaction counts")
+        parser.add_argument("--users", type=int, default=1000,
+                            help="Users of every ledger")
+        parser.add_argument("--repeat", type=int, default=20,
+                            help="Timed calls per function")
+        parser.add_argument("--seed", type=int, default=0,
+                            help="Random seed of the ledgers")
+        parser.add_argument("--output",
+                            help="Write JSON results to this file")
+        parser.add_argument("--compare", metavar="FILE",
+                            help="Print median change against results of an earlier run")
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options["sizes"].split(",")]
+        except ValueError:
+            raise CommandError("Sizes should be comma separated integers")
+        if options["repeat"] <= 0 or options["users"] < 2:
+            raise CommandError("Repeat should be positive and users at least 2")
+
+        results = {
+            "commit": self.get_commit(),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "users": options["users"],
+            "repeat": options["repeat"],
+            "seed": options["seed"],
+            "results": {},
+        }
+        for size in sizes:
+            self.stdout.write("Benchmarking {} transactions".format(size))
+            with db_transaction.atomic():
+                user_ids = SyntheticLedger(
+                    options["users"], size, seed=options["seed"], username_prefix=BENCHMARK_PREFIX,
+                    password=BENCHMARK_PREFIX).generate()
+                results["results"][str(size)] = self.run_benchmarks(
+                    user_ids, options["repeat"])
+                db_transaction.set_rollback(True)
+            self.clear_cache()
+
+        for size, timings in results["results"].items():
+            for name, timing in timings.items():
+                self.stdout.write("{:>8} {:<32} median {:>9.3f} ms  min {:>9.3f} ms".format(
+                    size, name, timing["median"] * 1000, timing["min"] * 1000))
+
+        if options["compare"]:
+            self.compare(results, options["compare"])
+        if options["output"]:
+            with open(options["output"], "w") as output_file:
+                json.dump(results, output_file, indent=2)
+            self.stdout.write("Results written to {}".format(options["output"]))
+
+    def get_commit(self):
+        try:
+            return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def clear_cache(self):
+        cache.clear()
+        LOCAL_CACHE.clear()
+
+    def run_benchmarks(self, user_ids: list, repeat: int):
+        '''Returns timings of every benchmarked function, hottest user first in user_ids'''
+
+        hot_user, cold_user = str(user_ids[0]), str(user_ids[-1])
+        unpaid_ids = iter([str(transaction_id) for transaction_id in Transactions.objects.filter(
+            transaction_status="unpaid").values_list("id", flat=True)[:repeat + 1]])
+        users_utility = UsersUtility()
+        transaction_utility = TransactionUtility()
+
+        def get_history_cold(user_id):
+            self.clear_cache()
+            return transaction_utility.get_transactions_by_user_id(user_id)
+
+        benchmarks = {
+            "login": lambda: users_utility.login("{}_0".format(BENCHMARK_PREFIX), BENCHMARK_PREFIX),
+            "get_credit_score": lambda: users_utility.get_credit_score(hot_user),
+            "get_credit_scores": lambda: users_utility.get_credit_scores([str(user_id) for user_id in user_ids]),
+            "get_transactions_hot_cold_cache": lambda: get_history_cold(hot_user),
+            "get_transactions_hot_warm_cache": lambda: transaction_utility.get_transactions_by_user_id(hot_user),
+            "get_transactions_cold_user": lambda: get_history_cold(cold_user),
+            "get_transactions_page": lambda: transaction_utility.get_transactions_page(hot_user, 50),
+            "export_transactions": lambda: sum(len(line) for line in transaction_utility.export_transactions_by_user_id(
+                hot_user)["lines"]),
+            "add_transaction": lambda: transaction_utility.add_transaction(
+                hot_user, cold_user, 10.0, "lend", "paid", "2022-06-01", "benchmark"),
+            "mark_transaction_paid": lambda: transaction_utility.mark_transaction_paid(next(unpaid_ids, "")),
+        }
+
+        timings = {}
+        for name, benchmark in benchmarks.items():
+            # Untimed first call warms caches and lazy imports
+            benchmark()
+            samples = []
+            for _ in range(repeat):
+                start_time = time.perf_counter()
+                benchmark()
+                samples.append(time.perf_counter() - start_time)
+            timings[name] = {
+                "median": statistics.median(samples),
+                "mean": statistics.fmean(samples),
+                "min": min(samples),
+                "max": max(samples),
+            }
+        return timings
+
+    def compare(self, results: dict, path: str):
+        try:
+            with open(path) as previous_file:
+                previous = json.load(previous_file)
+        except (OSError, ValueError) as e:
+            raise CommandError("Can not read {}: {}".format(path, e))
+
+        self.stdout.write("Compared with {} ({})".format(
+            path, previous.get("commit")))
+        for size, timings in results["results"].items():
+            for name, timing in timings.items():
+                before = previous.get("results", {}).get(size, {}).get(name)
+                if before:
+                    self.stdout.write("{:>8} {:<32} {:>+8.1f}%".format(
+                        size, name, (timing["median"] / before["median"] - 1) * 100))
@@ -0,0 +1,220 @@
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import Users
+from api.synthetic import SyntheticLedger
+
+BENCHMARK_PREFIX = "serverbench"
+
+SERVERS = {
+    "wsgi": lambda port, options: [
+        sys.executable, "-c", "from gunicorn.app.wsgiapp import run; run()", "ledger.wsgi:application",
+        "--bind", "127.0.0.1:{}".format(port), "--workers", str(options["workers"]),
+        "--worker-class", "gthread", "--threads", str(options["threads"])],
+    "asgi": lambda port, options: [
+        sys.executable, "-m", "uvicorn", "ledger.asgi:application", "--host", "127.0.0.1",
+        "--port", str(port), "--workers", str(options["workers"]), "--log-level", "warning"],
+}
+
+ENDPOINTS = ("credit_score", "get_transactions")
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares throughput and latency of the read endpoints served by gunicorn (WSGI, threads) "
+        "and uvicorn (ASGI, async views) under concurrent keep-alive clients. Servers use an "
+        "in-memory cache that sleeps --delay seconds per call, a stand-in for a slow remote cache, "
+        "and the database of the current settings with a generated synthetic ledger."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--servers", default="wsgi,asgi",
+                            help="Comma separated servers, wsgi/asgi")
+        parser.add_argument("--endpoints", default=",".join(ENDPOINTS),
+                            help="Comma separated endpoints, credit_score/get_transactions")
+        parser.add_argument("--concurrency", default="1,16,64",
+                            help="Comma separated numbers of concurrent clients")
+        parser.add_argument("--duration", type=float, default=5.0,
+                            help="Seconds per run")
+        parser.add_argument("--delay", type=float, default=0.005,
+                            help="Seconds of delay per cache call")
+        parser.add_argument("--workers", type=int, default=1,
+                            help="Server worker processes")
+        parser.add_argument("--threads", type=int, default=8,
+                            help="Threads per gunicorn worker")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--output",
+                            help="Write JSON results to this file")
+
+    def handle(self, *args, **options):
+        servers = options["servers"].split(",")
+        endpoints = options["endpoints"].split(",")
+        try:
+            concurrencies = [int(value) for value in options["concurrency"].split(",")]
+        except ValueError:
+            raise CommandError("Concurrency should be comma separated integers")
+        if any(server not in SERVERS for server in servers) or any(
+                endpoint not in ENDPOINTS for endpoint in endpoints):
+            raise CommandError("Unknown server or endpoint")
+        if options["delay"] <= 0:
+            raise CommandError("Delay should be positive, it switches the servers to the slow cache")
+
+        user_id = self.get_user_id()
+        results = {"delay": options["delay"], "duration": options["duration"],
+                   "workers": options["workers"], "threads": options["threads"], "results": {}}
+        for server in servers:
+            with self.run_server(server, options) as port:
+                token = self.login(port)
+                for endpoint in endpoints:
+                    for concurrency in concurrencies:
+                        result = asyncio.run(self.load(
+                            port, endpoint, user_id, token, concurrency, options["duration"]))
+                        results["results"].setdefault(server, {}).setdefault(
+                            endpoint, {})[str(concurrency)] = result
+                        self.stdout.write("{:<5} {:<17} {:>4} clients {:>9.1f} req/s  p50 {:>8.2f} ms  "
+                                          "p99 {:>8.2f} ms  errors {}".format(
+                                              server, endpoint, concurrency, result["throughput"],
+                                              result["p50"] * 1000, result["p99"] * 1000, result["errors"]))
+
+        if options["output"]:
+            with open(options["output"], "w") as output_file:
+                json.dump(results, output_file, indent=2)
+            self.stdout.write("Results written to {}".format(options["output"]))
+
+    def get_user_id(self):
+        '''Returns hottest user of the benchmark ledger, generating the ledger on first run'''
+
+        user_ids = list(Users.objects.filter(username="{}_0".format(BENCHMARK_PREFIX)).values_list(
+            "id", flat=True))
+        if not user_ids:
+            user_ids = SyntheticLedger(100, 5000, username_prefix=BENCHMARK_PREFIX,
+                                       password=BENCHMARK_PREFIX).generate()
+        return str(user_ids[0])
+
+    def run_server(self, server: str, options: dict):
+        return ServerProcess(SERVERS[server](options["port"], options), options["port"], dict(
+            os.environ, DJANGO_SETTINGS_MODULE="ledger.benchmark_settings",
+            LEDGER_BENCHMARK_BASE_SETTINGS=settings.SETTINGS_MODULE,
+            LEDGER_SLOW_CACHE_DELAY=str(options["delay"]), LEDGER_LOG_LEVEL="WARNING"))
+
+    def login(self, port: int):
+        status, body = asyncio.run(self.request_once(port, "POST", "login", {
+            "username": "{}_0".format(BENCHMARK_PREFIX), "password": BENCHMARK_PREFIX}, None))
+        if status != 200:
+            raise CommandError("Login failed with status {}: {}".format(status, body))
+        return json.loads(body)["token"]
+
+    async def request_once(self, port: int, method: str, endpoint: str, payload: dict, token: str):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            writer.write(self.build_request(method, endpoint, payload, token))
+            return await self.read_response(reader)
+        finally:
+            writer.close()
+
+    def build_request(self, method: str, endpoint: str, payload: dict, token: str):
+        body = json.dumps(payload).encode()
+        headers = ["{} /api/{} HTTP/1.1".format(method, endpoint), "Host: 127.0.0.1",
+                   "Content-Type: application/json", "Content-Length: {}".format(len(body))]
+        if token:
+            headers.append("Authorization: Bearer {}".format(token))
+        return "\r\n".join(headers).encode() + b"\r\n\r\n" + body
+
+    async def read_response(self, reader):
+        '''Returns status and body of one HTTP/1.1 response with Content-Length'''
+
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        length = 0
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value)
+        return int(lines[0].split()[1]), await reader.readexactly(length)
+
+    async def load(self, port: int, endpoint: str, user_id: str, token: str, concurrency: int,
+                   duration: float):
+        '''Runs concurrent keep-alive clients for duration seconds, returns throughput and latencies'''
+
+        request = self.build_request("GET", endpoint, {"user_id": user_id}, token)
+        latencies = []
+        errors = 0
+        deadline = time.perf_counter() + duration
+
+        async def client():
+            nonlocal errors
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            try:
+                while time.perf_counter() < deadline:
+                    start_time = time.perf_counter()
+                    writer.write(request)
+                    status, _ = await self.read_response(reader)
+                    latencies.append(time.perf_counter() - start_time)
+                    if status != 200:
+                        errors += 1
+            finally:
+                writer.close()
+
+        start_time = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start_time
+
+        latencies.sort()
+        return {
+            "requests": len(latencies),
+            "errors": errors,
+            "throughput": len(latencies) / elapsed,
+            "p50": statistics.median(latencies) if latencies else 0.0,
+            "p99": latencies[int(len(latencies) * 0.99)] if latencies else 0.0,
+        }
+
+
+class ServerProcess:
+    '''Context manager running a server subprocess until it accepts connections, returns its port'''
+
+    def __init__(self, command: list, port: int, env: dict, timeout: float = 30.0):
+        self.command = command
+        self.port = port
+        self.env = env
+        self.timeout = timeout
+        self.process = None
+        self.log_file = None
+
+    def __enter__(self):
+        # Server output goes to a file, a full pipe would block the server
+        self.log_file = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(self.command, env=self.env, cwd=str(settings.BASE_DIR),
+                                        stdout=self.log_file, stderr=subprocess.STDOUT)
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                self.log_file.seek(0)
+                output = self.log_file.read().decode(errors="replace")[-2000:]
+                self.log_file.close()
+                raise CommandError("Server exited: {}".format(output))
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=0.5).close()
+                return self.port
+            except OSError:
+                time.sleep(0.2)
+        self.__exit__(None, None, None)
+        raise CommandError("Server did not start within {} seconds".format(self.timeout))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.log_file.close()
@@ -0,0 +1,190 @@
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connection
+
+from api.models import Users
+from api.utils import TransactionUtility
+
+BENCHMARK_PREFIX = "sqlitebench"
+
+# Environment of the worker process per profile, stock is SQLite defaults with a connection per request
+PROFILES = {
+    "stock": {"LEDGER_SQLITE_TUNING": "0", "LEDGER_DB_CONN_MAX_AGE": "0"},
+    "tuned": {"LEDGER_SQLITE_TUNING": "1", "LEDGER_DB_CONN_MAX_AGE": "60"},
+}
+
+PATHS = ("history", "add_transaction")
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares throughput and latency of the history (get_transactions_page) and add_transaction "
+        "paths on a SQLite file under concurrent reader and writer threads, with stock SQLite settings "
+        "and a connection per request against LEDGER_SQLITE_PRAGMAS with persistent connections. "
+        "Every profile runs in its own process on a copy of the same synthetic ledger."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--profiles", default=",".join(PROFILES),
+                            help="Comma separated profiles, stock/tuned")
+        parser.add_argument("--readers", type=int, default=4,
+                            help="Threads reading history pages")
+        parser.add_argument("--writers", type=int, default=2,
+                            help="Threads adding transactions")
+        parser.add_argument("--duration", type=float, default=5.0,
+                            help="Seconds per profile")
+        parser.add_argument("--users", type=int, default=200,
+                            help="Users of the synthetic ledger")
+        parser.add_argument("--transactions", type=int, default=20000,
+                            help="Transactions of the synthetic ledger")
+        parser.add_argument("--output",
+                            help="Write JSON results to this file")
+        parser.add_argument("--worker", action="store_true",
+                            help="Run the load on the configured database and print JSON, used by the profiles")
+
+    def handle(self, *args, **options):
+        if options["readers"] < 0 or options["writers"] < 0 or options["readers"] + options["writers"] == 0:
+            raise CommandError("At least one reader or writer is needed")
+        if options["worker"]:
+            self.stdout.write(json.dumps(self.run_load(options)))
+            return
+
+        profiles = options["profiles"].split(",")
+        if any(profile not in PROFILES for profile in profiles):
+            raise CommandError("Unknown profile")
+
+        results = {"readers": options["readers"], "writers": options["writers"],
+                   "duration": options["duration"], "results": {}}
+        directory = tempfile.mkdtemp(prefix="ledger-sqlite-")
+        try:
+            template = os.path.join(directory, "template.sqlite3")
+            self.build_template(template, options)
+            for profile in profiles:
+                path = os.path.join(directory, "{}.sqlite3".format(profile))
+                shutil.copyfile(template, path)
+                result = results["results"][profile] = self.run_profile(
+                    profile, path, options)
+                for name in PATHS:
+                    self.stdout.write("{:<6} {:<16} {:>9.1f} ops/s  p50 {:>8.2f} ms  p99 {:>8.2f} ms  errors {}".format(
+                        profile, name, result[name]["throughput"], result[name]["p50"] * 1000,
+                        result[name]["p99"] * 1000, result[name]["errors"]))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        if "stock" in results["results"] and "tuned" in results["results"]:
+            for name in PATHS:
+                stock = results["results"]["stock"][name]["throughput"]
+                if stock:
+                    self.stdout.write("{:<16} tuned/stock throughput x{:.2f}".format(
+                        name, results["results"]["tuned"][name]["throughput"] / stock))
+
+        if options["output"]:
+            with open(options["output"], "w") as output_file:
+                json.dump(results, output_file, indent=2)
+            self.stdout.write("Results written to {}".format(options["output"]))
+
+    def get_env(self, path: str, profile: str = "stock"):
+        return dict(os.environ, DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE, LEDGER_SQLITE_PATH=path,
+                    LEDGER_LOG_LEVEL="WARNING", **PROFILES[profile])
+
+    def manage(self, arguments: list, env: dict):
+        completed = subprocess.run([sys.executable, str(settings.BASE_DIR / "manage.py")] + arguments,
+                                   env=env, cwd=str(settings.BASE_DIR), capture_output=True, text=True)
+        if completed.returncode:
+            raise CommandError("{} failed: {}".format(
+                arguments[0], completed.stderr[-2000:]))
+        return completed.stdout
+
+    def build_template(self, path: str, options: dict):
+        '''Migrates and fills the database file every profile starts from, in the stock rollback journal mode'''
+
+        env = self.get_env(path)
+        self.manage(["migrate", "--verbosity", "0"], env)
+        self.manage(["generate_ledger", "--users", str(options["users"]), "--transactions",
+                     str(options["transactions"]), "--username-prefix", BENCHMARK_PREFIX], env)
+
+    def run_profile(self, profile: str, path: str, options: dict):
+        output = self.manage(["benchmark_sqlite", "--worker", "--readers", str(options["readers"]),
+                              "--writers", str(options["writers"]), "--duration", str(options["duration"])],
+                             self.get_env(path, profile))
+        return json.loads(output.strip().splitlines()[-1])
+
+    def run_load(self, options: dict):
+        '''Runs reader and writer threads for duration seconds, every operation as one request'''
+
+        user_ids = [str(user_id) for user_id in Users.objects.filter(
+            username__startswith=BENCHMARK_PREFIX).values_list("id", flat=True)]
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode")
+            journal_mode = cursor.fetchone()[0]
+        close_old_connections()
+        if len(user_ids) < 2:
+            raise CommandError("The database has no benchmark ledger")
+
+        latencies = {name: [] for name in PATHS}
+        errors = {name: 0 for name in PATHS}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + options["duration"]
+
+        def read(rng):
+            return TransactionUtility().get_transactions_page(rng.choice(user_ids), 50)
+
+        def write(rng):
+            lender_id, borrower_id = rng.sample(user_ids, 2)
+            return TransactionUtility().add_transaction(
+                lender_id, borrower_id, round(rng.uniform(1, 500), 2), "lend",
+                rng.choice(("paid", "unpaid")), "2022-04-10", "benchmark")
+
+        def worker(name, operation, seed):
+            rng = random.Random(seed)
+            try:
+                while time.perf_counter() < deadline:
+                    # Like request_started and request_finished, closes connections past CONN_MAX_AGE
+                    close_old_connections()
+                    start_time = time.perf_counter()
+                    try:
+                        failed = operation(rng).get("code") != 200
+                    except Exception:
+                        failed = True
+                    elapsed = time.perf_counter() - start_time
+                    close_old_connections()
+                    with lock:
+                        latencies[name].append(elapsed)
+                        errors[name] += failed
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=("history", read, index))
+                   for index in range(options["readers"])]
+        threads += [threading.Thread(target=worker, args=("add_transaction", write, 1000 + index))
+                    for index in range(options["writers"])]
+        start_time = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start_time
+
+        result = {"journal_mode": journal_mode,
+                  "conn_max_age": settings.DATABASES["default"]["CONN_MAX_AGE"]}
+        for name in PATHS:
+            values = sorted(latencies[name])
+            result[name] = {
+                "requests": len(values),
+                "errors": errors[name],
+                "throughput": len(values) / elapsed,
+                "p50": statistics.median(values) if values else 0.0,
+                "p99": values[int(len(values) * 0.99)] if values else 0.0,
+            }
+        return result
@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import Users
+from api.synthetic import SyntheticLedger
+
+
+class Command(BaseCommand):
+    help = (
+        "Generates a reproducible synthetic ledger: users with power-law distributed activity and "
+        "transactions with a mix of paid and unpaid statuses spread over a date range. Rows are "
+        "bulk inserted, balances and aggregates are recomputed at the end."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000,
+                            help="Users to generate")
+        parser.add_argument("--transactions", type=int, default=100000,
+                            help="Transactions to generate")
+        parser.add_argument("--seed", type=int, default=0,
+                            help="Random seed, the same seed generates the same ledger")
+        parser.add_argument("--skew", type=float, default=1.1,
+                            help="Power-law exponent of user activity, 0 spreads transactions evenly")
+        parser.add_argument("--paid-ratio", type=float, default=0.7,
+                            help="Share of paid transactions")
+        parser.add_argument("--days", type=int, default=365,
+                            help="Days the transaction dates are spread over")
+        parser.add_argument("--batch-size", type=int, default=5000,
+                            help="Rows inserted per batch")
+        parser.add_argument("--username-prefix", default="synthetic",
+                            help="Usernames are <prefix>_<n>, the password of every user is the prefix")
+
+    def handle(self, *args, **options):
+        if options["users"] < 2:
+            raise CommandError("At least 2 users are needed")
+        if not 0 <= options["paid_ratio"] <= 1:
+            raise CommandError("Paid ratio should be between 0 and 1")
+        if options["days"] <= 0 or options["batch_size"] <= 0:
+            raise CommandError("Days and batch size should be positive")
+        prefix = options["username_prefix"]
+        if Users.objects.filter(username__startswith="{}_".format(prefix)).exists():
+            raise CommandError(
+                "Users with prefix {} already exist, use another --username-prefix".format(prefix))
+
+        start_time = time.time()
+        SyntheticLedger(
+            options["users"], options["transactions"], seed=options["seed"], skew=options["skew"],
+            paid_ratio=options["paid_ratio"], days=options["days"], username_prefix=prefix,
+            password=prefix).generate(options["batch_size"])
+        elapsed = time.time() - start_time
+
+        self.stdout.write(self.style.SUCCESS("Generated {} users and {} transactions in {:.1f}s ({:.0f} rows/s)".format(
+            options["users"], options["transactions"], elapsed,
+            (options["users"] + options["transactions"]) / max(elapsed, 1e-9))))
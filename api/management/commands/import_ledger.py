@@ -0,0 +1,185 @@
+import csv
+import itertools
+import json
+import os
+import time
+import uuid
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction as db_transaction
+
+from api.models import TRANSACTION_STATUS_CHOICES, Transactions, Users
+from api.money import to_minor_units
+from api.utils import AggregatesUtility, TransactionUtility
+
+# Namespace of transaction ids derived from file name and row number, so a
+# batch replayed after a crash inserts the same ids and is skipped as duplicate
+IMPORT_NAMESPACE = uuid.UUID("6c1b4a52-5e0f-4d43-9a58-3c2b8f0e7d11")
+
+
+class Command(BaseCommand):
+    help = (
+        "Streams historical transactions from a CSV or NDJSON file into the ledger in batches. "
+        "Rows have transaction_from (lender), transaction_with (borrower), transaction_amount, "
+        "transaction_status and optional transaction_id, transaction_type, transaction_date and reason. "
+        "Progress is checkpointed after every batch, re-running the command resumes from the checkpoint."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV or NDJSON file to import")
+        parser.add_argument("--format", choices=("csv", "ndjson"),
+                            help="File format, guessed from the file extension by default")
+        parser.add_argument("--batch-size", type=int, default=5000,
+                            help="Rows inserted per batch")
+        parser.add_argument("--checkpoint",
+                            help="Checkpoint file, defaults to <path>.checkpoint")
+        parser.add_argument("--restart", action="store_true",
+                            help="Ignore existing checkpoint and import from the first row")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        if not os.path.exists(path):
+            raise CommandError("File {} does not exist".format(path))
+        if options["batch_size"] <= 0:
+            raise CommandError("Batch size should be positive")
+
+        file_format = options["format"] or (
+            "csv" if path.lower().endswith(".csv") else "ndjson")
+        checkpoint_path = options["checkpoint"] or "{}.checkpoint".format(path)
+        checkpoint = {"rows": 0, "imported": 0, "rejected": 0}
+        if os.path.exists(checkpoint_path) and not options["restart"]:
+            with open(checkpoint_path) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            self.stdout.write("Resuming after row {}".format(checkpoint["rows"]))
+
+        user_ids = {}
+        for user_id in Users.objects.values_list("id", flat=True).iterator():
+            user_ids[str(user_id)] = user_ids[user_id.hex] = user_id
+
+        self.verbosity = options["verbosity"]
+        self.file_name = os.path.basename(path)
+        self.affected_user_ids = set()
+        start_time = time.time()
+        started_rows = checkpoint["rows"]
+
+        with open(path, newline="") as source:
+            rows = self.read_rows(source, file_format)
+            rows = itertools.islice(rows, checkpoint["rows"], None)
+            row_number = checkpoint["rows"]
+
+            while True:
+                batch = list(itertools.islice(rows, options["batch_size"]))
+                if not batch:
+                    break
+
+                new_transactions = []
+                for row in batch:
+                    row_number += 1
+                    transaction = self.build_transaction(row, row_number, user_ids)
+                    if transaction is None:
+                        checkpoint["rejected"] += 1
+                    else:
+                        new_transactions.append(transaction)
+
+                with db_transaction.atomic():
+                    # Rows imported by an earlier run are skipped, so only actual inserts are counted
+                    new_transactions = self.skip_existing(new_transactions)
+                    Transactions.objects.bulk_create(
+                        new_transactions, batch_size=1000, ignore_conflicts=True)
+
+                checkpoint["rows"] = row_number
+                checkpoint["imported"] += len(new_transactions)
+                self.save_checkpoint(checkpoint_path, checkpoint)
+
+                elapsed = time.time() - start_time
+                self.stdout.write("Imported {} rows, rejected {} - {:.0f} rows/s".format(
+                    checkpoint["imported"], checkpoint["rejected"],
+                    (row_number - started_rows) / elapsed if elapsed else 0))
+
+        self.stdout.write("Recomputing balances and aggregates")
+        TransactionUtility().recompute_balances()
+        AggregatesUtility().rebuild()
+        affected_user_ids = list(self.affected_user_ids)
+        for start in range(0, len(affected_user_ids), 1000):
+            TransactionUtility().delete_transaction_cache(
+                affected_user_ids[start:start + 1000], "ImportLedger")
+
+        self.stdout.write(self.style.SUCCESS("Imported {} rows, rejected {} rows in {:.1f}s".format(
+            checkpoint["imported"], checkpoint["rejected"], time.time() - start_time)))
+
+    def read_rows(self, source, file_format: str):
+        '''Yields rows of the source file as dicts'''
+
+        if file_format == "csv":
+            yield from csv.DictReader(source)
+        else:
+            for line in source:
+                try:
+                    row = json.loads(line) if line.strip() else {}
+                except ValueError:
+                    row = {}
+                # Malformed lines become empty rows, which are rejected like invalid CSV rows
+                yield row if isinstance(row, dict) else {}
+
+    def build_transaction(self, row: dict, row_number: int, user_ids: dict):
+        '''Returns unsaved Transactions object for row, None if row is invalid'''
+
+        lender_id = user_ids.get(str(row.get("transaction_from", "")).lower())
+        borrower_id = user_ids.get(str(row.get("transaction_with", "")).lower())
+        status = row.get("transaction_status")
+        # Amounts are major units with at most 2 decimal places, stored as minor units
+        amount = to_minor_units(row.get("transaction_amount")) or 0
+        try:
+            transaction_date = datetime.fromisoformat(
+                row.get("transaction_date") or "")
+        except (TypeError, ValueError):
+            transaction_date = None
+
+        if (not lender_id or not borrower_id or lender_id == borrower_id or amount <= 0
+                or status not in dict(TRANSACTION_STATUS_CHOICES) or not transaction_date):
+            if self.verbosity > 1:
+                self.stderr.write("Rejected row {}".format(row_number))
+            return None
+
+        if row.get("transaction_type") == "borrow":
+            lender_id, borrower_id = borrower_id, lender_id
+        try:
+            transaction_id = uuid.UUID(str(row["transaction_id"]))
+        except (KeyError, ValueError):
+            transaction_id = uuid.uuid5(
+                IMPORT_NAMESPACE, "{}:{}".format(self.file_name, row_number))
+
+        self.affected_user_ids.update((lender_id, borrower_id))
+        return Transactions(
+            id=transaction_id,
+            transaction_from_id=lender_id,
+            transaction_with_id=borrower_id,
+            transaction_amount=amount,
+            transaction_status=status,
+            transaction_date=transaction_date,
+            reason=row.get("reason") or None
+        )
+
+    def skip_existing(self, transactions: list):
+        '''Returns transactions whose id is neither in the ledger nor earlier in the list'''
+
+        unique = {}
+        for transaction in transactions:
+            unique.setdefault(transaction.id, transaction)
+        transactions = list(unique.values())
+
+        existing_ids = set()
+        for start in range(0, len(transactions), 1000):
+            existing_ids.update(Transactions.objects.filter(id__in=[
+                transaction.id for transaction in transactions[start:start + 1000]
+            ]).values_list("id", flat=True))
+        return [transaction for transaction in transactions if transaction.id not in existing_ids]
+
+    def save_checkpoint(self, checkpoint_path: str, checkpoint: dict):
+        '''Writes checkpoint atomically so a crash never leaves it half written'''
+
+        temp_path = "{}.tmp".format(checkpoint_path)
+        with open(temp_path, "w") as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+        os.replace(temp_path, checkpoint_path)
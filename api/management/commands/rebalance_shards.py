@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.sharding import get_shards, is_sharded
+from api.utils import ShardUtility
+
+
+class Command(BaseCommand):
+    help = (
+        "Applies shard transfers left pending, then moves every user that is not on the shard "
+        "their id hashes to under the current LEDGER_SHARDS. Pause writes while users move."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Only list the users that would move")
+        parser.add_argument("--recover-only", action="store_true",
+                            help="Only apply pending shard transfers")
+        parser.add_argument("--retired", default="",
+                            help="Comma separated shards removed from LEDGER_SHARDS to move users off")
+
+    def handle(self, *args, **options):
+        if not is_sharded():
+            raise CommandError("LEDGER_SHARDS is empty, the ledger is not sharded")
+
+        retired = options["retired"]
+        if isinstance(retired, str):
+            retired = [alias for alias in retired.split(",") if alias]
+        unknown = [alias for alias in retired if alias not in settings.DATABASES]
+        if unknown:
+            raise CommandError("Unknown database aliases {}".format(", ".join(unknown)))
+
+        aliases = get_shards() + [alias for alias in retired if alias not in get_shards()]
+        shard_utility = ShardUtility()
+        if not options["dry_run"]:
+            count = shard_utility.recover_transfers(aliases)
+            self.stdout.write("Applied {} pending transfers".format(count))
+        if options["recover_only"]:
+            return
+
+        misplaced = shard_utility.get_misplaced_users(aliases)
+        for user_id, source, target in misplaced:
+            self.stdout.write("{} {} -> {}".format(user_id, source, target))
+            if not options["dry_run"]:
+                shard_utility.move_user(user_id, source, target)
+
+        self.stdout.write(self.style.SUCCESS("{} {} users".format(
+            "Would move" if options["dry_run"] else "Moved", len(misplaced))))
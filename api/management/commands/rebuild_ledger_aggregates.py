@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.utils import AggregatesUtility
+
+
+class Command(BaseCommand):
+    help = "Rebuilds per-user ledger aggregates from Transactions and verifies them"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--verify-only", action="store_true",
+            help="Only compare stored aggregates with Transactions, do not rebuild")
+
+    def handle(self, *args, **options):
+        aggregates_utility = AggregatesUtility()
+
+        if not options["verify_only"]:
+            count = aggregates_utility.rebuild()
+            self.stdout.write("Rebuilt aggregates of {} users".format(count))
+
+        mismatches = aggregates_utility.verify()
+        if mismatches:
+            raise CommandError("Aggregates differ from Transactions for {} users: {}".format(
+                len(mismatches), ", ".join(str(user_id) for user_id in mismatches[:20])))
+
+        self.stdout.write(self.style.SUCCESS("Aggregates match Transactions"))
@@ -0,0 +1,54 @@
+import shutil
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.profiling import ProfileStore
+
+
+class Command(BaseCommand):
+    help = "Lists request profiles recorded by ProfilerMiddleware or shows one of them"
+
+    def add_arguments(self, parser):
+        parser.add_argument("profile_id", nargs="?",
+                            help="Profile to show, the latest profiles are listed without it")
+        parser.add_argument("--limit", type=int, default=20,
+                            help="Number of latest profiles to list")
+        parser.add_argument("--dump-stats", metavar="FILE",
+                            help="Copy raw cProfile stats of the profile to FILE, for pstats or snakeviz")
+        parser.add_argument("--clear", action="store_true",
+                            help="Delete all stored profiles")
+
+    def handle(self, *args, **options):
+        store = ProfileStore()
+
+        if options["clear"]:
+            store.clear()
+            self.stdout.write("Deleted all profiles")
+            return
+
+        if not options["profile_id"]:
+            for profile_id in reversed(store.get_ids()[-options["limit"]:]):
+                report = store.get(profile_id)
+                if report:
+                    self.stdout.write("{}  {:<7} {:<30} {} {:>9.1f} ms  {:>3} queries {:>9.1f} ms".format(
+                        profile_id, report["method"], report["route"], report["status"],
+                        report["duration"] * 1000, len(report["sql"]), report["sql_seconds"] * 1000))
+            return
+
+        report = store.get(options["profile_id"])
+        if report is None:
+            raise CommandError(
+                "Profile {} does not exist".format(options["profile_id"]))
+
+        if options["dump_stats"]:
+            shutil.copyfile(store.get_path(
+                report["id"], "prof"), options["dump_stats"])
+
+        self.stdout.write("{} {} -> {} in {:.1f} ms".format(
+            report["method"], report["path"], report["status"], report["duration"] * 1000))
+        self.stdout.write("\nSQL: {} queries in {:.1f} ms".format(
+            len(report["sql"]), report["sql_seconds"] * 1000))
+        for statement in report["sql"]:
+            self.stdout.write("{:>9.3f} ms  {}".format(
+                statement["seconds"] * 1000, statement["sql"]))
+        self.stdout.write("\n" + report["stats"])
@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.replication import ReplicationLagSimulator
+
+
+class Command(BaseCommand):
+    help = (
+        "Replicates the ledger tables of the primary database to a replica with a lag, for local "
+        "testing of LEDGER_READ_REPLICAS with two SQLite files. Runs until interrupted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--replica", default="replica",
+                            help="Database alias of the replica")
+        parser.add_argument("--lag", type=float, default=2.0,
+                            help="Seconds the replica is behind the primary")
+        parser.add_argument("--interval", type=float, default=0.5,
+                            help="Seconds between snapshots of the primary")
+        parser.add_argument("--once", action="store_true",
+                            help="Bring the replica up to date once and exit")
+
+    def handle(self, *args, **options):
+        if options["replica"] not in settings.DATABASES:
+            raise CommandError(
+                "Unknown database alias {}".format(options["replica"]))
+
+        simulator = ReplicationLagSimulator(options["replica"], options["lag"])
+        if options["once"]:
+            simulator.sync()
+            self.stdout.write("Replica {} is up to date".format(options["replica"]))
+            return
+
+        self.stdout.write("Replicating to {} with {}s lag, press Ctrl+C to stop".format(
+            options["replica"], options["lag"]))
+        try:
+            simulator.run(options["interval"])
+        except KeyboardInterrupt:
+            pass
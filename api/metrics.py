@@ -0,0 +1,220 @@
+import threading
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100)
+RESPONSE_SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536,
+                         262144, 1048576, 4194304)
+
+
+class ShardedMetric:
+    '''
+    Base of metrics whose series are kept in one shard per thread
+
+    A thread only ever writes its own shard, so recording takes no lock. The
+    lock is taken once per thread to register its shard and when rendering,
+    where shards of finished threads are folded into one retired shard so
+    thread churn does not grow the shard list.
+
+    '''
+
+    kind = None
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+        self.retired = {}
+
+    def get_shard(self):
+        '''Returns series dict of the current thread'''
+
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+            return shard
+
+    def new_series(self):
+        raise NotImplementedError
+
+    def merge_series(self, target: list, source: list):
+        for index, value in enumerate(source):
+            target[index] += value
+
+    def collect(self):
+        '''Returns series of all threads summed by labels'''
+
+        with self.lock:
+            live_shards = []
+            for thread, shard in self.shards:
+                if thread.is_alive():
+                    live_shards.append((thread, shard))
+                    continue
+                for labels, series in shard.items():
+                    self.merge_series(self.retired.setdefault(
+                        labels, self.new_series()), series)
+            self.shards = live_shards
+
+            merged = {labels: list(series)
+                      for labels, series in self.retired.items()}
+            for _, shard in live_shards:
+                # list() copies the items in one step, the owning thread may add series meanwhile
+                for labels, series in list(shard.items()):
+                    self.merge_series(merged.setdefault(
+                        labels, self.new_series()), list(series))
+
+        return merged
+
+    def reset(self):
+        with self.lock:
+            for _, shard in self.shards:
+                shard.clear()
+            self.retired = {}
+
+    def format_labels(self, labels: tuple, extra: str = None):
+        pairs = ['{}="{}"'.format(name, escape_label_value(value))
+                 for name, value in zip(self.labelnames, labels)]
+        if extra:
+            pairs.append(extra)
+        return "{{{}}}".format(",".join(pairs)) if pairs else ""
+
+    def render(self):
+        '''Returns metric in Prometheus text exposition format'''
+
+        lines = ["# HELP {} {}".format(self.name, self.help_text),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        for labels, series in sorted(self.collect().items()):
+            lines.extend(self.render_series(labels, series))
+        return "\n".join(lines)
+
+    def render_series(self, labels: tuple, series: list):
+        raise NotImplementedError
+
+
+class Counter(ShardedMetric):
+    '''Monotonic counter per label values'''
+
+    kind = "counter"
+
+    def new_series(self):
+        return [0]
+
+    def inc(self, labels: tuple, value=1):
+        shard = self.get_shard()
+        series = shard.get(labels)
+        if series is None:
+            series = shard[labels] = self.new_series()
+        series[0] += value
+
+    def render_series(self, labels: tuple, series: list):
+        return ["{}{} {}".format(self.name, self.format_labels(labels), format_value(series[0]))]
+
+
+class Histogram(ShardedMetric):
+    '''
+    Histogram per label values
+
+    Every series is a pre-allocated list of per bucket counts, the +Inf
+    count and the sum. Counts are made cumulative only when rendering.
+
+    '''
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple, buckets: tuple):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def new_series(self):
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def observe(self, labels: tuple, value):
+        shard = self.get_shard()
+        series = shard.get(labels)
+        if series is None:
+            series = shard[labels] = self.new_series()
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render_series(self, labels: tuple, series: list):
+        lines = []
+        count = 0
+        for bound, bucket_count in zip(self.buckets + ("+Inf",), series):
+            count += bucket_count
+            lines.append("{}_bucket{} {}".format(self.name, self.format_labels(
+                labels, 'le="{}"'.format(format_value(bound))), count))
+        lines.append("{}_sum{} {}".format(
+            self.name, self.format_labels(labels), format_value(series[-1])))
+        lines.append("{}_count{} {}".format(
+            self.name, self.format_labels(labels), count))
+        return lines
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class LedgerMetrics:
+    '''Metrics of this process, rendered by the /metrics endpoint'''
+
+    def __init__(self):
+        self.request_duration = Histogram(
+            "ledger_request_duration_seconds", "Request latency by endpoint and method.",
+            ("endpoint", "method"), LATENCY_BUCKETS)
+        self.request_db_queries = Histogram(
+            "ledger_request_db_queries", "DB queries per request by endpoint and method.",
+            ("endpoint", "method"), QUERY_COUNT_BUCKETS)
+        self.request_db_seconds = Counter(
+            "ledger_request_db_seconds_total", "Time spent in DB queries by endpoint and method.",
+            ("endpoint", "method"))
+        self.response_size = Histogram(
+            "ledger_response_size_bytes", "Response body size by endpoint and method.",
+            ("endpoint", "method"), RESPONSE_SIZE_BUCKETS)
+        self.responses = Counter(
+            "ledger_responses_total", "Responses by endpoint, method and status code.",
+            ("endpoint", "method", "status"))
+        self.cache_requests = Counter(
+            "ledger_cache_requests_total", "Cache lookups by key family, tier and result.",
+            ("family", "tier", "result"))
+
+    def get_metrics(self):
+        return (self.request_duration, self.request_db_queries, self.request_db_seconds,
+                self.response_size, self.responses, self.cache_requests)
+
+    def record_request(self, endpoint: str, method: str, status: int, duration: float,
+                       db_queries: int, db_seconds: float, response_size: int = None):
+        labels = (endpoint, method)
+        self.request_duration.observe(labels, duration)
+        self.request_db_queries.observe(labels, db_queries)
+        self.request_db_seconds.inc(labels, db_seconds)
+        self.responses.inc((endpoint, method, status))
+        if response_size is not None:
+            self.response_size.observe(labels, response_size)
+
+    def record_cache(self, family: str, tier: str, hit: bool):
+        self.cache_requests.inc((family, tier, "hit" if hit else "miss"))
+
+    def render(self):
+        '''Returns all metrics in Prometheus text exposition format'''
+
+        return "\n".join(metric.render() for metric in self.get_metrics()) + "\n"
+
+    def reset(self):
+        for metric in self.get_metrics():
+            metric.reset()
+
+
+METRICS = LedgerMetrics()
@@ -0,0 +1,237 @@
+import cProfile
+import random
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from .log import LOG_DEBUG_SAMPLED, LOG_ROUTE, should_sample_debug
+from .metrics import METRICS
+from .profiling import ProfileStore, SQLRecorder
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Any other method is recorded as OTHER so clients can not create new series
+KNOWN_METHODS = frozenset(
+    ("GET", "POST", "PUT", "PATCH", "DELETE", "HEAD", "OPTIONS"))
+
+
+class QueryRecorder:
+    '''DB execute wrapper counting queries of a request and the time spent in them'''
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start_time = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start_time
+            self.count += 1
+
+
+class RequestMetricsMiddleware:
+    '''
+    Records latency, DB queries and time, status and response size of every request
+
+    Endpoints are labelled by URL route so the number of series stays bounded.
+    Streaming responses are timed until their first byte and have no size.
+    Under ASGI the query wrappers are installed in the request's DB thread,
+    as DB connections belong to the thread running the ORM calls.
+
+    '''
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, "LEDGER_METRICS_ENABLED", True):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        recorder = QueryRecorder()
+        start_time = time.perf_counter()
+        with ExitStack() as stack:
+            self.wrap_connections(stack, recorder)
+            response = self.get_response(request)
+        self.record(request, response, recorder,
+                    time.perf_counter() - start_time)
+        return response
+
+    async def __acall__(self, request):
+        recorder = QueryRecorder()
+        start_time = time.perf_counter()
+        stack = ExitStack()
+        await sync_to_async(self.wrap_connections)(stack, recorder)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+        self.record(request, response, recorder,
+                    time.perf_counter() - start_time)
+        return response
+
+    def wrap_connections(self, stack: ExitStack, recorder: QueryRecorder):
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+
+    def record(self, request, response, recorder: QueryRecorder, duration: float):
+        resolver_match = request.resolver_match
+        endpoint = resolver_match.route if resolver_match else "unmatched"
+        method = request.method if request.method in KNOWN_METHODS else "OTHER"
+        METRICS.record_request(
+            endpoint, method, response.status_code, duration, recorder.count, recorder.seconds,
+            None if response.streaming else len(response.content))
+
+
+class LogContextMiddleware:
+    '''Sets the route of the request and its debug log sampling decision for the api log filter'''
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+            # Django would run a sync process_view in a thread, setting the variables in a copied context
+            self.process_view = self.aprocess_view
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        try:
+            return self.get_response(request)
+        finally:
+            self.reset_context(request)
+
+    async def __acall__(self, request):
+        try:
+            return await self.get_response(request)
+        finally:
+            self.reset_context(request)
+
+    def reset_context(self, request):
+        if getattr(request, "log_context_tokens", None):
+            route_token, sampled_token = request.log_context_tokens
+            LOG_DEBUG_SAMPLED.reset(sampled_token)
+            LOG_ROUTE.reset(route_token)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        route = request.resolver_match.route
+        request.log_context_tokens = (
+            LOG_ROUTE.set(route), LOG_DEBUG_SAMPLED.set(should_sample_debug(route)))
+        return None
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        return LogContextMiddleware.process_view(self, request, view_func, view_args, view_kwargs)
+
+
+class ProfilerMiddleware:
+    '''
+    Profiles requests with cProfile and records their SQL statements
+
+    A request is profiled if its LEDGER_PROFILER_HEADER carries one of
+    LEDGER_PROFILER_TOKENS or it is picked by LEDGER_PROFILER_SAMPLE_RATE.
+    Reports go to the on-disk ring buffer read by the show_profiles command.
+    Unless LEDGER_PROFILER_ENABLED is set the middleware removes itself at
+    startup, so it costs nothing. Under ASGI only the event loop thread is
+    profiled, the SQL of the request's DB thread is still recorded.
+
+    '''
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, "LEDGER_PROFILER_ENABLED", False):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+        self.header = getattr(
+            settings, "LEDGER_PROFILER_HEADER", "X-Ledger-Profile")
+        self.tokens = frozenset(
+            getattr(settings, "LEDGER_PROFILER_TOKENS", ()))
+        self.sample_rate = getattr(settings, "LEDGER_PROFILER_SAMPLE_RATE", 0.0)
+        self.store = ProfileStore()
+
+    def should_profile(self, request):
+        token = request.headers.get(self.header)
+        if token and token in self.tokens:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.should_profile(request):
+            return self.get_response(request)
+
+        recorder = SQLRecorder()
+        profiler = cProfile.Profile()
+        start_time = time.perf_counter()
+        with ExitStack() as stack:
+            self.wrap_connections(stack, recorder)
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+        return self.save(request, response, profiler, recorder, time.perf_counter() - start_time)
+
+    async def __acall__(self, request):
+        if not self.should_profile(request):
+            return await self.get_response(request)
+
+        recorder = SQLRecorder()
+        profiler = cProfile.Profile()
+        start_time = time.perf_counter()
+        stack = ExitStack()
+        await sync_to_async(self.wrap_connections)(stack, recorder)
+        try:
+            profiler.enable()
+            try:
+                response = await self.get_response(request)
+            finally:
+                profiler.disable()
+        finally:
+            await sync_to_async(stack.close)()
+        return await sync_to_async(self.save, thread_sensitive=False)(
+            request, response, profiler, recorder, time.perf_counter() - start_time)
+
+    def wrap_connections(self, stack: ExitStack, recorder: SQLRecorder):
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+
+    def save(self, request, response, profiler: cProfile.Profile, recorder: SQLRecorder, duration: float):
+        '''Writes the profile report of request, returns response carrying its id'''
+
+        resolver_match = request.resolver_match
+        try:
+            profile_id = self.store.save({
+                "time": time.time(),
+                "route": resolver_match.route if resolver_match else "unmatched",
+                "path": request.path,
+                "method": request.method,
+                "status": response.status_code,
+                "duration": duration,
+                "sql_seconds": sum(statement["seconds"] for statement in recorder.statements),
+                "sql": recorder.statements,
+            }, profiler)
+        except OSError as e:
+            logger.error("ProfilerMiddleware - ERROR - Exception - %s", e)
+        else:
+            response["X-Ledger-Profile-Id"] = profile_id
+        return response
@@ -0,0 +1,40 @@
+# Generated by Django 4.0.3 on 2026-10-18 18:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_remove_transactions_transaction_type'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='transactions',
+            name='transaction_from',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='transaction_from', to='api.users'),
+        ),
+        migrations.AlterField(
+            model_name='transactions',
+            name='transaction_with',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='transaction_with', to='api.users'),
+        ),
+        migrations.AddIndex(
+            model_name='transactions',
+            index=models.Index(fields=['transaction_from', 'transaction_status', 'transaction_amount'], name='trans_from_status_amount_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transactions',
+            index=models.Index(fields=['transaction_with', 'transaction_status', 'transaction_amount'], name='trans_with_status_amount_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transactions',
+            index=models.Index(fields=['transaction_from', 'transaction_date', 'id'], name='trans_from_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transactions',
+            index=models.Index(fields=['transaction_with', 'transaction_date', 'id'], name='trans_with_date_idx'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.0.3 on 2026-10-18 18:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_ledger_aggregates(apps, schema_editor):
+    Transactions = apps.get_model('api', 'Transactions')
+    LedgerAggregates = apps.get_model('api', 'LedgerAggregates')
+    db_alias = schema_editor.connection.alias
+
+    aggregates = {}
+    for party_field, side in (('transaction_from', 'lent'), ('transaction_with', 'borrowed')):
+        rows = Transactions.objects.using(db_alias).values(
+            party_field, 'transaction_status').annotate(
+                total=models.Sum('transaction_amount'), count=models.Count('id'))
+        for row in rows:
+            fields = aggregates.setdefault(row[party_field], {})
+            fields['{}_{}_total'.format(row['transaction_status'], side)] = row['total']
+            fields['{}_{}_count'.format(row['transaction_status'], side)] = row['count']
+
+    LedgerAggregates.objects.using(db_alias).bulk_create(
+        [LedgerAggregates(user_id=user_id, **fields) for user_id, fields in aggregates.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_transactions_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerAggregates',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='aggregates', serialize=False, to='api.users')),
+                ('paid_lent_total', models.FloatField(default=0.0)),
+                ('paid_lent_count', models.IntegerField(default=0)),
+                ('unpaid_lent_total', models.FloatField(default=0.0)),
+                ('unpaid_lent_count', models.IntegerField(default=0)),
+                ('paid_borrowed_total', models.FloatField(default=0.0)),
+                ('paid_borrowed_count', models.IntegerField(default=0)),
+                ('unpaid_borrowed_total', models.FloatField(default=0.0)),
+                ('unpaid_borrowed_count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(backfill_ledger_aggregates, migrations.RunPython.noop),
+    ]
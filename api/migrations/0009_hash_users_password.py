@@ -0,0 +1,32 @@
+# Generated by Django 4.0.3 on 2026-10-18 18:40
+
+from django.contrib.auth.hashers import identify_hasher, make_password
+from django.db import migrations, models
+
+
+def hash_plaintext_passwords(apps, schema_editor):
+    Users = apps.get_model('api', 'Users')
+    db_alias = schema_editor.connection.alias
+
+    for user in Users.objects.using(db_alias).only('id', 'password').iterator():
+        try:
+            identify_hasher(user.password)
+        except ValueError:
+            Users.objects.using(db_alias).filter(id=user.id).update(
+                password=make_password(user.password))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_ledgeraggregates'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='users',
+            name='password',
+            field=models.CharField(max_length=128),
+        ),
+        migrations.RunPython(hash_plaintext_passwords, migrations.RunPython.noop),
+    ]
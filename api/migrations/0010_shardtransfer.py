@@ -0,0 +1,24 @@
+# Generated by Django 4.2.16 on 2026-10-18 18:58
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_hash_users_password'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShardTransfer',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('target_shard', models.CharField(max_length=64)),
+                ('state', models.CharField(choices=[('pending', 'pending'), ('applied', 'applied')], default='pending', max_length=10)),
+                ('deltas', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 4.2.16 on 2026-10-18 19:09
+
+from django.db import migrations, models
+from django.db.models.functions import Round
+
+MINOR_UNITS = 100
+MONEY_FIELDS = (
+    ('Users', ('balance',)),
+    ('Transactions', ('transaction_amount',)),
+    ('LedgerAggregates', ('paid_lent_total', 'unpaid_lent_total', 'paid_borrowed_total', 'unpaid_borrowed_total')),
+)
+
+
+def to_minor_units(apps, schema_editor):
+    # Runs on the float columns, the rounded values are whole numbers the integer columns keep exactly
+    db_alias = schema_editor.connection.alias
+    for model_name, field_names in MONEY_FIELDS:
+        apps.get_model('api', model_name).objects.using(db_alias).update(**{
+            field_name: Round(models.F(field_name) * MINOR_UNITS) for field_name in field_names})
+
+
+def to_major_units(apps, schema_editor):
+    # Runs after the columns are floats again
+    db_alias = schema_editor.connection.alias
+    for model_name, field_names in MONEY_FIELDS:
+        apps.get_model('api', model_name).objects.using(db_alias).update(**{
+            field_name: models.F(field_name) / float(MINOR_UNITS) for field_name in field_names})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_shardtransfer'),
+    ]
+
+    operations = [
+        migrations.RunPython(to_minor_units, to_major_units),
+        migrations.AlterField(
+            model_name='ledgeraggregates',
+            name='paid_borrowed_total',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='ledgeraggregates',
+            name='paid_lent_total',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='ledgeraggregates',
+            name='unpaid_borrowed_total',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='ledgeraggregates',
+            name='unpaid_lent_total',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='transactions',
+            name='transaction_amount',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='users',
+            name='balance',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -4,13 +4,14 @@ import uuid
 
 
 class Users(models.Model):
-    '''Stores User data like name, username, password and current balance'''
+    '''Stores User data like name, username, hashed password and current balance'''
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=100)
     username = models.CharField(max_length=50, unique=True)
-    password = models.CharField(max_length=16)
-    balance = models.FloatField(default=0.0)
+    password = models.CharField(max_length=128)
+    # Money columns hold integer minor units (cents), see api.money
+    balance = models.BigIntegerField(default=0)
 
     def __str__(self):
         return "User {} has {} balance".format(self.name, self.balance)
@@ -29,12 +30,66 @@ class Transactions(models.Model):
     transaction_date = models.DateTimeField(default=datetime.now)
     transaction_status = models.CharField(
         max_length=25, choices=TRANSACTION_STATUS_CHOICES)
+    # Single column FK indexes are covered by the composite indexes in Meta
     transaction_from = models.ForeignKey(
-        Users, on_delete=models.CASCADE, related_name="transaction_from")
+        Users, on_delete=models.CASCADE, related_name="transaction_from", db_index=False)
     transaction_with = models.ForeignKey(
-        Users, on_delete=models.CASCADE, related_name="transaction_with")
-    transaction_amount = models.FloatField()
+        Users, on_delete=models.CASCADE, related_name="transaction_with", db_index=False)
+    transaction_amount = models.BigIntegerField()
     reason = models.CharField(max_length=100, null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # Paid/unpaid sums per lender and borrower, covered without table lookups
+            models.Index(fields=["transaction_from", "transaction_status", "transaction_amount"],
+                         name="trans_from_status_amount_idx"),
+            models.Index(fields=["transaction_with", "transaction_status", "transaction_amount"],
+                         name="trans_with_status_amount_idx"),
+            # Full history, pages and exports of lender and borrower ordered by (transaction_date, id)
+            models.Index(fields=["transaction_from", "transaction_date", "id"],
+                         name="trans_from_date_idx"),
+            models.Index(fields=["transaction_with", "transaction_date", "id"],
+                         name="trans_with_date_idx"),
+        ]
+
     def __str__(self):
         return "{} has paid {} amount to {}".format(self.transaction_from, self.transaction_amount, self.transaction_with)
+
+
+class LedgerAggregates(models.Model):
+    '''Stores running paid/unpaid lent and borrowed totals of a user, maintained on every ledger write'''
+
+    user = models.OneToOneField(
+        Users, primary_key=True, on_delete=models.CASCADE, related_name="aggregates")
+    paid_lent_total = models.BigIntegerField(default=0)
+    paid_lent_count = models.IntegerField(default=0)
+    unpaid_lent_total = models.BigIntegerField(default=0)
+    unpaid_lent_count = models.IntegerField(default=0)
+    paid_borrowed_total = models.BigIntegerField(default=0)
+    paid_borrowed_count = models.IntegerField(default=0)
+    unpaid_borrowed_total = models.BigIntegerField(default=0)
+    unpaid_borrowed_count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return "User {} has lent {} and borrowed {} paid amount".format(self.user_id, self.paid_lent_total, self.paid_borrowed_total)
+
+
+SHARD_TRANSFER_STATE_CHOICES = (
+    ("pending", "pending"),
+    ("applied", "applied")
+)
+
+
+class ShardTransfer(models.Model):
+    '''Stores balance and aggregate deltas of users homed on another shard, pending on the writing shard and applied on the target shard'''
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    target_shard = models.CharField(max_length=64)
+    state = models.CharField(
+        max_length=10, choices=SHARD_TRANSFER_STATE_CHOICES, default="pending")
+    # {"aggregates": {user_id: {field: delta}}, "balances": {user_id: delta}}
+    deltas = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "Transfer {} to {} is {}".format(self.id, self.target_shard, self.state)
@@ -0,0 +1,41 @@
+from decimal import Decimal, InvalidOperation
+
+# Money is stored as integer minor units, cents of the major unit the API speaks
+MINOR_UNITS = 100
+# Largest amount a BigIntegerField column holds
+MAX_MINOR_UNITS = 2 ** 63 - 1
+
+
+def to_minor_units(amount):
+    '''
+    Converts an API amount in major units to integer minor units
+
+    Floats are converted through their shortest repr, so 0.1 is 10 cents
+    instead of the binary fraction just below it.
+
+    Parameters:
+    amount (int/float/str/Decimal): Amount in major units
+
+    Returns:
+    Int: Amount in minor units, None if amount is not a finite number, is more precise than a minor
+    unit or does not fit a BigIntegerField
+
+    '''
+
+    if isinstance(amount, bool) or not isinstance(amount, (int, float, str, Decimal)):
+        return None
+    try:
+        value = Decimal(str(amount).strip()) * MINOR_UNITS
+    except InvalidOperation:
+        return None
+    if not value.is_finite() or value != value.to_integral_value() or abs(value) > MAX_MINOR_UNITS:
+        return None
+    return int(value)
+
+
+def to_major_units(amount: int):
+    '''Converts integer minor units to major units for API responses, blank amounts stay blank'''
+
+    if amount is None:
+        return None
+    return amount / MINOR_UNITS
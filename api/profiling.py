@@ -0,0 +1,112 @@
+import io
+import json
+import os
+import pstats
+import time
+import uuid
+
+from django.conf import settings
+
+PROFILE_STATS_LINES = 40
+
+
+class SQLRecorder:
+    '''DB execute wrapper keeping every statement of a profiled request with its time'''
+
+    def __init__(self):
+        self.statements = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start_time = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.statements.append(
+                {"sql": sql, "many": many, "seconds": time.perf_counter() - start_time})
+
+
+class ProfileStore:
+    '''
+    Bounded on-disk ring buffer of request profiles
+
+    Every profile is a JSON report next to the raw cProfile stats file, named
+    so that they sort by time. After each save only the newest max_entries
+    profiles are kept.
+
+    '''
+
+    def __init__(self, directory: str = None, max_entries: int = None):
+        self.directory = str(directory or getattr(
+            settings, "LEDGER_PROFILER_DIR", settings.BASE_DIR / "profiles"))
+        self.max_entries = max_entries or getattr(
+            settings, "LEDGER_PROFILER_MAX_ENTRIES", 100)
+
+    def save(self, report: dict, profiler):
+        '''
+        Stores report of a request with its profiler stats
+
+        Parameters:
+        report (dict): Request details like route, method, status, duration and SQL statements
+        profiler (cProfile.Profile): Disabled profiler of the request
+
+        Returns:
+        Str: Id of the stored profile
+
+        '''
+
+        os.makedirs(self.directory, exist_ok=True)
+        profile_id = "{:.6f}-{}".format(time.time(),
+                                        uuid.uuid4().hex[:8]).replace(".", "")
+
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats(
+            "cumulative").print_stats(PROFILE_STATS_LINES)
+        report = dict(report, id=profile_id, stats=stream.getvalue())
+
+        profiler.dump_stats(self.get_path(profile_id, "prof"))
+        # Report is written last and renamed into place, so listed profiles are complete
+        temp_path = self.get_path(profile_id, "json.tmp")
+        with open(temp_path, "w") as report_file:
+            json.dump(report, report_file)
+        os.replace(temp_path, self.get_path(profile_id, "json"))
+
+        self.prune()
+        return profile_id
+
+    def get_path(self, profile_id: str, extension: str):
+        return os.path.join(self.directory, "{}.{}".format(profile_id, extension))
+
+    def get_ids(self):
+        '''Returns ids of stored profiles, oldest first'''
+
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name[:-len(".json")] for name in os.listdir(self.directory)
+                      if name.endswith(".json"))
+
+    def get(self, profile_id: str):
+        '''Returns stored report of profile, None if it was pruned or never existed'''
+
+        try:
+            with open(self.get_path(profile_id, "json")) as report_file:
+                return json.load(report_file)
+        except (OSError, ValueError):
+            return None
+
+    def prune(self):
+        '''Deletes all but the newest max_entries profiles'''
+
+        profile_ids = self.get_ids()
+        for profile_id in profile_ids[:max(len(profile_ids) - self.max_entries, 0)]:
+            self.delete(profile_id)
+
+    def delete(self, profile_id: str):
+        for extension in ("json", "prof"):
+            try:
+                os.remove(self.get_path(profile_id, extension))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        for profile_id in self.get_ids():
+            self.delete(profile_id)
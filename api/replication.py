@@ -0,0 +1,85 @@
+import collections
+import time
+
+from django.db import transaction as db_transaction
+
+from .models import LedgerAggregates, Transactions, Users
+from .routers import PRIMARY_DATABASE
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Parents before children, so rows are inserted after the rows they reference
+REPLICATED_MODELS = (Users, Transactions, LedgerAggregates)
+
+
+class ReplicationLagSimulator:
+    '''
+    Copies the ledger tables from the primary to a replica, lag seconds behind
+
+    Stands in for database replication between two local SQLite files, for
+    small ledgers as every snapshot holds all rows in memory. Every
+    snapshot of the primary is applied to the replica as a whole once it is
+    lag seconds old, so the replica serves consistent but stale data.
+
+    '''
+
+    def __init__(self, replica: str, lag: float = 1.0, primary: str = PRIMARY_DATABASE):
+        self.replica = replica
+        self.lag = lag
+        self.primary = primary
+        self.pending = collections.deque()
+
+    def take_snapshot(self):
+        '''Returns rows of every replicated model on the primary'''
+
+        return {model: list(model.objects.using(self.primary).values_list(
+            *(field.attname for field in model._meta.concrete_fields)))
+            for model in REPLICATED_MODELS}
+
+    def apply_snapshot(self, snapshot: dict):
+        '''Replaces the replicated tables of the replica with snapshot in one transaction'''
+
+        with db_transaction.atomic(using=self.replica):
+            for model in reversed(REPLICATED_MODELS):
+                model.objects.using(self.replica).all().delete()
+            for model in REPLICATED_MODELS:
+                field_names = [
+                    field.attname for field in model._meta.concrete_fields]
+                model.objects.using(self.replica).bulk_create(
+                    [model(**dict(zip(field_names, row))) for row in snapshot[model]], batch_size=250)
+
+    def sync(self):
+        '''Brings the replica up to date at once'''
+
+        self.apply_snapshot(self.take_snapshot())
+
+    def tick(self, now: float = None):
+        '''
+        Takes a snapshot and applies the newest snapshot that is at least lag seconds old
+
+        Returns:
+        Bool: True if the replica was updated
+
+        '''
+
+        now = time.time() if now is None else now
+        self.pending.append((now, self.take_snapshot()))
+        due = None
+        while self.pending and self.pending[0][0] <= now - self.lag:
+            due = self.pending.popleft()[1]
+        if due is None:
+            return False
+        self.apply_snapshot(due)
+        return True
+
+    def run(self, interval: float = 0.5, iterations: int = None):
+        '''Ticks every interval seconds, forever unless iterations is given'''
+
+        logger.info("ReplicationLagSimulator - Run - Invoked - %s, lag %s",
+                    self.replica, self.lag)
+        count = 0
+        while iterations is None or count < iterations:
+            self.tick()
+            count += 1
+            time.sleep(interval)
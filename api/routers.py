@@ -0,0 +1,112 @@
+import contextvars
+import random
+from contextlib import contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+from .caching import normalize_user_id
+
+import logging
+logger = logging.getLogger(__name__)
+
+PRIMARY_DATABASE = "default"
+PIN_KEY = "ledger_primary_pin_{}"
+
+# Alias the ORM reads from while set, see read_from
+READ_DATABASE = contextvars.ContextVar("ledger_read_database", default=None)
+# Shard the ORM reads from and writes to while set, see on_shard
+SHARD_DATABASE = contextvars.ContextVar("ledger_shard_database", default=None)
+
+
+class LedgerRouter:
+    '''
+    Sends reads and writes of on_shard blocks to their shard, other writes to
+    the primary and the reads of read_from blocks to their database
+
+    Reads outside of read_from go to the primary too, so only the history and
+    credit score reads that opt in can see replication lag, never the reads
+    made while validating or applying a write. Transactions still need
+    atomic(using=shard), Django does not route them.
+
+    '''
+
+    def db_for_read(self, model, **hints):
+        return SHARD_DATABASE.get() or READ_DATABASE.get()
+
+    def db_for_write(self, model, **hints):
+        return SHARD_DATABASE.get() or PRIMARY_DATABASE
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+
+def get_read_database(user_ids: list):
+    '''
+    Returns alias to read ledger data of users from
+
+    Parameters:
+    user_ids (list): User ids from Users model
+
+    Returns:
+    Str: A random one of LEDGER_READ_REPLICAS, the primary if there are none
+    or any of the users wrote in the last LEDGER_READ_YOUR_WRITES_WINDOW seconds
+
+    '''
+
+    replicas = getattr(settings, "LEDGER_READ_REPLICAS", [])
+    if not replicas:
+        return PRIMARY_DATABASE
+    try:
+        pinned = cache.get_many([PIN_KEY.format(normalize_user_id(user_id))
+                                 for user_id in user_ids])
+    except Exception as e:
+        logger.error("GetReadDatabase - ERROR - Exception - %s", e)
+        return PRIMARY_DATABASE
+    return PRIMARY_DATABASE if pinned else random.choice(replicas)
+
+
+async def aget_read_database(user_ids: list):
+    '''Async get_read_database, the pin lookup runs in a worker thread'''
+
+    if not getattr(settings, "LEDGER_READ_REPLICAS", []):
+        return PRIMARY_DATABASE
+    return await sync_to_async(get_read_database, thread_sensitive=False)(user_ids)
+
+
+def pin_to_primary(user_ids: list):
+    '''Sends reads of users to the primary for LEDGER_READ_YOUR_WRITES_WINDOW seconds, called after their write commits'''
+
+    window = getattr(settings, "LEDGER_READ_YOUR_WRITES_WINDOW", 5)
+    if not getattr(settings, "LEDGER_READ_REPLICAS", []) or window <= 0:
+        return
+    try:
+        cache.set_many({PIN_KEY.format(normalize_user_id(user_id)): 1
+                        for user_id in user_ids}, window)
+    except Exception as e:
+        # The write is already committed, it must not fail because of the cache
+        logger.error("PinToPrimary - ERROR - Exception - %s", e)
+
+
+@contextmanager
+def read_from(alias: str):
+    '''Routes ORM reads of the block, including sync_to_async calls made from it, to alias'''
+
+    token = READ_DATABASE.set(alias)
+    try:
+        yield alias
+    finally:
+        READ_DATABASE.reset(token)
+
+
+@contextmanager
+def on_shard(alias: str):
+    '''Routes ORM reads and writes of the block, including sync_to_async calls made from it, to shard alias'''
+
+    token = SHARD_DATABASE.set(alias)
+    try:
+        yield alias
+    finally:
+        SHARD_DATABASE.reset(token)
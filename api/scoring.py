@@ -0,0 +1,83 @@
+from bisect import bisect_left
+from functools import lru_cache
+
+from django.conf import settings
+
+from .money import to_minor_units
+
+# (upper bound, score) tiers in major units, an amount gets the score of the first tier
+# whose inclusive upper bound it does not exceed, the None bound catches the rest
+BORROW_SCORE_TIERS = (
+    (100, 100), (200, 90), (300, 80), (400, 70), (500, 60),
+    (600, 50), (700, 40), (800, 30), (900, 20), (1000, 10), (None, 0),
+)
+LEND_SCORE_TIERS = (
+    (1000, 0), (1100, 10), (1200, 20), (1300, 30), (1400, 40), (1500, 50),
+    (1600, 60), (1700, 70), (1800, 80), (1900, 90), (2000, 100), (None, 100),
+)
+
+
+class ScoreTable:
+    '''
+    Maps amounts in minor units to scores with a binary search over tier upper bounds
+
+    Bounds are converted to minor units once, so scoring compares integers
+    and an amount a cent above a bound always falls in the next tier.
+
+    '''
+
+    def __init__(self, tiers):
+        tiers = tuple(tuple(tier) for tier in tiers)
+        if not tiers or tiers[-1][0] is not None:
+            raise ValueError("Last score tier should have None upper bound")
+        bounds = [to_minor_units(bound) for bound, _ in tiers[:-1]]
+        if None in bounds:
+            raise ValueError("Score tier upper bounds should be amounts with at most 2 decimal places")
+        if any(lower >= upper for lower, upper in zip(bounds, bounds[1:])):
+            raise ValueError("Score tier upper bounds should be increasing")
+
+        self.bounds = bounds
+        self.scores = [score for _, score in tiers]
+
+    def score(self, amount: int):
+        '''Returns score of amount in minor units, blank amount scores as 0'''
+
+        return self.scores[bisect_left(self.bounds, amount or 0)]
+
+    def score_many(self, amounts):
+        '''Returns scores of all amounts in one call'''
+
+        bounds, scores = self.bounds, self.scores
+        return [scores[bisect_left(bounds, amount or 0)] for amount in amounts]
+
+
+class CreditScoreEngine:
+    '''Credit score is the sum of the lend score of paid lent amount and the borrow score of paid borrowed amount'''
+
+    def __init__(self, lend_tiers=LEND_SCORE_TIERS, borrow_tiers=BORROW_SCORE_TIERS):
+        self.lend_table = ScoreTable(lend_tiers)
+        self.borrow_table = ScoreTable(borrow_tiers)
+
+    def score(self, lend_sum: int, borrow_sum: int):
+        '''Returns credit score of one user'''
+
+        return self.lend_table.score(lend_sum) + self.borrow_table.score(borrow_sum)
+
+    def score_many(self, lend_sums, borrow_sums):
+        '''Returns credit scores of many users from parallel sequences of paid lent and borrowed sums in minor units'''
+
+        return [lend_score + borrow_score for lend_score, borrow_score in zip(
+            self.lend_table.score_many(lend_sums), self.borrow_table.score_many(borrow_sums))]
+
+
+def get_credit_score_engine():
+    '''Returns engine for the LEDGER_LEND_SCORE_TIERS/LEDGER_BORROW_SCORE_TIERS settings'''
+
+    return _build_credit_score_engine(
+        tuple(map(tuple, getattr(settings, "LEDGER_LEND_SCORE_TIERS", LEND_SCORE_TIERS))),
+        tuple(map(tuple, getattr(settings, "LEDGER_BORROW_SCORE_TIERS", BORROW_SCORE_TIERS))))
+
+
+@lru_cache(maxsize=8)
+def _build_credit_score_engine(lend_tiers, borrow_tiers):
+    return CreditScoreEngine(lend_tiers, borrow_tiers)
@@ -0,0 +1,119 @@
+import bisect
+import functools
+import hashlib
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+
+from .routers import on_shard
+
+# Users referenced by transactions of another shard get a placeholder row there, for the foreign keys
+SHADOW_USERNAME = "shadow:{}"
+SHADOW_USERNAME_PREFIX = "shadow:"
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class HashRing:
+    '''
+    Consistent hash ring of shard aliases
+
+    Every shard owns vnodes points on the ring and a user belongs to the shard
+    of the first point after the hash of the user UUID, so adding or removing
+    a shard only moves the users of the affected arcs, about 1/N of them.
+
+    '''
+
+    def __init__(self, shards: list, vnodes: int = 64):
+        if not shards:
+            raise ValueError("At least one shard is needed")
+        points = sorted((self.hash("{}-{}".format(shard, index)), shard)
+                        for shard in shards for index in range(vnodes))
+        self.points = [point for point, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    @staticmethod
+    def hash(value: str):
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+    def get_shard(self, user_id):
+        '''Returns alias of the shard that is home of user'''
+
+        index = bisect.bisect(self.points, self.hash(
+            str(uuid.UUID(str(user_id))))) % len(self.points)
+        return self.shards[index]
+
+
+@functools.lru_cache(maxsize=8)
+def get_ring(shards: tuple, vnodes: int):
+    return HashRing(list(shards), vnodes)
+
+
+def get_shards():
+    '''Returns LEDGER_SHARDS, empty if the ledger is not sharded'''
+
+    return list(getattr(settings, "LEDGER_SHARDS", []))
+
+
+def is_sharded():
+    return bool(getattr(settings, "LEDGER_SHARDS", []))
+
+
+def get_shard(user_id):
+    '''Returns alias of the home shard of user'''
+
+    return get_ring(tuple(get_shards()), getattr(settings, "LEDGER_SHARD_VNODES", 64)).get_shard(user_id)
+
+
+def group_by_shard(user_ids):
+    '''Returns user ids grouped by home shard alias'''
+
+    groups = {}
+    for user_id in user_ids:
+        groups.setdefault(get_shard(user_id), []).append(user_id)
+    return groups
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=getattr(
+                settings, "LEDGER_SHARD_FANOUT_WORKERS", 8), thread_name_prefix="ledger-shard")
+        return _executor
+
+
+def run_on_shard(func, alias: str):
+    with on_shard(alias):
+        return func(alias)
+
+
+def run_in_worker(func, alias: str):
+    # Django only closes connections of request threads, pool threads close theirs after every task
+    try:
+        return run_on_shard(func, alias)
+    finally:
+        connections.close_all()
+
+
+def fan_out(func, aliases: list):
+    '''
+    Calls func(alias) on every shard concurrently, ORM calls of func go to its shard
+
+    Parameters:
+    func (callable): Reads from one shard, called with its alias
+    aliases (list): Shard aliases
+
+    Returns:
+    List: Results of func in the order of aliases
+
+    '''
+
+    aliases = list(aliases)
+    if len(aliases) <= 1:
+        return [run_on_shard(func, alias) for alias in aliases]
+    return list(get_executor().map(functools.partial(run_in_worker, func), aliases))
@@ -0,0 +1,22 @@
+from django.conf import settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    '''
+    Runs LEDGER_SQLITE_PRAGMAS on a new SQLite connection, receiver of connection_created
+
+    Pragmas go straight to the sqlite3 connection, so they are not counted as
+    queries of the request that happened to open the connection.
+
+    '''
+
+    if connection.vendor != "sqlite":
+        return
+    for name, value in getattr(settings, "LEDGER_SQLITE_PRAGMAS", {}).items():
+        result = connection.connection.execute(
+            "PRAGMA {} = {}".format(name, value)).fetchone()
+        logger.debug("ConfigureSqlite - %s - %s = %s - %s",
+                     connection.alias, name, value, result)
@@ -0,0 +1,118 @@
+import itertools
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from django.contrib.auth.hashers import make_password
+from django.db import transaction as db_transaction
+
+from .models import Transactions, Users
+from .money import MINOR_UNITS
+from .utils import BULK_BATCH_SIZE, AggregatesUtility, TransactionUtility
+
+import logging
+logger = logging.getLogger(__name__)
+
+SYNTHETIC_REASONS = ("food", "travel", "rent", "shopping", "bills", None)
+
+
+class SyntheticLedger:
+    '''
+    Generates a reproducible ledger of users and transactions
+
+    Counterparties are drawn from a power-law (Zipf-like) distribution, so a
+    few hot users take part in most transactions, as in production. The same
+    seed and username prefix always generate the same ids, amounts, statuses
+    and dates.
+
+    '''
+
+    def __init__(self, users: int, transactions: int, seed: int = 0, skew: float = 1.1,
+                 paid_ratio: float = 0.7, days: int = 365, start_date: datetime = None,
+                 username_prefix: str = "synthetic", password: str = "synthetic"):
+        self.users = users
+        self.transactions = transactions
+        self.seed = seed
+        self.skew = skew
+        self.paid_ratio = paid_ratio
+        self.days = days
+        self.start_date = start_date or datetime(
+            2022, 1, 1, tzinfo=timezone.utc)
+        self.username_prefix = username_prefix
+        self.password = password
+
+    def get_random(self):
+        '''Returns random generator of the ledger, the prefix is part of the seed so other prefixes get other ids'''
+
+        return random.Random("{}-{}".format(self.username_prefix, self.seed))
+
+    def new_uuid(self, rand: random.Random):
+        return uuid.UUID(int=rand.getrandbits(128), version=4)
+
+    def iter_users(self, rand: random.Random):
+        '''Yields unsaved Users, all sharing one password hash so generating stays cheap'''
+
+        password = make_password(self.password)
+        for index in range(self.users):
+            yield Users(id=self.new_uuid(rand), name="Synthetic {}".format(index),
+                        username="{}_{}".format(self.username_prefix, index), password=password)
+
+    def iter_transactions(self, rand: random.Random, user_ids: list):
+        '''Yields unsaved Transactions between power-law distributed users'''
+
+        cum_weights = list(itertools.accumulate(
+            1.0 / (rank + 1) ** self.skew for rank in range(len(user_ids))))
+        span_seconds = self.days * 24 * 60 * 60
+        for _ in range(self.transactions):
+            lender_id, borrower_id = rand.choices(
+                user_ids, cum_weights=cum_weights, k=2)
+            while borrower_id == lender_id:
+                borrower_id = rand.choices(
+                    user_ids, cum_weights=cum_weights)[0]
+            yield Transactions(
+                id=self.new_uuid(rand),
+                transaction_from_id=lender_id,
+                transaction_with_id=borrower_id,
+                transaction_amount=round(
+                    rand.lognormvariate(4, 1.2) * MINOR_UNITS) or MINOR_UNITS,
+                transaction_status="paid" if rand.random() < self.paid_ratio else "unpaid",
+                transaction_date=self.start_date +
+                timedelta(seconds=rand.randrange(span_seconds)),
+                reason=rand.choice(SYNTHETIC_REASONS))
+
+    def generate(self, batch_size: int = None):
+        '''
+        Bulk inserts the ledger, then recomputes balances and aggregates
+
+        Parameters:
+        batch_size (int): Rows per INSERT
+
+        Returns:
+        List: Ids of generated users, hottest first
+
+        '''
+
+        if self.users < 2:
+            raise ValueError("At least 2 users are needed for transactions")
+        batch_size = batch_size or BULK_BATCH_SIZE
+        rand = self.get_random()
+
+        logger.info("SyntheticLedger - Generate - Invoked - %s users, %s transactions",
+                    self.users, self.transactions)
+        with db_transaction.atomic():
+            users = Users.objects.bulk_create(
+                self.iter_users(rand), batch_size=batch_size)
+            user_ids = [user.id for user in users]
+
+            transactions = self.iter_transactions(rand, user_ids)
+            while True:
+                batch = list(itertools.islice(transactions, batch_size))
+                if not batch:
+                    break
+                Transactions.objects.bulk_create(batch)
+
+            TransactionUtility().recompute_balances()
+            AggregatesUtility().rebuild()
+
+        logger.info("SyntheticLedger - Generate - SUCCESS - Executed")
+        return user_ids
@@ -1,45 +1,95 @@
-from datetime import datetime
-from django.test import TestCase
-from api.models import Transactions, Users
-from api.utils import TransactionUtility, UsersUtility
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+import cProfile
+import csv
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from decimal import Decimal
+from unittest import mock, skipUnless
 
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import OperationalError, connection, connections
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.db.models import Q, Sum
+from asgiref.sync import async_to_sync, sync_to_async
+from django.http import HttpResponse
+from django.test import AsyncClient, AsyncRequestFactory, Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from api.caching import GENERATION_KEY, LOCAL_CACHE, CacheCounters, LedgerCache, LocalCache, RowCodec
+from api.middleware import LogContextMiddleware
+from api.log import LOG_DEBUG_SAMPLED, LOG_ROUTE, JsonFormatter, QueueLogHandler, RouteContextFilter, should_sample_debug
+from api.metrics import METRICS, Counter, Histogram
+from api.profiling import ProfileStore
+from api.replication import ReplicationLagSimulator
+from api.routers import PIN_KEY, get_read_database, read_from
+from api.synthetic import SyntheticLedger
+from api.models import LedgerAggregates, ShardTransfer, Transactions, Users
+from api.money import MINOR_UNITS, to_major_units, to_minor_units
+from api.scoring import CreditScoreEngine, ScoreTable
+from api.sharding import HashRing, fan_out, get_shard
+from api.utils import AggregatesUtility, ShardUtility, TokenUtility, TransactionUtility, UsersUtility
+from api.views import AsyncTransactionExportView, AsyncTransactionView, AsyncUserView
 
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
 class LedgerTestCases(TestCase):
     def setUp(self):
         jeff_user = Users.objects.create(
-            name="Jeff", username="jeff", password="jeff")
+            name="Jeff", username="jeff", password=make_password("jeff"))
         ali_user = Users.objects.create(
-            name="Ali", username="ali", password="ali")
+            name="Ali", username="ali", password=make_password("ali"))
         Users.objects.create(
-            name="Jafar", username="jafar", password="jafar")
-        Transactions.objects.create(transaction_from=jeff_user,
+            name="Jafar", username="jafar", password=make_password("jafar"))
+        # History rows of the same date are ordered by id, so the ids fix the expected order
+        Transactions.objects.create(id="1c2f6a4e-5b7d-4e21-9a3c-0d6e8f1b2a41",
+                                    transaction_from=jeff_user,
                                     transaction_with=ali_user,
-                                    transaction_amount=1500.0,
+                                    transaction_amount=150000,
                                     transaction_status="paid",
                                     transaction_date=TransactionUtility().get_datetime_obj(
                                         "2022-04-10"),
                                     reason="food")
-        Transactions.objects.create(transaction_from=ali_user,
+        Transactions.objects.create(id="5a8d3c7e-2f14-4b69-8e0a-7c3b9d1e4f52",
+                                    transaction_from=ali_user,
                                     transaction_with=jeff_user,
-                                    transaction_amount=600.0,
+                                    transaction_amount=60000,
                                     transaction_status="paid",
                                     transaction_date=TransactionUtility().get_datetime_obj(
                                         "2022-04-10"),
                                     reason="travel")
-        Transactions.objects.create(transaction_from=jeff_user,
+        Transactions.objects.create(id="9e4b1d6a-7c38-4f05-b2d7-3a6f0c8e5b63",
+                                    transaction_from=jeff_user,
                                     transaction_with=ali_user,
-                                    transaction_amount=300.0,
+                                    transaction_amount=30000,
                                     transaction_status="unpaid",
                                     transaction_date=TransactionUtility().get_datetime_obj(
                                         "2022-04-10"),
                                     reason="travel")
+        AggregatesUtility().rebuild()
 
     def test_login_success(self):
-        user = Users.objects.filter(username="jeff", password="jeff")
+        user = Users.objects.filter(username="jeff")
         actual = UsersUtility().login("jeff", "jeff")
+        self.assertEqual(TokenUtility().verify_token(
+            actual.pop("token")), str(user[0].id))
         expected = {
             "name": user[0].name,
-            "balance": user[0].balance,
+            "balance": to_major_units(user[0].balance),
             "user_id": str(user[0].id),
             "code": 200
         }
@@ -50,6 +100,186 @@ class LedgerTestCases(TestCase):
         expected = {"message": "Wrong username or password!", "code": 401}
         self.assertEqual(actual, expected)
 
+    def test_login_failure_wrong_password(self):
+        actual = UsersUtility().login("jeff", "ali")
+        expected = {"message": "Wrong username or password!", "code": 401}
+        self.assertEqual(actual, expected)
+
+    def test_password_is_stored_hashed(self):
+        self.assertNotIn("jeff", Users.objects.get(username="jeff").password)
+
+    def test_token_verification(self):
+        token = UsersUtility().login("jeff", "jeff")["token"]
+        self.assertIsNone(TokenUtility().verify_token(token[:-1] + ("A" if token[-1] != "A" else "B")))
+        self.assertIsNone(TokenUtility().verify_token(""))
+        with override_settings(LEDGER_TOKEN_MAX_AGE=-1):
+            self.assertIsNone(TokenUtility().verify_token(token))
+
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(TokenUtility().verify_token(token))
+
+    def test_views_require_token(self):
+        jeff_user = Users.objects.get(username="jeff")
+        body = json.dumps({"user_id": str(jeff_user.id)})
+
+        response = Client().generic(
+            "GET", "/api/credit_score", body, content_type="application/json")
+        self.assertEqual(response.status_code, 401)
+        response = Client().generic("GET", "/api/credit_score", body, content_type="application/json",
+                                    HTTP_AUTHORIZATION="Bearer invalid")
+        self.assertEqual(response.status_code, 401)
+
+        response = Client().post("/api/login", json.dumps(
+            {"username": "jeff", "password": "jeff"}), content_type="application/json")
+        token = response.json()["token"]
+        response = Client().generic("GET", "/api/credit_score", body, content_type="application/json",
+                                    HTTP_AUTHORIZATION="Bearer {}".format(token))
+        self.assertEqual(response.json(), {"credit_score": 100})
+
+    def test_views_reject_other_users(self):
+        jeff_user = Users.objects.get(username="jeff")
+        ali_user = Users.objects.get(username="ali")
+        jafar_user = Users.objects.get(username="jafar")
+        client = Client()
+        authorization = "Bearer {}".format(TokenUtility().issue_token(jeff_user.id))
+
+        def request(method, path, body):
+            return client.generic(method, path, json.dumps(body), content_type="application/json",
+                                  HTTP_AUTHORIZATION=authorization)
+
+        transaction = {"transaction_from": str(ali_user.id), "transaction_with": str(jafar_user.id),
+                       "transaction_amount": 10.0, "transaction_type": "lend", "transaction_status": "unpaid",
+                       "transaction_date": "2022-04-11"}
+        other_transaction = Transactions.objects.create(
+            transaction_from=ali_user, transaction_with=jafar_user, transaction_amount=1000,
+            transaction_status="unpaid", transaction_date=TransactionUtility().get_datetime_obj("2022-04-10"))
+        count = Transactions.objects.count()
+
+        for method, path, body in (
+                ("GET", "/api/credit_score", {"user_id": str(ali_user.id)}),
+                ("GET", "/api/get_transactions", {"user_id": str(ali_user.id)}),
+                ("GET", "/api/get_transactions", {"user_id": str(ali_user.id), "page_size": 10}),
+                ("GET", "/api/export_transactions", {"user_id": str(ali_user.id)}),
+                ("POST", "/api/add_transaction", transaction),
+                ("POST", "/api/add_transactions", {"transactions": [
+                    dict(transaction, transaction_from=str(jeff_user.id)), transaction]}),
+                ("PATCH", "/api/mark_paid", {"transaction_id": str(other_transaction.id)})):
+            with self.subTest(method=method, path=path):
+                self.assertEqual(request(method, path, body).status_code, 403)
+        self.assertEqual(Transactions.objects.count(), count)
+        self.assertEqual(Transactions.objects.get(id=other_transaction.id).transaction_status, "unpaid")
+
+        # The token user may be either party, in any UUID spelling
+        self.assertEqual(request("GET", "/api/credit_score", {
+            "user_id": str(jeff_user.id).upper()}).status_code, 200)
+        self.assertEqual(request("POST", "/api/add_transaction", dict(
+            transaction, transaction_with=str(jeff_user.id))).status_code, 200)
+        unpaid = Transactions.objects.get(transaction_from=ali_user, transaction_status="unpaid",
+                                          transaction_with=jeff_user)
+        self.assertEqual(request("PATCH", "/api/mark_paid", {
+            "transaction_id": str(unpaid.id)}).status_code, 200)
+
+    def test_metrics_endpoint(self):
+        METRICS.reset()
+        jeff_user = Users.objects.get(username="jeff")
+        Client().generic("GET", "/api/get_transactions", json.dumps({"user_id": str(jeff_user.id)}),
+                         content_type="application/json",
+                         HTTP_AUTHORIZATION="Bearer {}".format(TokenUtility().issue_token(jeff_user.id)))
+
+        response = Client().get("/metrics")
+
+        self.assertEqual(response.status_code, 200)
+        metrics = response.content.decode()
+        self.assertIn(
+            'ledger_request_duration_seconds_count{endpoint="api/get_transactions",method="GET"} 1', metrics)
+        self.assertIn(
+            'ledger_request_db_queries_bucket{endpoint="api/get_transactions",method="GET",le="2"} 1', metrics)
+        self.assertIn(
+            'ledger_responses_total{endpoint="api/get_transactions",method="GET",status="200"} 1', metrics)
+        self.assertIn(
+            'ledger_cache_requests_total{family="trans_history",tier="remote",result="miss"} 1', metrics)
+
+    def test_profiler_records_allow_listed_requests(self):
+        jeff_user = Users.objects.get(username="jeff")
+        body = json.dumps({"user_id": str(jeff_user.id)})
+        authorization = "Bearer {}".format(
+            TokenUtility().issue_token(jeff_user.id))
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+                LEDGER_PROFILER_ENABLED=True, LEDGER_PROFILER_TOKENS=["secret"], LEDGER_PROFILER_DIR=directory):
+            client = Client()
+            response = client.generic("GET", "/api/credit_score", body, content_type="application/json",
+                                      HTTP_AUTHORIZATION=authorization)
+            self.assertNotIn("X-Ledger-Profile-Id", response)
+            response = client.generic("GET", "/api/credit_score", body, content_type="application/json",
+                                      HTTP_AUTHORIZATION=authorization, HTTP_X_LEDGER_PROFILE="wrong")
+            self.assertNotIn("X-Ledger-Profile-Id", response)
+
+            response = client.generic("GET", "/api/credit_score", body, content_type="application/json",
+                                      HTTP_AUTHORIZATION=authorization, HTTP_X_LEDGER_PROFILE="secret")
+
+            profile_id = response["X-Ledger-Profile-Id"]
+            report = ProfileStore().get(profile_id)
+            self.assertEqual(report["route"], "api/credit_score")
+            self.assertEqual(len(report["sql"]), 1)
+            self.assertIn("get_credit_score", report["stats"])
+
+            out = StringIO()
+            call_command("show_profiles", stdout=out)
+            self.assertIn(profile_id, out.getvalue())
+            out = StringIO()
+            call_command("show_profiles", profile_id, stdout=out)
+            self.assertIn("api_ledgeraggregates", out.getvalue())
+
+    @override_settings(DEBUG=True, LEDGER_PROFILER_ENABLED=True)
+    def test_asgi_handler_adapts_no_middleware(self):
+        # With DEBUG Django logs every middleware it has to wrap with sync_to_async or async_to_sync
+        with self.assertNoLogs("django.request", "DEBUG"):
+            ASGIHandler()
+
+    async def test_profiler_records_async_requests(self):
+        jeff_user = await Users.objects.aget(username="jeff")
+        body = json.dumps({"user_id": str(jeff_user.id)})
+        authorization = "Bearer {}".format(
+            TokenUtility().issue_token(jeff_user.id))
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+                LEDGER_PROFILER_ENABLED=True, LEDGER_PROFILER_TOKENS=["secret"], LEDGER_PROFILER_DIR=directory):
+            client = AsyncClient()
+            response = await client.generic("GET", "/api/credit_score", body, content_type="application/json",
+                                            headers={"Authorization": authorization})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn("X-Ledger-Profile-Id", response)
+
+            response = await client.generic("GET", "/api/credit_score", body, content_type="application/json",
+                                            headers={"Authorization": authorization, "X-Ledger-Profile": "secret"})
+
+            report = ProfileStore().get(response["X-Ledger-Profile-Id"])
+            self.assertEqual(report["route"], "api/credit_score")
+            self.assertEqual(len(report["sql"]), 1)
+
+    def test_synthetic_ledger(self):
+        count = Transactions.objects.count()
+        ledger = SyntheticLedger(20, 500, seed=1, username_prefix="synth")
+
+        user_ids = ledger.generate()
+
+        self.assertEqual(Transactions.objects.count(), count + 500)
+        activity = [Transactions.objects.filter(Q(transaction_from=user_id) | Q(
+            transaction_with=user_id)).count() for user_id in user_ids]
+        self.assertGreater(activity[0], activity[-1] * 3)
+        self.assertEqual(AggregatesUtility().verify(), [])
+        self.assertEqual(UsersUtility().login(
+            "synth_0", "synthetic")["user_id"], str(user_ids[0]))
+
+        # Same seed and prefix generate the same rows
+        rand = ledger.get_random()
+        self.assertEqual([user.id for user in ledger.iter_users(rand)], user_ids)
+        rows = sorted((transaction.id, transaction.transaction_amount, transaction.transaction_status)
+                      for transaction in ledger.iter_transactions(rand, user_ids))
+        self.assertEqual(rows, list(Transactions.objects.filter(id__in=[row[0] for row in rows]).order_by(
+            "id").values_list("id", "transaction_amount", "transaction_status")))
+
     def test_login_blank(self):
         actual = UsersUtility().login("", "")
         expected = {"message": "Wrong username or password!", "code": 401}
@@ -61,17 +291,53 @@ class LedgerTestCases(TestCase):
         expected = {"credit_score": 100, "code": 200}
         self.assertEqual(actual, expected)
 
+    def test_get_credit_score_single_query(self):
+        user = Users.objects.get(username="jeff")
+        with self.assertNumQueries(1):
+            actual = UsersUtility().get_credit_score(str(user.id))
+        self.assertEqual(actual, {"credit_score": 100, "code": 200})
+
+    def test_get_credit_score_without_transactions(self):
+        user = Users.objects.get(username="jafar")
+        actual = UsersUtility().get_credit_score(str(user.id))
+        self.assertEqual(actual, {"credit_score": 100, "code": 200})
+
+    def test_get_credit_scores_success(self):
+        user_ids = [str(user_id) for user_id in Users.objects.order_by(
+            "username").values_list("id", flat=True)]
+
+        with self.assertNumQueries(1):
+            actual = UsersUtility().get_credit_scores(
+                user_ids + ["64bf6cc4-0ed9-4e52-a450-605574334641"])
+
+        expected = {
+            "credit_scores": {
+                user_id: UsersUtility().get_credit_score(user_id)["credit_score"] for user_id in user_ids},
+            "code": 200
+        }
+        expected["credit_scores"]["64bf6cc4-0ed9-4e52-a450-605574334641"] = 100
+        self.assertEqual(actual, expected)
+
+    def test_get_credit_scores_failure(self):
+        actual = UsersUtility().get_credit_scores([])
+        self.assertEqual(
+            actual, {"message": "Please provide user ids", "code": 400})
+
+        actual = UsersUtility().get_credit_scores(["jeff"])
+        self.assertEqual(
+            actual, {"message": "Please provide valid user ids", "code": 400})
+
     def test_get_credit_score_failure(self):
         actual = UsersUtility().get_credit_score("")
         expected = {"message": "Please provide user id", "code": 400}
         self.assertEqual(actual, expected)
 
     def test_calculate_lend_score(self):
-        actual = UsersUtility().calculate_lend_score(1500.0)
+        actual = UsersUtility().calculate_lend_score(150000)
         self.assertEqual(actual, 50)
 
     def test_calculate_borrow_score(self):
-        actual = UsersUtility().calculate_borrow_score(600.0)
+        actual = UsersUtility().calculate_borrow_score(60000)
         self.assertEqual(actual, 50)
 
     def test_get_transactions_by_user_id_success(self):
@@ -129,6 +395,146 @@ class LedgerTestCases(TestCase):
             "message": "There is no transactions for given user id", "code": 404}
         self.assertEqual(actual, expected)
 
+    def test_get_transactions_by_user_id_query_count(self):
+        jeff_user = Users.objects.get(username="jeff")
+        cache.clear()
+
+        # One projection query per direction, each read in order from its (party, date, id) index.
+        # A single OR query would have to sort the whole history
+        with self.assertNumQueries(2):
+            actual = TransactionUtility(
+            ).get_transactions_by_user_id(str(jeff_user.id))
+
+        transactions = Transactions.objects.filter(
+            transaction_from=jeff_user).order_by("transaction_date", "id")
+        expected = [{
+            "transaction_id": str(transaction.id),
+            "transaction_date": transaction.transaction_date.strftime("%Y-%m-%d"),
+            "transaction_from": str(transaction.transaction_from_id),
+            "transaction_with": str(transaction.transaction_with_id),
+            "transaction_status": transaction.transaction_status,
+            "transaction_amount": to_major_units(transaction.transaction_amount),
+            "transaction_type": "lend",
+            "reason": transaction.reason
+        } for transaction in transactions]
+        transactions = Transactions.objects.filter(
+            transaction_with=jeff_user).order_by("transaction_date", "id")
+        expected += [{
+            "transaction_id": str(transaction.id),
+            "transaction_date": transaction.transaction_date.strftime("%Y-%m-%d"),
+            "transaction_from": str(transaction.transaction_with_id),
+            "transaction_with": str(transaction.transaction_from_id),
+            "transaction_status": transaction.transaction_status,
+            "transaction_amount": to_major_units(transaction.transaction_amount),
+            "transaction_type": "borrow",
+            "reason": transaction.reason
+        } for transaction in transactions]
+        self.assertEqual(json.dumps(actual["transactions"]), json.dumps(expected))
+
+    def test_get_transactions_page_walks_all_pages(self):
+        jeff_user = Users.objects.get(username="jeff")
+        expected = sorted(Transactions.objects.filter(
+            Q(transaction_from=jeff_user) | Q(transaction_with=jeff_user)),
+            key=lambda transaction: (transaction.transaction_date, transaction.id.hex))
+
+        transaction_ids = []
+        cursor = None
+        while True:
+            with self.assertNumQueries(2):
+                actual = TransactionUtility().get_transactions_page(
+                    str(jeff_user.id), page_size=1, cursor=cursor)
+            self.assertEqual(actual["code"], 200)
+            transaction_ids += [transaction["transaction_id"]
+                                for transaction in actual["transactions"]]
+            cursor = actual["next_cursor"]
+            if not cursor:
+                break
+
+        self.assertEqual(
+            transaction_ids, [str(transaction.id) for transaction in expected])
+
+    def test_get_transactions_page_filters(self):
+        jeff_user = Users.objects.get(username="jeff")
+        ali_user = Users.objects.get(username="ali")
+        jafar_user = Users.objects.get(username="jafar")
+
+        actual = TransactionUtility().get_transactions_page(
+            str(jeff_user.id), direction="borrow")
+        self.assertEqual([(transaction["transaction_type"], transaction["transaction_amount"])
+                          for transaction in actual["transactions"]], [("borrow", 600.0)])
+        self.assertIsNone(actual["next_cursor"])
+
+        actual = TransactionUtility().get_transactions_page(
+            str(jeff_user.id), transaction_status="unpaid", counterparty=str(ali_user.id))
+        self.assertEqual([transaction["transaction_amount"]
+                          for transaction in actual["transactions"]], [300.0])
+
+        actual = TransactionUtility().get_transactions_page(
+            str(jeff_user.id), counterparty=str(jafar_user.id))
+        self.assertEqual(actual["transactions"], [])
+
+        actual = TransactionUtility().get_transactions_page(
+            str(jeff_user.id), date_from="2022-04-10", date_to="2022-04-10")
+        self.assertEqual(len(actual["transactions"]), 3)
+
+        actual = TransactionUtility().get_transactions_page(
+            str(jeff_user.id), date_to="2022-04-09")
+        self.assertEqual(actual["transactions"], [])
+
+    def test_get_transactions_page_failure_invalid_parameters(self):
+        jeff_user = Users.objects.get(username="jeff")
+
+        actual = TransactionUtility().get_transactions_page(
+            str(jeff_user.id), cursor="not-a-cursor")
+        self.assertEqual(
+            actual, {"message": "Please provide valid cursor", "code": 400})
+
+        actual = TransactionUtility().get_transactions_page(
+            str(jeff_user.id), direction="gift")
+        self.assertEqual(
+            actual, {"message": "Please provide valid direction (lend/borrow)", "code": 400})
+
+        actual = TransactionUtility().get_transactions_page(
+            str(jeff_user.id), page_size=0)
+        self.assertEqual(actual["code"], 400)
+
+    def test_export_transactions_ndjson(self):
+        jeff_user = Users.objects.get(username="jeff")
+
+        actual = TransactionUtility().export_transactions_by_user_id(
+            str(jeff_user.id), "ndjson")
+        self.assertEqual(actual["content_type"], "application/x-ndjson")
+
+        exported = [json.loads(line)
+                    for line in "".join(actual["lines"]).splitlines()]
+        history = TransactionUtility().get_transactions_by_user_id(
+            str(jeff_user.id))["transactions"]
+        self.assertEqual(sorted(exported, key=lambda x: x["transaction_id"]),
+                         sorted(history, key=lambda x: x["transaction_id"]))
+
+    def test_export_transactions_csv_view(self):
+        jeff_user = Users.objects.get(username="jeff")
+
+        response = Client().generic("GET", "/api/export_transactions", json.dumps(
+            {"user_id": str(jeff_user.id), "format": "csv"}), content_type="application/json",
+            HTTP_AUTHORIZATION="Bearer {}".format(TokenUtility().issue_token(jeff_user.id)))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        rows = list(csv.DictReader(StringIO(
+            b"".join(response.streaming_content).decode())))
+        self.assertEqual([(row["transaction_type"], row["transaction_amount"]) for row in rows
+                          if row["transaction_type"] == "borrow"], [("borrow", "600.0")])
+        self.assertEqual(len(rows), 3)
+
+    def test_export_transactions_failure_invalid_format(self):
+        jeff_user = Users.objects.get(username="jeff")
+        actual = TransactionUtility().export_transactions_by_user_id(
+            str(jeff_user.id), "xml")
+        expected = {
+            "message": "Please provide valid format (ndjson/csv)", "code": 400}
+        self.assertEqual(actual, expected)
+
     def test_format_datetime(self):
         actual = TransactionUtility().format_datetime(datetime.now())
         expected = datetime.now().strftime("%Y-%m-%d")
@@ -153,8 +559,8 @@ class LedgerTestCases(TestCase):
         new_jeff_balance = jeff_user[0].balance
         new_ali_balance = ali_user[0].balance
 
-        self.assertEqual(jeff_balance - 400.0, new_jeff_balance)
-        self.assertEqual(ali_balance + 400.0, new_ali_balance)
+        self.assertEqual(jeff_balance - 40000, new_jeff_balance)
+        self.assertEqual(ali_balance + 40000, new_ali_balance)
 
         transaction_id = actual["message"].split(" - ")[1]
         expected = {
@@ -179,6 +585,17 @@ class LedgerTestCases(TestCase):
             "message": "Transaction With User does not exist", "code": 404}
         self.assertEqual(actual, expected)
 
+    def test_add_transaction_failure_same_user_spelled_differently(self):
+        jeff_user = Users.objects.get(username="jeff")
+        count = Transactions.objects.count()
+
+        actual = TransactionUtility().add_transaction(
+            str(jeff_user.id), str(jeff_user.id).upper(), 400.0, "lend", "paid", "2022-04-10", "food")
+
+        expected = {"message": "The transaction can not be placed between the same users", "code": 400}
+        self.assertEqual(actual, expected)
+        self.assertEqual(Transactions.objects.count(), count)
+
     def test_mark_transaction_paid_success(self):
         transaction = Transactions.objects.filter(transaction_status="unpaid")
         transaction_id = str(transaction[0].id)
@@ -188,6 +605,413 @@ class LedgerTestCases(TestCase):
             "message": "Transaction successfully updated - {}".format(transaction_id), "code": 200}
         self.assertEqual(actual, expected)
 
+    def test_add_transaction_updates_aggregates(self):
+        jeff_user = Users.objects.get(username="jeff")
+        jafar_user = Users.objects.get(username="jafar")
+
+        TransactionUtility().add_transaction(str(jeff_user.id), str(
+            jafar_user.id), 400.0, "borrow", "unpaid", "2022-04-10", "food")
+
+        aggregates = LedgerAggregates.objects.get(user=jafar_user)
+        self.assertEqual(aggregates.unpaid_lent_total, 40000)
+        self.assertEqual(aggregates.unpaid_lent_count, 1)
+        aggregates = LedgerAggregates.objects.get(user=jeff_user)
+        self.assertEqual(aggregates.unpaid_borrowed_total, 40000)
+        self.assertEqual(aggregates.paid_borrowed_total, 60000)
+        self.assertEqual(AggregatesUtility().verify(), [])
+
+    def test_mark_transaction_paid_updates_aggregates(self):
+        jeff_user = Users.objects.get(username="jeff")
+        transaction = Transactions.objects.get(transaction_status="unpaid")
+
+        TransactionUtility().mark_transaction_paid(str(transaction.id))
+        TransactionUtility().mark_transaction_paid(str(transaction.id))
+
+        aggregates = LedgerAggregates.objects.get(user=jeff_user)
+        self.assertEqual(aggregates.paid_lent_total, 180000)
+        self.assertEqual(aggregates.paid_lent_count, 2)
+        self.assertEqual(aggregates.unpaid_lent_total, 0)
+        self.assertEqual(aggregates.unpaid_lent_count, 0)
+        self.assertEqual(Users.objects.get(id=jeff_user.id).balance, -30000)
+        self.assertEqual(AggregatesUtility().verify(), [])
+
+    def get_uncached_history(self, user_id):
+        return TransactionUtility().serialize_history_rows(
+            user_id, [row[:-1] for queryset in TransactionUtility().get_history_querysets(user_id) for row in queryset])
+
+    def test_add_transaction_writes_through_cache(self):
+        jeff_id = str(Users.objects.get(username="jeff").id)
+        ali_id = str(Users.objects.get(username="ali").id)
+        for user_id in (jeff_id, ali_id):
+            TransactionUtility().get_transactions_by_user_id(user_id)
+        TransactionUtility().get_lend_transactions_by_user_id(jeff_id, "Test")
+        before = TransactionUtility().get_transactions_by_user_id(jeff_id)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            TransactionUtility().add_transaction(
+                jeff_id, ali_id, 250.0, "lend", "unpaid", "2022-04-09", "rent")
+        # Nothing is published before commit
+        self.assertEqual(
+            TransactionUtility().get_transactions_by_user_id(jeff_id), before)
+
+        for callback in callbacks:
+            callback()
+
+        with self.assertNumQueries(0):
+            jeff_history = TransactionUtility().get_transactions_by_user_id(jeff_id)
+            ali_history = TransactionUtility().get_transactions_by_user_id(ali_id)
+            lend = TransactionUtility().get_lend_transactions_by_user_id(jeff_id, "Test")
+        self.assertEqual(jeff_history["transactions"],
+                         self.get_uncached_history(jeff_id))
+        self.assertEqual(ali_history["transactions"],
+                         self.get_uncached_history(ali_id))
+        self.assertEqual(sorted(transaction.transaction_amount for transaction in lend), [
+                         25000, 30000, 150000])
+
+    def test_mark_transaction_paid_writes_through_cache(self):
+        jeff_id = str(Users.objects.get(username="jeff").id)
+        ali_id = str(Users.objects.get(username="ali").id)
+        transaction = Transactions.objects.get(transaction_status="unpaid")
+        for user_id in (jeff_id, ali_id):
+            TransactionUtility().get_transactions_by_user_id(user_id)
+        TransactionUtility().get_borrow_transactions_by_user_id(ali_id, "Test")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            TransactionUtility().mark_transaction_paid(str(transaction.id))
+
+        with self.assertNumQueries(0):
+            jeff_history = TransactionUtility().get_transactions_by_user_id(jeff_id)
+            ali_history = TransactionUtility().get_transactions_by_user_id(ali_id)
+            borrow = TransactionUtility().get_borrow_transactions_by_user_id(ali_id, "Test")
+        self.assertEqual(jeff_history["transactions"],
+                         self.get_uncached_history(jeff_id))
+        self.assertEqual(ali_history["transactions"],
+                         self.get_uncached_history(ali_id))
+        self.assertEqual({transaction.transaction_status for transaction in borrow}, {"paid"})
+
+    @override_settings(LEDGER_CACHE_WRITE_THROUGH=False)
+    def test_add_transaction_without_write_through_invalidates_cache(self):
+        jeff_id = str(Users.objects.get(username="jeff").id)
+        ali_id = str(Users.objects.get(username="ali").id)
+        TransactionUtility().get_transactions_by_user_id(jeff_id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            TransactionUtility().add_transaction(
+                jeff_id, ali_id, 250.0, "lend", "unpaid", "2022-04-09", "rent")
+
+        with self.assertNumQueries(2):
+            actual = TransactionUtility().get_transactions_by_user_id(jeff_id)
+        self.assertEqual(actual["transactions"],
+                         self.get_uncached_history(jeff_id))
+
+    @override_settings(LEDGER_CACHE_WRITE_THROUGH_MAX_USERS=1)
+    def test_bulk_write_invalidates_cache(self):
+        jeff_id = str(Users.objects.get(username="jeff").id)
+        ali_id = str(Users.objects.get(username="ali").id)
+        TransactionUtility().get_transactions_by_user_id(jeff_id)
+
+        with mock.patch.object(LedgerCache, "update_entries_many") as update_entries_many:
+            with self.captureOnCommitCallbacks(execute=True):
+                TransactionUtility().add_transaction(
+                    jeff_id, ali_id, 250.0, "lend", "unpaid", "2022-04-09", "rent")
+        update_entries_many.assert_not_called()
+
+        with self.assertNumQueries(2):
+            actual = TransactionUtility().get_transactions_by_user_id(jeff_id)
+        self.assertEqual(actual["transactions"],
+                         self.get_uncached_history(jeff_id))
+
+    def test_rebuild_ledger_aggregates_command(self):
+        jeff_user = Users.objects.get(username="jeff")
+        LedgerAggregates.objects.filter(
+            user=jeff_user).update(paid_lent_total=100)
+
+        with self.assertRaises(CommandError):
+            call_command("rebuild_ledger_aggregates",
+                         "--verify-only", stdout=StringIO())
+
+        call_command("rebuild_ledger_aggregates", stdout=StringIO())
+        self.assertEqual(LedgerAggregates.objects.get(
+            user=jeff_user).paid_lent_total, 150000)
+
+    def test_add_transactions_success(self):
+        jeff_user = Users.objects.get(username="jeff")
+        ali_user = Users.objects.get(username="ali")
+        jafar_user = Users.objects.get(username="jafar")
+        count = Transactions.objects.count()
+
+        actual = TransactionUtility().add_transactions([
+            {"transaction_from": str(jeff_user.id), "transaction_with": str(ali_user.id), "transaction_amount": 100.0,
+             "transaction_type": "lend", "transaction_status": "paid", "transaction_date": "2022-04-11", "reason": "food"},
+            {"transaction_from": str(jeff_user.id), "transaction_with": str(jafar_user.id), "transaction_amount": 50.0,
+             "transaction_type": "borrow", "transaction_status": "paid", "transaction_date": "2022-04-11", "reason": "rent"},
+            {"transaction_from": str(ali_user.id), "transaction_with": str(jafar_user.id), "transaction_amount": 25.0,
+             "transaction_type": "lend", "transaction_status": "unpaid", "transaction_date": "2022-04-11", "reason": "gift"},
+        ])
+
+        self.assertEqual(actual["code"], 200)
+        self.assertEqual([result["code"]
+                          for result in actual["results"]], [200, 200, 200])
+        self.assertEqual(Transactions.objects.count(), count + 3)
+        self.assertEqual(Users.objects.get(id=jeff_user.id).balance, -5000)
+        self.assertEqual(Users.objects.get(id=ali_user.id).balance, 10000)
+        self.assertEqual(Users.objects.get(id=jafar_user.id).balance, -5000)
+        self.assertEqual(AggregatesUtility().verify(), [])
+
+    def test_add_transactions_query_count_does_not_grow_with_batch(self):
+        jeff_user = Users.objects.get(username="jeff")
+        ali_user = Users.objects.get(username="ali")
+        item = {"transaction_from": str(jeff_user.id), "transaction_with": str(ali_user.id), "transaction_amount": 10.0,
+                "transaction_type": "lend", "transaction_status": "paid", "transaction_date": "2022-04-11"}
+
+        with CaptureQueriesContext(connection) as small_batch:
+            TransactionUtility().add_transactions([item] * 2)
+        with CaptureQueriesContext(connection) as large_batch:
+            TransactionUtility().add_transactions([item] * 100)
+
+        self.assertEqual(len(small_batch), len(large_batch))
+        self.assertEqual(Users.objects.get(id=jeff_user.id).balance, -102000)
+
+    def test_add_transactions_failure_invalid_transaction(self):
+        jeff_user = Users.objects.get(username="jeff")
+        ali_user = Users.objects.get(username="ali")
+        count = Transactions.objects.count()
+
+        actual = TransactionUtility().add_transactions([
+            {"transaction_from": str(jeff_user.id), "transaction_with": str(ali_user.id), "transaction_amount": 100.0,
+             "transaction_type": "lend", "transaction_status": "paid"},
+            {"transaction_from": str(jeff_user.id), "transaction_with": "64bf6cc4-0ed9-4e52-a450-605574334641",
+             "transaction_amount": 100.0, "transaction_type": "lend", "transaction_status": "paid"},
+            {"transaction_from": str(jeff_user.id), "transaction_with": str(ali_user.id), "transaction_amount": -1,
+             "transaction_type": "lend", "transaction_status": "paid"},
+        ])
+
+        self.assertEqual(actual["code"], 400)
+        self.assertEqual(actual["results"], [
+            {"message": "Transaction is valid", "code": 200},
+            {"message": "Transaction With User does not exist", "code": 404},
+            {"message": "Please provide postive non-zero transaction amount", "code": 400},
+        ])
+        self.assertEqual(Transactions.objects.count(), count)
+
+    def test_add_transaction_failure_sub_cent_amount(self):
+        jeff_user = Users.objects.get(username="jeff")
+        ali_user = Users.objects.get(username="ali")
+        count = Transactions.objects.count()
+
+        actual = TransactionUtility().add_transaction(
+            str(jeff_user.id), str(ali_user.id), 10.001, "lend", "paid", "2022-04-11", "food")
+
+        expected = {"message": "Please provide transaction amount with at most 2 decimal places", "code": 400}
+        self.assertEqual(actual, expected)
+        self.assertEqual(Transactions.objects.count(), count)
+
+    def test_add_transaction_amounts_are_exact(self):
+        jeff_user = Users.objects.get(username="jeff")
+        ali_user = Users.objects.get(username="ali")
+        jeff_balance = jeff_user.balance
+        ali_balance = ali_user.balance
+
+        for _ in range(10):
+            TransactionUtility().add_transaction(
+                str(jeff_user.id), str(ali_user.id), 0.1, "lend", "paid", "2022-04-11", "food")
+
+        # Ten floats of 0.1 sum to 0.9999999999999999, ten cents sum to 1
+        self.assertEqual(Users.objects.get(id=jeff_user.id).balance, jeff_balance - MINOR_UNITS)
+        self.assertEqual(Users.objects.get(id=ali_user.id).balance, ali_balance + MINOR_UNITS)
+        self.assertEqual(AggregatesUtility().verify(), [])
+
+    def test_add_transactions_failure_blank_parameter(self):
+        actual = TransactionUtility().add_transactions([])
+        expected = {"message": "Please provide transactions", "code": 400}
+        self.assertEqual(actual, expected)
+
+    def test_import_ledger_command(self):
+        jeff_user = Users.objects.get(username="jeff")
+        ali_user = Users.objects.get(username="ali")
+        jafar_user = Users.objects.get(username="jafar")
+        count = Transactions.objects.count()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "ledger.csv")
+            with open(path, "w", newline="") as source:
+                writer = csv.writer(source)
+                writer.writerow(["transaction_from", "transaction_with", "transaction_amount",
+                                 "transaction_status", "transaction_date", "reason"])
+                writer.writerow([jeff_user.id, jafar_user.id,
+                                 "10", "paid", "2020-01-01", "food"])
+                writer.writerow([jeff_user.id, "64bf6cc4-0ed9-4e52-a450-605574334641",
+                                 "10", "paid", "2020-01-01", "food"])
+                writer.writerow([jafar_user.id.hex, ali_user.id,
+                                 "5.5", "unpaid", "2020-01-02", ""])
+                writer.writerow([ali_user.id, jeff_user.id,
+                                 "20", "paid", "2020-01-03", "rent"])
+
+            call_command("import_ledger", path,
+                         "--batch-size", "2", stdout=StringIO(), stderr=StringIO())
+            self.assertEqual(Transactions.objects.count(), count + 3)
+            with open(path + ".checkpoint") as checkpoint_file:
+                self.assertEqual(json.load(checkpoint_file), {
+                                 "rows": 4, "imported": 3, "rejected": 1})
+
+            # Rows after the checkpoint only, already imported rows are skipped
+            call_command("import_ledger", path, stdout=StringIO())
+            self.assertEqual(Transactions.objects.count(), count + 3)
+
+            # Replaying the whole file does not duplicate transactions and reports no imports
+            call_command("import_ledger", path, "--restart",
+                         stdout=StringIO(), stderr=StringIO())
+            self.assertEqual(Transactions.objects.count(), count + 3)
+            with open(path + ".checkpoint") as checkpoint_file:
+                self.assertEqual(json.load(checkpoint_file), {
+                                 "rows": 4, "imported": 0, "rejected": 1})
+
+        # Balances are recomputed from all paid transactions, including the setUp ones
+        self.assertEqual(Users.objects.get(
+            id=jeff_user.id).balance, -150000 + 60000 - 1000 + 2000)
+        self.assertEqual(Users.objects.get(id=jafar_user.id).balance, 1000)
+        self.assertEqual(AggregatesUtility().verify(), [])
+
+    def test_import_ledger_rejects_malformed_ndjson_lines(self):
+        jeff_user = Users.objects.get(username="jeff")
+        jafar_user = Users.objects.get(username="jafar")
+        count = Transactions.objects.count()
+        row = {"transaction_from": str(jeff_user.id), "transaction_with": str(jafar_user.id),
+               "transaction_amount": "10", "transaction_status": "paid", "transaction_date": "2020-01-01"}
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "ledger.ndjson")
+            with open(path, "w") as source:
+                source.write(json.dumps(row) + "\n")
+                source.write('{"transaction_from": \n')
+                source.write("[1, 2]\n")
+                source.write(json.dumps(dict(row, transaction_amount="20")) + "\n")
+
+            call_command("import_ledger", path,
+                         stdout=StringIO(), stderr=StringIO())
+            with open(path + ".checkpoint") as checkpoint_file:
+                self.assertEqual(json.load(checkpoint_file), {
+                                 "rows": 4, "imported": 2, "rejected": 2})
+        self.assertEqual(Transactions.objects.count(), count + 2)
+
+    async def test_async_login(self):
+        user = await Users.objects.aget(username="jeff")
+        actual = await UsersUtility().alogin("jeff", "jeff")
+        self.assertEqual(TokenUtility().verify_token(
+            actual.pop("token")), str(user.id))
+        self.assertEqual(actual, {"name": user.name, "balance": to_major_units(user.balance),
+                                  "user_id": str(user.id), "code": 200})
+
+        expected = {"message": "Wrong username or password!", "code": 401}
+        self.assertEqual(await UsersUtility().alogin("jeff", "ali"), expected)
+        self.assertEqual(await UsersUtility().alogin("jeff1", "jeff1"), expected)
+
+    async def test_async_reads_match_sync_reads(self):
+        user_id = str((await Users.objects.aget(username="jeff")).id)
+
+        self.assertEqual(await UsersUtility().aget_credit_score(user_id),
+                         await sync_to_async(UsersUtility().get_credit_score)(user_id))
+        expected = await sync_to_async(TransactionUtility().get_transactions_by_user_id)(user_id)
+        # Cached by the sync read above, then computed with the async ORM
+        self.assertEqual(await TransactionUtility().aget_transactions_by_user_id(user_id), expected)
+        cache.clear()
+        LOCAL_CACHE.clear()
+        self.assertEqual(await TransactionUtility().aget_transactions_by_user_id(user_id), expected)
+        self.assertEqual(await TransactionUtility().aget_transactions_by_user_id(str(uuid.uuid4())),
+                         {"message": "There is no transactions for given user id", "code": 404})
+
+    async def test_async_views(self):
+        factory = AsyncRequestFactory()
+        jeff_user = await Users.objects.aget(username="jeff")
+        ali_user = await Users.objects.aget(username="ali")
+
+        response = await AsyncUserView.as_view()(factory.post(
+            "/api/login", json.dumps({"username": "jeff", "password": "jeff"}), content_type="application/json"))
+        self.assertEqual(response.status_code, 200)
+        headers = {"Authorization": "Bearer {}".format(
+            json.loads(response.content)["token"])}
+        body = json.dumps({"user_id": str(jeff_user.id)})
+
+        response = await AsyncUserView.as_view()(factory.generic(
+            "GET", "/api/credit_score", body, content_type="application/json"))
+        self.assertEqual(response.status_code, 401)
+        response = await AsyncTransactionView.as_view()(factory.generic(
+            "GET", "/api/get_transactions", body, content_type="application/json"))
+        self.assertEqual(response.status_code, 401)
+
+        response = await AsyncUserView.as_view()(factory.generic(
+            "GET", "/api/credit_score", body, content_type="application/json", headers=headers))
+        self.assertEqual(json.loads(response.content), {"credit_score": 100})
+
+        other_body = json.dumps({"user_id": str(ali_user.id)})
+        response = await AsyncUserView.as_view()(factory.generic(
+            "GET", "/api/credit_score", other_body, content_type="application/json", headers=headers))
+        self.assertEqual(response.status_code, 403)
+        response = await AsyncTransactionView.as_view()(factory.generic(
+            "GET", "/api/get_transactions", other_body, content_type="application/json", headers=headers))
+        self.assertEqual(response.status_code, 403)
+        response = await AsyncTransactionExportView.as_view()(factory.generic(
+            "GET", "/api/export_transactions", other_body, content_type="application/json", headers=headers))
+        self.assertEqual(response.status_code, 403)
+
+        response = await AsyncTransactionView.as_view()(factory.post("/api/add_transaction", json.dumps({
+            "transaction_from": str(jeff_user.id), "transaction_with": str(ali_user.id), "transaction_amount": 50.0,
+            "transaction_type": "lend", "transaction_status": "unpaid", "transaction_date": "2022-04-11"
+        }), content_type="application/json", headers=headers))
+        self.assertEqual(response.status_code, 200)
+
+        response = await AsyncTransactionView.as_view()(factory.generic(
+            "GET", "/api/get_transactions", body, content_type="application/json", headers=headers))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)["transactions"]), 4)
+
+        response = await AsyncTransactionView.as_view()(factory.generic(
+            "GET", "/api/get_transactions", json.dumps({"user_id": str(jeff_user.id), "page_size": 1}),
+            content_type="application/json", headers=headers))
+        self.assertEqual(len(json.loads(response.content)["transactions"]), 1)
+
+    async def test_async_export_streams_one_chunk_at_a_time(self):
+        jeff_user = await Users.objects.aget(username="jeff")
+        body = json.dumps({"user_id": str(jeff_user.id)})
+        fetched = []
+        iter_export_chunks = TransactionUtility.iter_export_chunks
+
+        def recording_iter_export_chunks(utility, *args):
+            for chunk in iter_export_chunks(utility, *args):
+                fetched.append(chunk)
+                yield chunk
+
+        response = await AsyncTransactionExportView.as_view()(AsyncRequestFactory().generic(
+            "GET", "/api/export_transactions", body, content_type="application/json"))
+        self.assertEqual(response.status_code, 401)
+
+        chunks = []
+        with mock.patch.object(TransactionUtility, "iter_export_chunks", recording_iter_export_chunks), \
+                override_settings(LEDGER_EXPORT_CHUNK_SIZE=1):
+            response = await AsyncTransactionExportView.as_view()(AsyncRequestFactory().generic(
+                "GET", "/api/export_transactions", body, content_type="application/json",
+                headers={"Authorization": "Bearer {}".format(TokenUtility().issue_token(jeff_user.id))}))
+            self.assertTrue(response.is_async)
+            async for chunk in response:
+                # Only the chunk being sent has been read from the DB
+                self.assertEqual(len(fetched), len(chunks) + 1)
+                chunks.append(chunk)
+
+        self.assertEqual(sorted(json.loads(chunk)["transaction_amount"] for chunk in chunks),
+                         [300.0, 600.0, 1500.0])
+
+    async def test_async_middleware(self):
+        METRICS.reset()
+        jeff_user = await Users.objects.aget(username="jeff")
+
+        response = await self.async_client.generic(
+            "GET", "/api/credit_score", json.dumps({"user_id": str(jeff_user.id)}), content_type="application/json",
+            AUTHORIZATION="Bearer {}".format(TokenUtility().issue_token(jeff_user.id)))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('ledger_request_db_queries_bucket{endpoint="api/credit_score",method="GET",le="1"} 1',
+                      METRICS.render())
+
     def test_mark_transaction_paid_failure_blank_parameter(self):
         actual = TransactionUtility().mark_transaction_paid("")
 
@@ -201,3 +1025,1089 @@ class LedgerTestCases(TestCase):
         expected = {
             "message": "Given transaction id does not exists", "code": 404}
         self.assertEqual(actual, expected)
+
+
+class HistoryBaselineTestCases(TestCase):
+    '''
+    Transaction history responses compared byte for byte with api/history_baseline.json
+
+    The fixture holds the responses of the original two-query implementation
+    for the ledger below, inserted out of date and id order, with the rows of
+    each direction ordered by (transaction_date, id).
+
+    '''
+
+    USERS = [
+        ("4bc1e57f-07ab-4bc7-ad9b-3e3a50f3325e", "Jeff", "jeff"),
+        ("324368a0-a76a-40ec-9bd5-e3ef68f630ca", "Ali", "ali"),
+        ("f92699e3-13b1-4430-a817-d15cecc2dcee", "Jafar", "jafar"),
+        ("fe1b0669-f408-430f-97c1-4a61fd86d82f", "Zara", "zara"),
+    ]
+    # (id, lender, borrower, amount, status, date, reason) in insertion order
+    TRANSACTIONS = [
+        ("bf65da97-fb81-4f1d-9832-ffb8a6585da4", "jeff", "ali", 1500.0, "paid", "2022-04-10", "food"),
+        ("688c3891-0579-4511-9070-e6013c8e9f5c", "ali", "jeff", 600.0, "paid", "2022-04-10", "travel"),
+        ("4f4036f3-4a3b-4b24-b72b-75baf2e2a6af", "jeff", "ali", 300.0, "unpaid", "2022-04-10", "travel"),
+        ("857041e4-4e7f-4c0e-92ac-d1a28dfc214e", "jeff", "jafar", 19.99, "unpaid", "2022-03-01", None),
+        ("432ca2f2-a304-4b77-b21a-a1e741158d3c", "jafar", "jeff", 0.1, "paid", "2022-05-20", "coffee"),
+        ("033997ac-e87c-4498-a31f-798e02b8ec9e", "jeff", "ali", 2.5, "paid", "2021-12-31", "snacks"),
+        ("4a6f787b-08c5-43d4-a78e-51841696aaa7", "ali", "jeff", 1234.56, "unpaid", "2022-04-10", "rent"),
+        ("6bb345e1-7674-4bf9-b489-c1c5f29e3733", "jafar", "ali", 75.0, "paid", "2022-04-11", "books"),
+        ("8fca3c20-3c0c-4db2-962a-0d8b5a028205", "jeff", "jafar", 0.01, "paid", "2022-04-10", ""),
+        ("6ec45978-2d50-48e6-bfcf-7c0a2a953601", "ali", "jafar", 99.95, "unpaid", "2022-01-15", "gift \u00e9"),
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        users = {username: Users.objects.create(id=user_id, name=name, username=username,
+                                                password=make_password(username))
+                 for user_id, name, username in cls.USERS}
+        for transaction_id, lender, borrower, amount, status, date, reason in cls.TRANSACTIONS:
+            Transactions.objects.create(
+                id=transaction_id, transaction_from=users[lender], transaction_with=users[borrower],
+                transaction_amount=to_minor_units(amount), transaction_status=status, reason=reason,
+                transaction_date=TransactionUtility().get_datetime_obj(date))
+
+    def setUp(self):
+        cache.clear()
+        LOCAL_CACHE.clear()
+
+    def test_history_matches_baseline_responses(self):
+        with open(os.path.join(os.path.dirname(__file__), "history_baseline.json")) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        # Cold cache first, then the cached rows
+        for attempt in ("cold", "cached"):
+            for user_id, _, _ in self.USERS:
+                with self.subTest(attempt=attempt, user_id=user_id):
+                    response = Client().generic(
+                        "GET", "/api/get_transactions", json.dumps({"user_id": user_id}),
+                        content_type="application/json",
+                        HTTP_AUTHORIZATION="Bearer {}".format(TokenUtility().issue_token(user_id)))
+                    self.assertEqual(response.status_code, baseline[user_id]["status"])
+                    self.assertEqual(response.content.decode(), baseline[user_id]["body"])
+
+
+class QueryPlanTestCases(TestCase):
+    '''Guards hot Transactions queries against falling back to full table scans'''
+
+    def setUp(self):
+        self.jeff_user = Users.objects.create(
+            name="Jeff", username="jeff", password="jeff")
+        self.ali_user = Users.objects.create(
+            name="Ali", username="ali", password="ali")
+        Transactions.objects.create(transaction_from=self.jeff_user,
+                                    transaction_with=self.ali_user,
+                                    transaction_amount=150000,
+                                    transaction_status="paid",
+                                    transaction_date=TransactionUtility().get_datetime_obj(
+                                        "2022-04-10"),
+                                    reason="food")
+        cache.clear()
+
+    def get_query_plans(self, func):
+        '''Runs func and returns EXPLAIN QUERY PLAN details of every Transactions query it executed'''
+
+        with CaptureQueriesContext(connection) as context:
+            func()
+
+        plans = []
+        with connection.cursor() as cursor:
+            for query in context.captured_queries:
+                if "api_transactions" not in query["sql"]:
+                    continue
+                cursor.execute("EXPLAIN QUERY PLAN {}".format(query["sql"]))
+                plans.append([row[-1] for row in cursor.fetchall()])
+        self.assertTrue(plans)
+        return plans
+
+    def assertIndexedPlan(self, plan, index_names):
+        for detail in plan:
+            self.assertFalse(detail.startswith("SCAN api_transactions"),
+                             "Full scan in query plan: {}".format(plan))
+            self.assertNotIn("TEMP B-TREE", detail,
+                             "Sort in query plan: {}".format(plan))
+        for index_name in index_names:
+            self.assertTrue(any(index_name in detail for detail in plan),
+                            "{} not used in query plan: {}".format(index_name, plan))
+
+    def test_paid_sums_use_covering_indexes(self):
+        for field, index_name in (("transaction_from", "trans_from_status_amount_idx"),
+                                  ("transaction_with", "trans_with_status_amount_idx")):
+            plans = self.get_query_plans(lambda: Transactions.objects.filter(
+                **{field: self.jeff_user.id, "transaction_status": "paid"}
+            ).aggregate(Sum("transaction_amount")))
+            self.assertIndexedPlan(plans[0], [index_name])
+            self.assertTrue(any("COVERING INDEX" in detail for detail in plans[0]))
+
+    def test_history_uses_indexes(self):
+        plans = self.get_query_plans(
+            lambda: TransactionUtility().get_transactions_by_user_id(str(self.jeff_user.id)))
+        self.assertEqual(len(plans), 2)
+        self.assertIndexedPlan(plans[0], ["trans_from_date_idx"])
+        self.assertIndexedPlan(plans[1], ["trans_with_date_idx"])
+
+    def test_history_page_uses_date_ordered_indexes(self):
+        plans = self.get_query_plans(
+            lambda: TransactionUtility().get_transactions_page(str(self.jeff_user.id)))
+        self.assertEqual(len(plans), 2)
+        self.assertIndexedPlan(plans[0], ["trans_from_date_idx"])
+        self.assertIndexedPlan(plans[1], ["trans_with_date_idx"])
+
+
+class ConcurrentTransferTestCases(TransactionTestCase):
+    '''Fires transfers from many threads and checks that no balance update is lost'''
+
+    THREADS = 4
+    TRANSFERS_PER_THREAD = 500
+
+    def setUp(self):
+        self.user_ids = [str(Users.objects.create(
+            name="User {}".format(index), username="user{}".format(index), password="user").id)
+            for index in range(4)]
+
+    def transfer(self, seed: int, completed: list):
+        rand = random.Random(seed)
+        try:
+            for _ in range(self.TRANSFERS_PER_THREAD):
+                transaction_from, transaction_with = rand.sample(self.user_ids, 2)
+                amount = round(rand.uniform(0.01, 100), 2)
+                status = rand.choice(("paid", "unpaid"))
+                # SQLite allows one writer at a time, retry until the transfer lands
+                while True:
+                    try:
+                        result = TransactionUtility().add_transaction(
+                            transaction_from, transaction_with, amount, "lend", status, "2022-04-10", "stress")
+                        if result["code"] == 200:
+                            break
+                    except OperationalError:
+                        pass
+                    time.sleep(0.001)
+                completed.append(
+                    (transaction_from, transaction_with, amount, status))
+        finally:
+            connection.close()
+
+    def test_concurrent_transfers_keep_balances_consistent(self):
+        completed = []
+        threads = [threading.Thread(target=self.transfer, args=(seed, completed))
+                   for seed in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(completed), self.THREADS *
+                         self.TRANSFERS_PER_THREAD)
+
+        expected = dict.fromkeys(self.user_ids, 0)
+        for transaction_from, transaction_with, amount, status in completed:
+            if status == "paid":
+                expected[transaction_from] -= to_minor_units(amount)
+                expected[transaction_with] += to_minor_units(amount)
+
+        balances = {str(user_id): balance for user_id,
+                    balance in Users.objects.values_list("id", "balance")}
+        self.assertEqual(balances, expected)
+        self.assertEqual(sum(balances.values()), 0)
+        self.assertEqual(AggregatesUtility().verify(), [])
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+@override_settings(LEDGER_READ_REPLICAS=["replica"], LEDGER_READ_YOUR_WRITES_WINDOW=60)
+@skipUnless("replica" in settings.DATABASES, "No replica alias, run with --settings=ledger.settings_test")
+class ReadReplicaTestCases(TestCase):
+    '''History and credit score reads of a local SQLite replica kept behind the primary by ReplicationLagSimulator'''
+
+    # The runner sets up the aliases of skipped classes too, so only defined ones are listed
+    databases = {"default", "replica"} & set(settings.DATABASES)
+
+    def setUp(self):
+        self.jeff_user = Users.objects.create(
+            name="Jeff", username="jeff", password="jeff")
+        self.ali_user = Users.objects.create(
+            name="Ali", username="ali", password="ali")
+        self.jafar_user = Users.objects.create(
+            name="Jafar", username="jafar", password="jafar")
+        self.create_transaction(self.jeff_user, self.ali_user)
+        AggregatesUtility().rebuild()
+        ReplicationLagSimulator("replica").sync()
+        cache.clear()
+        LOCAL_CACHE.clear()
+
+    def create_transaction(self, lender, borrower):
+        return Transactions.objects.create(transaction_from=lender, transaction_with=borrower,
+                                           transaction_amount=150000, transaction_status="paid",
+                                           transaction_date=TransactionUtility().get_datetime_obj("2022-04-10"))
+
+    def get_history_length(self, user):
+        return len(TransactionUtility().get_transactions_by_user_id(str(user.id))["transactions"])
+
+    def test_reads_are_served_by_replica(self):
+        self.create_transaction(self.jeff_user, self.jafar_user)
+
+        self.assertEqual(Transactions.objects.count(), 2)
+        self.assertEqual(Transactions.objects.using("replica").count(), 1)
+        self.assertEqual(self.get_history_length(self.jeff_user), 1)
+        page = TransactionUtility().get_transactions_page(str(self.jeff_user.id), 10)
+        self.assertEqual(len(page["transactions"]), 1)
+
+        ReplicationLagSimulator("replica").sync()
+        cache.clear()
+        LOCAL_CACHE.clear()
+        self.assertEqual(self.get_history_length(self.jeff_user), 2)
+
+    def test_writers_read_their_writes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = TransactionUtility().add_transaction(
+                str(self.jeff_user.id), str(self.ali_user.id), 50.0, "lend", "unpaid", "2022-04-11", "food")
+        self.assertEqual(response["code"], 200)
+
+        self.assertEqual(Transactions.objects.using("replica").count(), 1)
+        self.assertEqual(get_read_database([self.jeff_user.id]), "default")
+        self.assertEqual(get_read_database([self.ali_user.id]), "default")
+        self.assertEqual(get_read_database([self.jafar_user.id]), "replica")
+        self.assertEqual(self.get_history_length(self.ali_user), 2)
+        self.assertEqual(len(async_to_sync(TransactionUtility().aget_transactions_by_user_id)(
+            str(self.jeff_user.id))["transactions"]), 2)
+
+        # Once the window is over the replica serves them again
+        cache.delete(PIN_KEY.format(self.jeff_user.id))
+        self.assertEqual(get_read_database([self.jeff_user.id]), "replica")
+
+    def test_writes_go_to_primary(self):
+        with read_from("replica"):
+            Users.objects.create(name="Bob", username="bob", password="bob")
+
+        self.assertTrue(Users.objects.filter(username="bob").exists())
+        self.assertFalse(Users.objects.using(
+            "replica").filter(username="bob").exists())
+
+    def test_replication_lag(self):
+        simulator = ReplicationLagSimulator("replica", lag=5.0)
+        self.create_transaction(self.jeff_user, self.jafar_user)
+        self.assertFalse(simulator.tick(now=100.0))
+        self.create_transaction(self.ali_user, self.jafar_user)
+
+        self.assertTrue(simulator.tick(now=105.0))
+        self.assertEqual(Transactions.objects.using("replica").count(), 2)
+        self.assertEqual(Transactions.objects.count(), 3)
+
+    @override_settings(LEDGER_READ_REPLICAS=[])
+    def test_reads_go_to_primary_without_replicas(self):
+        self.create_transaction(self.jeff_user, self.jafar_user)
+        self.assertEqual(get_read_database([self.jafar_user.id]), "default")
+        self.assertEqual(self.get_history_length(self.jeff_user), 2)
+
+
+SHARDS = ["default"] + sorted(alias for alias in settings.DATABASES if alias.startswith("shard_"))
+
+
+@override_settings(LEDGER_SHARDS=SHARDS)
+@skipUnless(len(SHARDS) > 1, "No shard aliases, run with --settings=ledger.settings_test")
+class ShardingTestCases(TransactionTestCase):
+    '''Ledger sharded by user over default and the local SQLite shards, read concurrently by worker threads'''
+
+    databases = set(SHARDS)
+
+    def setUp(self):
+        cache.clear()
+        LOCAL_CACHE.clear()
+        self.jeff_user = self.create_user("jeff")
+        self.ali_user = self.create_user("ali")
+        # Borrowers homed on another shard than the lender
+        self.remote_user = self.create_user(
+            "remote", lambda shard: shard != get_shard(self.jeff_user.id))
+        self.local_user = self.create_user(
+            "local", lambda shard: shard == get_shard(self.jeff_user.id))
+
+    def create_user(self, username, accept_shard=lambda shard: True):
+        user_id = uuid.uuid4()
+        while not accept_shard(get_shard(user_id)):
+            user_id = uuid.uuid4()
+        return Users.objects.using(get_shard(user_id)).create(
+            id=user_id, name=username.capitalize(), username=username, password=make_password(username))
+
+    def add_transaction(self, lender, borrower, amount, status, date="2022-04-10"):
+        response = TransactionUtility().add_transaction(
+            str(lender.id), str(borrower.id), amount, "lend", status, date, "food")
+        self.assertEqual(response["code"], 200)
+        return response["message"].rsplit(" ", 1)[-1]
+
+    def get_balance(self, user):
+        return to_major_units(Users.objects.using(get_shard(user.id)).get(id=user.id).balance)
+
+    def get_aggregates(self, user):
+        return LedgerAggregates.objects.using(get_shard(user.id)).get(user_id=user.id)
+
+    def test_hash_ring_moves_few_users(self):
+        user_ids = [uuid.uuid4() for _ in range(2000)]
+        ring = HashRing(["shard_a", "shard_b", "shard_c"])
+        grown_ring = HashRing(["shard_a", "shard_b", "shard_c", "shard_d"])
+
+        self.assertEqual([ring.get_shard(user_id) for user_id in user_ids],
+                         [HashRing(["shard_c", "shard_a", "shard_b"]).get_shard(user_id) for user_id in user_ids])
+        moved = [user_id for user_id in user_ids if ring.get_shard(
+            user_id) != grown_ring.get_shard(user_id)]
+        self.assertTrue(all(grown_ring.get_shard(user_id) == "shard_d" for user_id in moved))
+        self.assertLess(abs(len(moved) / len(user_ids) - 0.25), 0.1)
+
+    def test_login_finds_user_on_any_shard(self):
+        for user in (self.jeff_user, self.remote_user):
+            response = UsersUtility().login(user.username, user.username)
+            self.assertEqual(response["code"], 200)
+            self.assertEqual(response["user_id"], str(user.id))
+        self.assertEqual(async_to_sync(UsersUtility().alogin)(
+            "remote", "remote")["user_id"], str(self.remote_user.id))
+        self.assertEqual(UsersUtility().login("nobody", "nobody")["code"], 401)
+
+    def test_cross_shard_transaction(self):
+        transaction_id = self.add_transaction(self.jeff_user, self.remote_user, 1500.0, "paid")
+        lender_shard, borrower_shard = get_shard(self.jeff_user.id), get_shard(self.remote_user.id)
+
+        self.assertTrue(Transactions.objects.using(lender_shard).filter(id=transaction_id).exists())
+        self.assertFalse(Transactions.objects.using(borrower_shard).filter(id=transaction_id).exists())
+        self.assertEqual(self.get_balance(self.jeff_user), -1500.0)
+        self.assertEqual(self.get_balance(self.remote_user), 1500.0)
+        self.assertEqual(self.get_aggregates(self.jeff_user).paid_lent_total, 150000)
+        self.assertEqual(self.get_aggregates(self.remote_user).paid_borrowed_total, 150000)
+        # Transfers are applied and only their markers are left
+        self.assertFalse(ShardTransfer.objects.using(lender_shard).exists())
+        self.assertEqual(list(ShardTransfer.objects.using(
+            borrower_shard).values_list("state", flat=True)), ["applied"])
+
+        lender_score = UsersUtility().calculate_lend_score(
+            150000) + UsersUtility().calculate_borrow_score(0)
+        borrower_score = UsersUtility().calculate_lend_score(
+            0) + UsersUtility().calculate_borrow_score(150000)
+        self.assertEqual(UsersUtility().get_credit_score(
+            str(self.remote_user.id))["credit_score"], borrower_score)
+        self.assertEqual(UsersUtility().get_credit_scores(
+            [str(self.jeff_user.id), str(self.remote_user.id)])["credit_scores"],
+            {str(self.jeff_user.id): lender_score, str(self.remote_user.id): borrower_score})
+        self.assertEqual(
+            UsersUtility().login("remote", "remote")["balance"], 1500.0)
+
+    def test_batch_writes_each_lender_shard(self):
+        response = TransactionUtility().add_transactions([
+            {"transaction_from": str(lender.id), "transaction_with": str(borrower.id), "transaction_amount": 100.0,
+             "transaction_type": "lend", "transaction_status": "paid", "transaction_date": "2022-04-10"}
+            for lender, borrower in ((self.jeff_user, self.remote_user), (self.remote_user, self.ali_user),
+                                     (self.jeff_user, self.local_user))])
+        self.assertEqual(response["code"], 200)
+
+        self.assertEqual(sum(Transactions.objects.using(alias).count() for alias in SHARDS), 3)
+        self.assertEqual(self.get_balance(self.jeff_user), -200.0)
+        self.assertEqual(self.get_balance(self.remote_user), 0.0)
+        self.assertEqual(self.get_balance(self.ali_user), 100.0)
+        self.assertEqual(self.get_balance(self.local_user), 100.0)
+        self.assertEqual(self.get_aggregates(self.remote_user).paid_lent_count, 1)
+        self.assertEqual(self.get_aggregates(self.remote_user).paid_borrowed_count, 1)
+
+    def test_history_is_merged_across_shards(self):
+        self.add_transaction(self.jeff_user, self.remote_user, 100.0, "unpaid", "2022-04-12")
+        self.add_transaction(self.remote_user, self.jeff_user, 200.0, "unpaid", "2022-04-10")
+        self.add_transaction(self.ali_user, self.jeff_user, 300.0, "unpaid", "2022-04-11")
+        self.add_transaction(self.jeff_user, self.local_user, 400.0, "unpaid", "2022-04-09")
+
+        history = TransactionUtility().get_transactions_by_user_id(str(self.jeff_user.id))
+        # Rows of each direction are merged across shards by date
+        self.assertEqual([(transaction["transaction_type"], transaction["transaction_amount"])
+                          for transaction in history["transactions"]],
+                         [("lend", 400.0), ("lend", 100.0), ("borrow", 200.0), ("borrow", 300.0)])
+        cache.clear()
+        LOCAL_CACHE.clear()
+        self.assertEqual(async_to_sync(TransactionUtility().aget_transactions_by_user_id)(
+            str(self.jeff_user.id))["transactions"], history["transactions"])
+
+        page = TransactionUtility().get_transactions_page(str(self.jeff_user.id), 3)
+        self.assertEqual([transaction["transaction_amount"] for transaction in page["transactions"]],
+                         [400.0, 200.0, 300.0])
+        page = TransactionUtility().get_transactions_page(
+            str(self.jeff_user.id), 3, page["next_cursor"])
+        self.assertEqual([transaction["transaction_amount"]
+                         for transaction in page["transactions"]], [100.0])
+
+        export = TransactionUtility().export_transactions_by_user_id(str(self.jeff_user.id))
+        self.assertEqual([json.loads(line)["transaction_amount"] for line in "".join(
+            export["lines"]).splitlines()], [400.0, 200.0, 300.0, 100.0])
+
+        # Writes invalidate the cached history of both users
+        self.add_transaction(self.remote_user, self.jeff_user, 500.0, "unpaid", "2022-04-13")
+        self.assertEqual(len(TransactionUtility().get_transactions_by_user_id(
+            str(self.jeff_user.id))["transactions"]), 5)
+
+    def test_fan_out_workers_close_their_connections(self):
+        with mock.patch.object(connections, "close_all") as close_all:
+            self.assertEqual(fan_out(lambda alias: Users.objects.filter(
+                username="jeff").count(), SHARDS), [1 if alias == get_shard(self.jeff_user.id) else 0
+                                                   for alias in SHARDS])
+        self.assertEqual(close_all.call_count, len(SHARDS))
+
+    def test_mark_paid_on_lender_shard(self):
+        transaction_id = self.add_transaction(self.jeff_user, self.remote_user, 1500.0, "unpaid")
+
+        response = TransactionUtility().mark_transaction_paid(transaction_id)
+        self.assertEqual(response["code"], 200)
+        self.assertEqual(self.get_balance(self.jeff_user), -1500.0)
+        self.assertEqual(self.get_balance(self.remote_user), 1500.0)
+        self.assertEqual(self.get_aggregates(self.remote_user).unpaid_borrowed_count, 0)
+        self.assertEqual(self.get_aggregates(self.remote_user).paid_borrowed_count, 1)
+        self.assertEqual(TransactionUtility().mark_transaction_paid(str(uuid.uuid4()))["code"], 404)
+
+    def test_pending_transfer_is_recovered_once(self):
+        with mock.patch.object(ShardUtility, "apply_transfers"):
+            self.add_transaction(self.jeff_user, self.remote_user, 1500.0, "paid")
+        self.assertEqual(self.get_balance(self.remote_user), 0.0)
+        self.assertEqual(ShardTransfer.objects.using(
+            get_shard(self.jeff_user.id)).filter(state="pending").count(), 1)
+
+        # A crash after applying on the target but before deleting the pending row
+        transfer = ShardTransfer.objects.using(get_shard(self.jeff_user.id)).get()
+        self.assertTrue(ShardUtility().apply_transfer(get_shard(self.jeff_user.id), transfer.id))
+        transfer.save(using=get_shard(self.jeff_user.id))
+        self.assertEqual(self.get_balance(self.remote_user), 1500.0)
+
+        self.assertEqual(ShardUtility().recover_transfers(), 1)
+        self.assertEqual(ShardUtility().recover_transfers(), 0)
+        self.assertEqual(self.get_balance(self.remote_user), 1500.0)
+        self.assertEqual(self.get_aggregates(self.remote_user).paid_borrowed_count, 1)
+
+    def test_rebalance_after_shard_change(self):
+        self.add_transaction(self.jeff_user, self.remote_user, 1500.0, "paid")
+        self.add_transaction(self.remote_user, self.ali_user, 200.0, "unpaid")
+        self.add_transaction(self.local_user, self.jeff_user, 300.0, "unpaid")
+        user_ids = [str(user.id) for user in (
+            self.jeff_user, self.ali_user, self.remote_user, self.local_user)]
+        credit_scores = UsersUtility().get_credit_scores(user_ids)["credit_scores"]
+
+        # Shrinking to default moves everyone there, the retired shards are scanned for users too
+        with override_settings(LEDGER_SHARDS=SHARDS[:1]):
+            call_command("rebalance_shards", retired=SHARDS[1:], stdout=StringIO())
+            self.assertEqual(ShardUtility().get_misplaced_users(SHARDS), [])
+            self.assertEqual(Users.objects.exclude(username__startswith="shadow:").count(), 4)
+            self.assertEqual(Transactions.objects.count(), 3)
+            self.assertEqual(Users.objects.get(id=self.remote_user.id).balance, 150000)
+            self.assertEqual(UsersUtility().get_credit_scores(user_ids)["credit_scores"], credit_scores)
+
+        self.assertNotEqual(ShardUtility().get_misplaced_users(), [])
+        output = StringIO()
+        call_command("rebalance_shards", dry_run=True, stdout=output)
+        self.assertIn("Would move", output.getvalue())
+        call_command("rebalance_shards", stdout=StringIO())
+        self.assertEqual(ShardUtility().get_misplaced_users(), [])
+        self.assertEqual(self.get_balance(self.remote_user), 1500.0)
+        self.assertEqual(self.get_aggregates(self.remote_user).paid_borrowed_total, 150000)
+        self.assertEqual(sum(Transactions.objects.using(alias).count() for alias in SHARDS), 3)
+        self.assertEqual(UsersUtility().get_credit_scores(user_ids)["credit_scores"], credit_scores)
+        self.assertEqual(len(TransactionUtility().get_transactions_by_user_id(
+            str(self.jeff_user.id))["transactions"]), 2)
+
+
+class PerformanceBudgetTestCases(TestCase):
+    '''
+    Query budgets and latency baselines of the API endpoints on seeded data
+
+    Query counts include everything the request runs, after-commit cache
+    refreshes too. Wall time is compared with the median recorded in
+    LEDGER_PERF_BASELINE_FILE when it has an entry for the endpoint. Run with
+    LEDGER_PERF_RECORD=1 to record baselines on the machine that runs the
+    suite, LEDGER_PERF_MARGIN (default 0.5) is the allowed relative slowdown.
+    Without recorded baselines the check is skipped, unless
+    LEDGER_PERF_BASELINE_FILE is set, then it fails.
+
+    '''
+
+    USERS = 50
+    TRANSACTIONS = 5000
+    TIMING_ROUNDS = 7
+
+    # Maximum queries per request, cold cache
+    QUERY_BUDGETS = {
+        "login": 1,
+        "credit_score": 1,
+        "credit_scores": 1,
+        "get_transactions": 2,
+        "get_transactions_page": 2,
+        "add_transaction": 5,
+        "add_transactions": 5,
+        "mark_paid": 4,
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        rand = random.Random(0)
+        users = Users.objects.bulk_create([
+            Users(name="User {}".format(index), username="perf{}".format(index),
+                  password=make_password("perf{}".format(index)))
+            for index in range(cls.USERS)])
+        cls.user_ids = [str(user.id) for user in users]
+        transactions = []
+        for index in range(cls.TRANSACTIONS):
+            lender, borrower = rand.sample(users, 2)
+            transactions.append(Transactions(
+                transaction_from=lender, transaction_with=borrower,
+                transaction_amount=rand.randint(1, 500) * MINOR_UNITS,
+                transaction_status=rand.choice(("paid", "unpaid")),
+                transaction_date=datetime(2022, 1, 1, tzinfo=dt_timezone.utc) + timedelta(minutes=index),
+                reason="perf"))
+        Transactions.objects.bulk_create(transactions, batch_size=500)
+        # Requests are made with the token of the first user, only their transactions can be marked paid
+        cls.unpaid_ids = [str(transaction.id) for transaction in transactions
+                          if transaction.transaction_status == "unpaid" and users[0] in (
+                              transaction.transaction_from, transaction.transaction_with)]
+        AggregatesUtility().rebuild()
+        TransactionUtility().recompute_balances()
+
+    def setUp(self):
+        cache.clear()
+        LOCAL_CACHE.clear()
+        self.client = Client()
+        self.authorization = "Bearer {}".format(
+            TokenUtility().issue_token(self.user_ids[0]))
+
+    def request(self, method, path, body):
+        response = self.client.generic(method, path, json.dumps(body), content_type="application/json",
+                                       HTTP_AUTHORIZATION=self.authorization)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response
+
+    def get_endpoint_requests(self):
+        '''Returns name and request function of every endpoint, each call makes a fresh request'''
+
+        unpaid_ids = iter(self.unpaid_ids)
+        return {
+            "login": lambda: self.request("POST", "/api/login", {"username": "perf0", "password": "perf0"}),
+            "credit_score": lambda: self.request("GET", "/api/credit_score", {"user_id": self.user_ids[0]}),
+            "credit_scores": lambda: self.request("GET", "/api/credit_scores", {"user_ids": self.user_ids}),
+            "get_transactions": lambda: (cache.clear(), LOCAL_CACHE.clear(), self.request(
+                "GET", "/api/get_transactions", {"user_id": self.user_ids[0]}))[-1],
+            "get_transactions_page": lambda: self.request(
+                "GET", "/api/get_transactions", {"user_id": self.user_ids[0], "page_size": 50}),
+            "add_transaction": lambda: self.request("POST", "/api/add_transaction", {
+                "transaction_from": self.user_ids[0], "transaction_with": self.user_ids[1],
+                "transaction_amount": 10.0, "transaction_type": "lend", "transaction_status": "paid",
+                "transaction_date": "2022-04-10", "reason": "perf"}),
+            "add_transactions": lambda: self.request("POST", "/api/add_transactions", {"transactions": [{
+                "transaction_from": self.user_ids[0], "transaction_with": self.user_ids[index + 1],
+                "transaction_amount": 10.0, "transaction_type": "lend", "transaction_status": "paid",
+                "transaction_date": "2022-04-10", "reason": "perf"} for index in range(20)]}),
+            "mark_paid": lambda: self.request("PATCH", "/api/mark_paid", {"transaction_id": next(unpaid_ids)}),
+        }
+
+    def test_query_budgets(self):
+        for name, request in self.get_endpoint_requests().items():
+            with self.subTest(endpoint=name), self.captureOnCommitCallbacks(execute=True), \
+                    CaptureQueriesContext(connection) as context:
+                request()
+            queries = [query for query in context.captured_queries
+                       if not query["sql"].startswith(("SAVEPOINT", "RELEASE SAVEPOINT"))]
+            self.assertLessEqual(len(queries), self.QUERY_BUDGETS[name], "\n".join(
+                query["sql"] for query in queries))
+
+    def test_latency_baselines(self):
+        baseline_file = os.environ.get("LEDGER_PERF_BASELINE_FILE", os.path.join(
+            os.path.dirname(__file__), "perf_baselines.json"))
+        margin = float(os.environ.get("LEDGER_PERF_MARGIN", "0.5"))
+
+        medians = {}
+        for name, request in self.get_endpoint_requests().items():
+            timings = []
+            for _ in range(self.TIMING_ROUNDS + 1):
+                with self.captureOnCommitCallbacks(execute=True):
+                    start_time = time.perf_counter()
+                    request()
+                timings.append(time.perf_counter() - start_time)
+            # First round warms up imports and connection state
+            medians[name] = statistics.median(timings[1:])
+
+        if os.environ.get("LEDGER_PERF_RECORD") == "1":
+            with open(baseline_file, "w") as baselines_file:
+                json.dump(medians, baselines_file, indent=2, sort_keys=True)
+            return
+
+        if not os.path.exists(baseline_file):
+            # An explicitly configured baseline file must exist, only the default one is optional
+            if "LEDGER_PERF_BASELINE_FILE" in os.environ:
+                self.fail("Latency baseline file {} does not exist, record it with LEDGER_PERF_RECORD=1".format(
+                    baseline_file))
+            self.skipTest(
+                "No latency baselines, record them with LEDGER_PERF_RECORD=1")
+        with open(baseline_file) as baselines_file:
+            baselines = json.load(baselines_file)
+
+        for name, median in medians.items():
+            if name not in baselines:
+                continue
+            with self.subTest(endpoint=name):
+                self.assertLessEqual(median, baselines[name] * (1 + margin), "{} median {:.2f} ms, baseline {:.2f} ms".format(
+                    name, median * 1000, baselines[name] * 1000))
+
+
+class MoneyTestCases(SimpleTestCase):
+    def test_to_minor_units(self):
+        self.assertEqual(to_minor_units(0.1), 10)
+        self.assertEqual(to_minor_units(19.99), 1999)
+        self.assertEqual(to_minor_units("12.30"), 1230)
+        self.assertEqual(to_minor_units(Decimal("0.07")), 7)
+        self.assertEqual(to_minor_units(400), 40000)
+        self.assertEqual(to_minor_units(1e-2), 1)
+        for amount in (10.001, "0.005", "abc", "", None, True, float("nan"), float("inf"), [1], 2 ** 63):
+            with self.subTest(amount=amount):
+                self.assertIsNone(to_minor_units(amount))
+
+    def test_to_major_units(self):
+        self.assertEqual(to_major_units(1999), 19.99)
+        self.assertEqual(to_major_units(-5000), -50.0)
+        self.assertIsNone(to_major_units(None))
+
+    def test_reconciliation_over_random_amounts(self):
+        rand = random.Random(25)
+        count = 2000000
+        cents = [rand.randint(1, 10 ** 9) * rand.choice((1, -1)) for _ in range(count)]
+        amounts = [to_major_units(amount) for amount in cents]
+
+        # Every amount survives the API round trip, in and out
+        self.assertEqual([to_minor_units(amount) for amount in amounts], cents)
+        self.assertEqual(sum(cents), sum(Decimal(str(amount)) for amount in amounts) * MINOR_UNITS)
+
+        # Running float totals, like the float columns summed, drift away from the exact total
+        float_total = 0.0
+        for amount in amounts:
+            float_total += amount
+        self.assertNotEqual(Decimal(str(float_total)) * MINOR_UNITS, sum(cents))
+
+
+class CreditScoreEngineTestCases(SimpleTestCase):
+    def legacy_borrow_score(self, borrow_sum):
+        if borrow_sum in range(0, 101):
+            return 100
+        for index, lower in enumerate(range(101, 1001, 100)):
+            if borrow_sum in range(lower, lower + 100):
+                return 90 - index * 10
+        if borrow_sum >= 1001:
+            return 0
+
+    def legacy_lend_score(self, lend_sum):
+        if lend_sum in range(0, 1001):
+            return 0
+        for index, lower in enumerate(range(1001, 2001, 100)):
+            if lend_sum in range(lower, lower + 100):
+                return 10 + index * 10
+        if lend_sum >= 2001:
+            return 100
+
+    def test_scores_match_legacy_tiers_for_integers(self):
+        amounts = list(range(0, 3001))
+        engine = CreditScoreEngine()
+
+        cents = [amount * MINOR_UNITS for amount in amounts]
+
+        self.assertEqual(engine.borrow_table.score_many(cents),
+                         [self.legacy_borrow_score(amount) for amount in amounts])
+        self.assertEqual(engine.lend_table.score_many(cents),
+                         [self.legacy_lend_score(amount) for amount in amounts])
+        self.assertEqual(engine.score_many(cents, reversed(cents)),
+                         [self.legacy_lend_score(lend_sum) + self.legacy_borrow_score(borrow_sum)
+                          for lend_sum, borrow_sum in zip(amounts, reversed(amounts))])
+
+    def test_fractional_and_blank_amounts(self):
+        self.assertEqual(UsersUtility().calculate_borrow_score(15050), 90)
+        self.assertEqual(UsersUtility().calculate_borrow_score(10001), 90)
+        self.assertEqual(UsersUtility().calculate_borrow_score(10000), 100)
+        self.assertEqual(UsersUtility().calculate_lend_score(100001), 10)
+        self.assertEqual(UsersUtility().calculate_lend_score(None), 0)
+        self.assertEqual(UsersUtility().calculate_borrow_score(None), 100)
+
+    @override_settings(LEDGER_BORROW_SCORE_TIERS=[(50, 100), (None, 0)])
+    def test_configurable_tiers(self):
+        self.assertEqual(UsersUtility().calculate_borrow_score(5000), 100)
+        self.assertEqual(UsersUtility().calculate_borrow_score(5001), 0)
+
+    def test_invalid_tiers(self):
+        with self.assertRaises(ValueError):
+            ScoreTable([(100, 10), (50, 20), (None, 0)])
+        with self.assertRaises(ValueError):
+            ScoreTable([(100, 10)])
+        with self.assertRaises(ValueError):
+            ScoreTable([(100.001, 10), (None, 0)])
+
+
+class RoundTripCounter:
+    '''Cache backend proxy that records the name of every call made through it'''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.backend, name)
+
+        def call(*args, **kwargs):
+            self.calls.append(name)
+            return method(*args, **kwargs)
+        return call
+
+
+class LedgerCacheTestCases(SimpleTestCase):
+    def setUp(self):
+        self.ledger_cache = LedgerCache(LocMemCache(
+            "ledger-cache-tests", {}), local=LocalCache(0), counters=CacheCounters())
+        self.ledger_cache.backend.clear()
+        self.user_id = "64bf6cc4-0ed9-4e52-a450-605574334641"
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        return [self.calls]
+
+    def test_bump_generation_invalidates_entries(self):
+        self.assertEqual(self.ledger_cache.get_or_compute(
+            "trans_history", self.user_id, self.compute, 60), [1])
+        self.assertEqual(self.ledger_cache.get_or_compute(
+            "trans_history", self.user_id.replace("-", ""), self.compute, 60), [1])
+
+        self.ledger_cache.bump_generations([self.user_id.upper()])
+
+        self.assertEqual(self.ledger_cache.get_or_compute(
+            "trans_history", self.user_id, self.compute, 60), [2])
+        self.assertEqual(self.calls, 2)
+
+    @override_settings(LEDGER_CACHE_GENERATION_TTL=0.1)
+    def test_generation_stamps_expire(self):
+        self.ledger_cache.get_or_compute(
+            "trans_history", self.user_id, self.compute, 60)
+        self.ledger_cache.bump_generations([self.user_id])
+        key = GENERATION_KEY.format(self.user_id)
+        self.assertIsNotNone(self.ledger_cache.backend.get(key))
+
+        time.sleep(0.15)
+        self.assertIsNone(self.ledger_cache.backend.get(key))
+        # An expired stamp starts a fresh generation
+        self.assertEqual(self.ledger_cache.get_or_compute(
+            "trans_history", self.user_id, self.compute, 60), [2])
+
+    def test_missing_entry_is_computed_once(self):
+        def slow_compute():
+            time.sleep(0.2)
+            return self.compute()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.ledger_cache.get_or_compute(
+            "trans_history", self.user_id, slow_compute, 60))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [[1]] * 8)
+
+    def test_update_entries_many_batches_round_trips(self):
+        user_ids = [str(uuid.uuid4()) for _ in range(30)]
+        for user_id in user_ids:
+            self.ledger_cache.get_or_compute(
+                "trans_history", user_id, self.compute, 60)
+
+        backend = RoundTripCounter(self.ledger_cache.backend)
+        writer = LedgerCache(backend, local=LocalCache(0), counters=CacheCounters())
+        updated = writer.update_entries_many({user_id: {
+            "trans_history": lambda cached: cached + [0]} for user_id in user_ids}, 60)
+
+        self.assertEqual(updated, set(user_ids))
+        # One lock per user, the rest of the batch is a fixed number of round trips
+        self.assertEqual(backend.calls.count("add"), len(user_ids))
+        self.assertEqual(len(backend.calls), len(user_ids) + 6)
+        for user_id in user_ids:
+            self.assertEqual(self.ledger_cache.get_or_compute(
+                "trans_history", user_id, self.compute, 60)[-1], 0)
+        self.assertEqual(self.calls, len(user_ids))
+
+    @override_settings(LEDGER_CACHE_EARLY_REFRESH_BETA=0)
+    def test_entry_is_not_refreshed_without_early_refresh(self):
+        for _ in range(5):
+            self.ledger_cache.get_or_compute(
+                "trans_history", self.user_id, self.compute, 60)
+        self.assertEqual(self.calls, 1)
+
+    @override_settings(LEDGER_CACHE_EARLY_REFRESH_BETA=1e12)
+    def test_entry_is_refreshed_early_before_expiry(self):
+        self.ledger_cache.get_or_compute(
+            "trans_history", self.user_id, lambda: (time.sleep(0.01), self.compute())[1], 60)
+        self.assertEqual(self.ledger_cache.get_or_compute(
+            "trans_history", self.user_id, self.compute, 60), [2])
+
+
+class TwoTierCacheTestCases(SimpleTestCase):
+    def setUp(self):
+        self.backend = LocMemCache("two-tier-cache-tests", {})
+        self.backend.clear()
+        self.user_id = "64bf6cc4-0ed9-4e52-a450-605574334641"
+        self.calls = 0
+
+    def get_worker(self, max_entries=16):
+        '''Returns LedgerCache of a separate worker sharing the same backend'''
+
+        return LedgerCache(self.backend, local=LocalCache(max_entries), counters=CacheCounters())
+
+    def compute(self):
+        self.calls += 1
+        return [self.calls]
+
+    def test_local_tier_serves_without_backend_round_trips(self):
+        worker = self.get_worker()
+        worker.get_or_compute("trans_history", self.user_id, self.compute, 60)
+
+        self.backend.clear()
+        for _ in range(3):
+            self.assertEqual(worker.get_or_compute(
+                "trans_history", self.user_id, self.compute, 60), [1])
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(worker.get_stats(), {
+            "local": {"hits": 3, "misses": 1, "hit_ratio": 0.75},
+            "remote": {"hits": 0, "misses": 1, "hit_ratio": 0.0},
+        })
+
+    def test_remote_tier_shared_between_workers(self):
+        self.get_worker().get_or_compute(
+            "trans_history", self.user_id, self.compute, 60)
+        worker = self.get_worker()
+        self.assertEqual(worker.get_or_compute(
+            "trans_history", self.user_id, self.compute, 60), [1])
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(worker.get_stats()["remote"]["hits"], 1)
+
+    @override_settings(LEDGER_LOCAL_CACHE_GENERATION_TTL=0.2)
+    def test_bump_reaches_other_workers_after_generation_ttl(self):
+        writer, reader = self.get_worker(), self.get_worker()
+        for worker in (writer, reader):
+            worker.get_or_compute(
+                "trans_history", self.user_id, self.compute, 60)
+
+        writer.bump_generations([self.user_id])
+        self.assertEqual(writer.get_or_compute(
+            "trans_history", self.user_id, self.compute, 60), [2])
+        self.assertEqual(reader.get_or_compute(
+            "trans_history", self.user_id, self.compute, 60), [1])
+
+        time.sleep(0.25)
+        self.assertEqual(reader.get_or_compute(
+            "trans_history", self.user_id, self.compute, 60), [2])
+        self.assertEqual(self.calls, 2)
+
+    def test_local_cache_evicts_least_recently_used(self):
+        local = LocalCache(2)
+        local.set("a", 1, 60)
+        local.set("b", 2, 60)
+        local.get("a")
+        local.set("c", 3, 60)
+        self.assertEqual((local.get("a"), local.get(
+            "b"), local.get("c")), (1, None, 3))
+
+    def test_local_cache_entries_expire(self):
+        local = LocalCache(2)
+        local.set("a", 1, 0.05)
+        time.sleep(0.1)
+        self.assertIsNone(local.get("a"))
+
+
+class RowCodecTestCases(SimpleTestCase):
+    def setUp(self):
+        self.rows = [
+            (uuid.UUID("64bf6cc4-0ed9-4e52-a450-605574334641"), "lend", 1500.0, None),
+            (uuid.UUID("36e6e7b9-65ba-4cb7-a3ff-7d2d1b2e1fb9"), "borrow", 10.5, "food"),
+            (None, "lend", 0.0, "travel"),
+        ]
+
+    def test_roundtrip(self):
+        codec = RowCodec(compress_threshold=1 << 20)
+        payload = codec.encode(self.rows)
+        self.assertTrue(payload.startswith(b"r"))
+        self.assertEqual(codec.decode(payload), self.rows)
+
+    def test_large_payload_is_compressed(self):
+        rows = self.rows * 500
+        codec = RowCodec(compress_threshold=1024)
+        payload = codec.encode(rows)
+        self.assertTrue(payload.startswith(b"z"))
+        self.assertLess(len(payload), len(RowCodec(
+            compress_threshold=1 << 30).encode(rows)))
+        self.assertEqual(codec.decode(payload), rows)
+
+    def test_empty_rows(self):
+        codec = RowCodec()
+        self.assertEqual(codec.decode(codec.encode([])), [])
+
+    def test_ledger_cache_stores_encoded_payload(self):
+        ledger_cache = LedgerCache(LocMemCache(
+            "row-codec-tests", {}), local=LocalCache(0))
+        ledger_cache.backend.clear()
+        user_id = ledger_cache.normalize_user_id(str(self.rows[0][0]))
+        for _ in range(2):
+            self.assertEqual(ledger_cache.get_or_compute(
+                "trans_history", user_id, lambda: list(self.rows), 60, codec=RowCodec()), self.rows)
+        key = ledger_cache.make_key(
+            "trans_history", user_id, ledger_cache.get_generations([user_id])[user_id])
+        self.assertIsInstance(ledger_cache.backend.get(key)[0], bytes)
+
+
+class MetricsTestCases(SimpleTestCase):
+    def test_histogram_renders_cumulative_buckets(self):
+        histogram = Histogram("latency_seconds", "Latency.",
+                              ("endpoint",), (0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(("api/login",), value)
+
+        self.assertEqual(histogram.render().splitlines(), [
+            "# HELP latency_seconds Latency.",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{endpoint="api/login",le="0.1"} 2',
+            'latency_seconds_bucket{endpoint="api/login",le="1.0"} 3',
+            'latency_seconds_bucket{endpoint="api/login",le="+Inf"} 4',
+            'latency_seconds_sum{endpoint="api/login"} 2.65',
+            'latency_seconds_count{endpoint="api/login"} 4',
+        ])
+
+    def test_counter_sums_thread_shards(self):
+        counter = Counter("requests_total", "Requests.", ("method",))
+        threads = [threading.Thread(target=lambda: [counter.inc(("GET",)) for _ in range(1000)])
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc(("GET",))
+
+        self.assertEqual(counter.collect(), {("GET",): [4001]})
+        # Shards of finished threads are folded into one
+        self.assertEqual(len(counter.shards), 1)
+        self.assertIn('requests_total{method="GET"} 4001', counter.render())
+
+    def test_label_values_are_escaped(self):
+        counter = Counter("requests_total", "Requests.", ("endpoint",))
+        counter.inc(('a"b\\c',))
+        self.assertIn('requests_total{endpoint="a\\"b\\\\c"} 1', counter.render())
+
+
+class StructuredLoggingTestCases(SimpleTestCase):
+    def make_record(self, level, msg, *args):
+        return logging.LogRecord("api.utils", level, __file__, 1, msg, args, None)
+
+    def test_json_formatter(self):
+        record = self.make_record(
+            logging.INFO, "UsersUtility - Login - Invoked - %s", "jeff")
+        record.route = "api/login"
+
+        payload = json.loads(JsonFormatter().format(record))
+
+        self.assertEqual(payload["message"],
+                         "UsersUtility - Login - Invoked - jeff")
+        self.assertEqual(payload["level"], "INFO")
+        self.assertEqual(payload["route"], "api/login")
+
+    def test_queue_handler_formats_in_background_thread(self):
+        stream = StringIO()
+        handler = QueueLogHandler(stream)
+        record = self.make_record(logging.ERROR, "%s - ERROR - %s", "Test", 42)
+        try:
+            handler.handle(record)
+            # Enqueued as is, the message is not formatted by the calling thread
+            self.assertEqual((record.msg, record.args),
+                             ("%s - ERROR - %s", ("Test", 42)))
+        finally:
+            handler.close()
+
+        payload = json.loads(stream.getvalue())
+        self.assertEqual(payload["message"], "Test - ERROR - 42")
+
+    def test_queue_handler_formats_mutable_args_and_tracebacks_in_calling_thread(self):
+        stream = StringIO()
+        handler = QueueLogHandler(stream)
+        user_ids = ["jeff"]
+        record = self.make_record(logging.INFO, "Invoked - %s", user_ids)
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            error_record = logging.LogRecord(
+                "api.utils", logging.ERROR, __file__, 1, "Failed - %s", ("jeff",), sys.exc_info())
+        try:
+            handler.handle(record)
+            user_ids.append("ali")
+            handler.handle(error_record)
+            self.assertEqual((record.msg, record.args), ("Invoked - ['jeff']", None))
+            self.assertIsNone(error_record.exc_info)
+        finally:
+            handler.close()
+
+        payloads = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(payloads[0]["message"], "Invoked - ['jeff']")
+        self.assertEqual(payloads[1]["message"], "Failed - jeff")
+        self.assertIn("ValueError: boom", payloads[1]["exc_info"])
+
+    @override_settings(LEDGER_LOG_DEBUG_SAMPLE_RATES={"api/get_transactions": 0.0, "*": 1.0})
+    def test_debug_lines_are_sampled_per_route(self):
+        self.assertFalse(should_sample_debug("api/get_transactions"))
+        self.assertTrue(should_sample_debug("api/login"))
+
+        route_filter = RouteContextFilter()
+        route_token = LOG_ROUTE.set("api/get_transactions")
+        sampled_token = LOG_DEBUG_SAMPLED.set(False)
+        try:
+            self.assertFalse(route_filter.filter(
+                self.make_record(logging.DEBUG, "Cache - HIT")))
+            info_record = self.make_record(logging.INFO, "Invoked")
+            self.assertTrue(route_filter.filter(info_record))
+            self.assertEqual(info_record.route, "api/get_transactions")
+        finally:
+            LOG_DEBUG_SAMPLED.reset(sampled_token)
+            LOG_ROUTE.reset(route_token)
+
+
+class ProfileStoreTestCases(SimpleTestCase):
+    def test_store_keeps_newest_profiles(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = ProfileStore(directory, max_entries=3)
+            profile_ids = []
+            for index in range(5):
+                profiler = cProfile.Profile()
+                profiler.enable()
+                sum(range(100))
+                profiler.disable()
+                profile_ids.append(store.save({"index": index}, profiler))
+
+            self.assertEqual(store.get_ids(), profile_ids[2:])
+            self.assertIsNone(store.get(profile_ids[0]))
+            self.assertEqual(store.get(profile_ids[-1])["index"], 4)
+            self.assertEqual(len(os.listdir(directory)), 6)
+
+
+class SqliteTuningTestCases(SimpleTestCase):
+    '''LEDGER_SQLITE_PRAGMAS run by api.sqlite on new connections to a SQLite file'''
+
+    def get_pragmas(self, path):
+        wrapper = DatabaseWrapper(dict(connection.settings_dict, NAME=path), alias="sqlite_tuning")
+        try:
+            wrapper.ensure_connection()
+            return {name: wrapper.connection.execute("PRAGMA {}".format(name)).fetchone()[0]
+                    for name in ("journal_mode", "synchronous", "busy_timeout", "cache_size")}
+        finally:
+            wrapper.close()
+
+    def test_pragmas_on_new_connections(self):
+        with tempfile.TemporaryDirectory() as directory:
+            pragmas = self.get_pragmas(os.path.join(directory, "tuned.sqlite3"))
+            self.assertEqual(pragmas["journal_mode"], "wal")
+            # NORMAL
+            self.assertEqual(pragmas["synchronous"], 1)
+            self.assertEqual(pragmas["busy_timeout"], 5000)
+            self.assertEqual(pragmas["cache_size"], -64000)
+
+    @override_settings(LEDGER_SQLITE_PRAGMAS={})
+    def test_stock_connections_without_pragmas(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual(self.get_pragmas(os.path.join(
+                directory, "stock.sqlite3"))["journal_mode"], "delete")
+
+    def test_connections_are_reused(self):
+        self.assertTrue(all(database["CONN_HEALTH_CHECKS"] and database["CONN_MAX_AGE"] == settings.LEDGER_DB_CONN_MAX_AGE
+                            for database in settings.DATABASES.values()))
@@ -1,11 +1,24 @@
+from django.conf import settings
 from django.urls import path
 from .views import *
 
+# Read endpoints are served by async views under ASGI, writes keep the sync views
+if getattr(settings, "LEDGER_ASYNC_VIEWS", False):
+    user_view = AsyncUserView.as_view()
+    transaction_view = AsyncTransactionView.as_view()
+    export_view = AsyncTransactionExportView.as_view()
+else:
+    user_view = UserView.as_view()
+    transaction_view = TransactionView.as_view()
+    export_view = TransactionExportView.as_view()
 
 urlpatterns = [
-    path("login", UserView.as_view()),
-    path("get_transactions", TransactionView.as_view()),
-    path("add_transaction", TransactionView.as_view()),
-    path("mark_paid", TransactionView.as_view()),
-    path("credit_score", UserView.as_view()),
+    path("login", user_view),
+    path("get_transactions", transaction_view),
+    path("export_transactions", export_view),
+    path("add_transaction", transaction_view),
+    path("add_transactions", TransactionBatchView.as_view()),
+    path("mark_paid", transaction_view),
+    path("credit_score", user_view),
+    path("credit_scores", CreditScoreBatchView.as_view()),
 ]
@@ -1,56 +1,207 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import base64
+import csv
+import heapq
+import io
+import itertools
+import json
+import uuid
+from asgiref.sync import sync_to_async
 from .models import *
-from django.db.models import Sum
-from django.core.cache import cache
+from .caching import LedgerCache, RowCodec, normalize_user_id
+from .money import to_major_units, to_minor_units
+from .routers import aget_read_database, get_read_database, on_shard, pin_to_primary, read_from
+from .sharding import SHADOW_USERNAME, SHADOW_USERNAME_PREFIX, fan_out, get_shard, get_shards, group_by_shard, is_sharded
+from .scoring import get_credit_score_engine
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, make_password
+from django.core import signing
+from django.core.exceptions import ValidationError
+from django.db import transaction as db_transaction
+from django.db.models import Case, Count, F, Q, Sum, Value, When
+from django.db.models.functions import Cast, TruncDate
+from django.utils import timezone
 
 import logging
 logger = logging.getLogger(__name__)
 
 CACHE_TTL = 60
 
+HISTORY_FIELDS = ("id", "date_str", "counterparty", "transaction_status",
+                  "transaction_amount", "direction", "reason")
+
+TRANSACTION_DIRECTIONS = ("lend", "borrow")
+
+# Cached Transactions rows, in concrete field order so they load with Transactions.from_db
+TRANSACTION_ROW_FIELDS = tuple(
+    field.attname for field in Transactions._meta.concrete_fields)
+
+ROW_CODEC = RowCodec()
+
+EXPORT_FIELDS = ("transaction_id", "transaction_date", "transaction_from", "transaction_with",
+                 "transaction_status", "transaction_amount", "transaction_type", "reason")
+EXPORT_CONTENT_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+TOKEN_SALT = "api.token"
+
+# Rows per INSERT and users per CASE UPDATE, keeps statements under DB parameter limits
+BULK_BATCH_SIZE = 250
+
+
+class TokenUtility:
+    def issue_token(self, user_id: str):
+        '''
+        Returns signed, timestamped login token of user
+
+        Parameters:
+        user_id (str): User id from Users model
+
+        Returns:
+        Str: Token to send as "Authorization: Bearer <token>"
+
+        '''
+
+        return signing.dumps(str(user_id), salt=TOKEN_SALT)
+
+    def verify_token(self, token: str):
+        '''
+        Returns user id of token, None if token is invalid or expired
+
+        Only the HMAC and the timestamp are checked, there is no DB or cache lookup.
+
+        Parameters:
+        token (str): Token issued by login
+
+        Returns:
+        Str: User id from Users model
+
+        '''
+
+        if not token:
+            return None
+        try:
+            return signing.loads(token, salt=TOKEN_SALT, max_age=getattr(
+                settings, "LEDGER_TOKEN_MAX_AGE", 12 * 60 * 60))
+        except signing.BadSignature:
+            return None
+
+    def is_party(self, token_user_id: str, user_ids):
+        '''
+        Returns True if the user of a verified token is one of user_ids, ids are compared as UUIDs
+
+        Parameters:
+        token_user_id (str): User id returned by verify_token
+        user_ids (iterable): User ids the request reads or writes
+
+        Returns:
+        Bool: True if any of user_ids is the token user
+
+        '''
+
+        try:
+            token_uuid = uuid.UUID(str(token_user_id))
+        except ValueError:
+            return False
+        for user_id in user_ids:
+            try:
+                if uuid.UUID(str(user_id)) == token_uuid:
+                    return True
+            except ValueError:
+                continue
+        return False
+
 
 class UsersUtility:
     def login(self, username: str, password: str):
         '''
-        Authenticates User
+        Authenticates User and issues login token
 
         Parameters:
         username (str): Username of user
         password (str): Password of user
 
         Returns:
-        Dict: User details/Error details
+        Dict: User details with token/Error details
 
         '''
 
-        logger.info("UsersUtility - Login - Invoked - {}".format(username))
+        logger.info("UsersUtility - Login - Invoked - %s", username)
         if not username or not password:
             logger.error(
                 "UsersUtility - Login - ERROR - Username or password is blank")
             return {"message": "Wrong username or password!", "code": 401}
 
-        user = cache.get("user_{}_{}".format(username, password))
-        logger.info("UsersUtility - Login - Cache - GET")
+        user = ShardUtility().find_user_by_username(
+            username, ("id", "name", "balance", "password"))
 
         if not user:
-            logger.info("UsersUtility - Login - Cache - MISS")
-            user = Users.objects.filter(username=username, password=password)
-            cache.set("user_{}_{}".format(username, password), user, CACHE_TTL)
-            logger.info("UsersUtility - Login - Cache - SET")
+            # Hash anyway so unknown usernames take as long as wrong passwords
+            make_password(password)
+            logger.error(
+                "UsersUtility - Login - ERROR - User does not exists in DB")
+            return {"message": "Wrong username or password!", "code": 401}
+
+        user_id, name, balance, encoded_password = user
+        if not check_password(password, encoded_password):
+            logger.error(
+                "UsersUtility - Login - ERROR - Wrong password")
+            return {"message": "Wrong username or password!", "code": 401}
+
+        result = {
+            "name": name,
+            "balance": to_major_units(balance),
+            "user_id": str(user_id),
+            "token": TokenUtility().issue_token(user_id),
+            "code": 200
+        }
+        logger.info(
+            "UsersUtility - Login - SUCCESS - Executed - %s", username)
+
+        return result
+
+    async def alogin(self, username: str, password: str):
+        '''
+        Async login for ASGI views, see login
+
+        The user is read with the async ORM and the password hash is checked in
+        a worker thread, so the event loop keeps serving other requests meanwhile.
+
+        '''
+
+        logger.info("UsersUtility - ALogin - Invoked - %s", username)
+        if not username or not password:
+            logger.error(
+                "UsersUtility - ALogin - ERROR - Username or password is blank")
+            return {"message": "Wrong username or password!", "code": 401}
+
+        if is_sharded():
+            user = await sync_to_async(ShardUtility().find_user_by_username)(
+                username, ("id", "name", "balance", "password"))
+        else:
+            user = await Users.objects.filter(username=username).values_list(
+                "id", "name", "balance", "password").afirst()
 
         if not user:
+            await sync_to_async(make_password, thread_sensitive=False)(password)
             logger.error(
-                "UsersUtility - Login - ERROR - User does not exists in DB")
+                "UsersUtility - ALogin - ERROR - User does not exists in DB")
+            return {"message": "Wrong username or password!", "code": 401}
+
+        user_id, name, balance, encoded_password = user
+        if not await sync_to_async(check_password, thread_sensitive=False)(password, encoded_password):
+            logger.error(
+                "UsersUtility - ALogin - ERROR - Wrong password")
             return {"message": "Wrong username or password!", "code": 401}
 
         result = {
-            "name": user[0].name,
-            "balance": user[0].balance,
-            "user_id": str(user[0].id),
+            "name": name,
+            "balance": to_major_units(balance),
+            "user_id": str(user_id),
+            "token": TokenUtility().issue_token(user_id),
             "code": 200
         }
         logger.info(
-            "UsersUtility - Login - SUCCESS - Executed - {}".format(username))
+            "UsersUtility - ALogin - SUCCESS - Executed - %s", username)
 
         return result
 
@@ -67,100 +218,110 @@ class UsersUtility:
         '''
 
         logger.info(
-            "UsersUtility - GetCreditScore - Invoked - {}".format(user_id))
+            "UsersUtility - GetCreditScore - Invoked - %s", user_id)
         if not user_id:
             logger.error(
                 "UsersUtility - GetCreditScore - ERROR - UserId is blank")
             return {"message": "Please provide user id", "code": 400}
 
-        transactions_lend = TransactionUtility().get_lend_transactions_by_user_id(
-            user_id, "UsersUtility - GetCreditScore")
-        lend_sum = transactions_lend.filter(
-            transaction_status="paid").aggregate(Sum('transaction_amount'))
+        with read_from(get_read_database([user_id])), on_shard(ShardUtility().get_home_shard(user_id)):
+            lend_sum, borrow_sum = AggregatesUtility().get_paid_totals(user_id)
+
+        lend_score = self.calculate_lend_score(lend_sum)
+        borrow_score = self.calculate_borrow_score(borrow_sum)
 
-        lend_score = self.calculate_lend_score(
-            lend_sum["transaction_amount__sum"])
+        total_score = lend_score + borrow_score
+        logger.debug(
+            "UsersUtility - GetCreditScore - TotalScore - %s", total_score)
 
-        transactions_borrow = TransactionUtility().get_borrow_transactions_by_user_id(
-            user_id, "UsersUtility - GetCreditScore")
-        borrow_sum = transactions_borrow.filter(
-            transaction_status="paid").aggregate(Sum('transaction_amount'))
+        logger.info(
+            "UsersUtility - GetCreditScore - SUCCESS - Executed - %s", user_id)
 
-        borrow_score = self.calculate_borrow_score(
-            borrow_sum["transaction_amount__sum"])
+        return {"credit_score": total_score, "code": 200}
+
+    async def aget_credit_score(self, user_id: str):
+        '''Async get_credit_score for ASGI views, paid totals are read with the async ORM'''
 
-        total_score = lend_score + borrow_score
         logger.info(
-            "UsersUtility - GetCreditScore - TotalScore - {}".format(total_score))
+            "UsersUtility - AGetCreditScore - Invoked - %s", user_id)
+        if not user_id:
+            logger.error(
+                "UsersUtility - AGetCreditScore - ERROR - UserId is blank")
+            return {"message": "Please provide user id", "code": 400}
 
+        with read_from(await aget_read_database([user_id])), on_shard(ShardUtility().get_home_shard(user_id)):
+            lend_sum, borrow_sum = await AggregatesUtility().aget_paid_totals(user_id)
+        total_score = self.calculate_lend_score(
+            lend_sum) + self.calculate_borrow_score(borrow_sum)
         logger.info(
-            "UsersUtility - GetCreditScore - SUCCESS - Executed - {}".format(user_id))
+            "UsersUtility - AGetCreditScore - SUCCESS - Executed - %s", user_id)
 
         return {"credit_score": total_score, "code": 200}
 
-    def calculate_borrow_score(self, borrow_sum: float):
-        '''According total borrowing amount it returns borrowing score'''
-
-        logger.info(
-            "UsersUtility - GetCreditScore - CalculateBorrowScore - BorrowSum - {}".format(borrow_sum))
-        if not borrow_sum:
-            borrow_sum = 0
-
-        if borrow_sum in range(0, 101):
-            return 100
-        elif borrow_sum in range(101, 201):
-            return 90
-        elif borrow_sum in range(201, 301):
-            return 80
-        elif borrow_sum in range(301, 401):
-            return 70
-        elif borrow_sum in range(401, 501):
-            return 60
-        elif borrow_sum in range(501, 601):
-            return 50
-        elif borrow_sum in range(601, 701):
-            return 40
-        elif borrow_sum in range(701, 801):
-            return 30
-        elif borrow_sum in range(801, 901):
-            return 20
-        elif borrow_sum in range(901, 1001):
-            return 10
-        elif borrow_sum >= 1001:
-            return 0
-
-    def calculate_lend_score(self, lend_sum: float):
-        '''According total lending amount it returns lending score'''
-
-        logger.info(
-            "UsersUtility - GetCreditScore - CalculateLendScore - LendSum - {}".format(lend_sum))
-        if not lend_sum:
-            lend_sum = 0
-
-        if lend_sum in range(0, 1001):
-            return 0
-        elif lend_sum in range(1001, 1101):
-            return 10
-        elif lend_sum in range(1101, 1201):
-            return 20
-        elif lend_sum in range(1201, 1301):
-            return 30
-        elif lend_sum in range(1301, 1401):
-            return 40
-        elif lend_sum in range(1401, 1501):
-            return 50
-        elif lend_sum in range(1501, 1601):
-            return 60
-        elif lend_sum in range(1601, 1701):
-            return 70
-        elif lend_sum in range(1701, 1801):
-            return 80
-        elif lend_sum in range(1801, 1901):
-            return 90
-        elif lend_sum in range(1901, 2001):
-            return 100
-        elif lend_sum >= 2001:
-            return 100
+    def get_credit_scores(self, user_ids: list):
+        '''
+        Calculate credit scores of many users at once
+
+        Paid totals of all users are read with one query and scored in one
+        batch, so cost grows with the number of distinct users, not queries.
+
+        Parameters:
+        user_ids (list): User ids from Users model
+
+        Returns:
+        Dict: Credit score keyed by user id
+
+        '''
+
+        logger.info(
+            "UsersUtility - GetCreditScores - Invoked - %s", len(user_ids or []))
+        max_batch_size = getattr(
+            settings, "LEDGER_CREDIT_SCORE_BATCH_MAX_SIZE", 1000)
+        if not user_ids or not isinstance(user_ids, list):
+            logger.error(
+                "UsersUtility - GetCreditScores - ERROR - UserIds are blank")
+            return {"message": "Please provide user ids", "code": 400}
+        if len(user_ids) > max_batch_size:
+            logger.error(
+                "UsersUtility - GetCreditScores - ERROR - Too many UserIds")
+            return {"message": "Please provide at most {} user ids".format(max_batch_size), "code": 400}
+
+        parsed_user_ids = {}
+        for user_id in user_ids:
+            try:
+                parsed_user_ids[str(user_id)] = uuid.UUID(str(user_id))
+            except ValueError:
+                logger.error(
+                    "UsersUtility - GetCreditScores - ERROR - Invalid UserId - %s", user_id)
+                return {"message": "Please provide valid user ids", "code": 400}
+
+        with read_from(get_read_database(list(parsed_user_ids.values()))):
+            totals = ShardUtility().get_paid_totals_many(
+                set(parsed_user_ids.values()))
+        user_id_keys = list(parsed_user_ids)
+        user_totals = [totals.get(parsed_user_ids[user_id], (0, 0))
+                       for user_id in user_id_keys]
+        scores = get_credit_score_engine().score_many(
+            [lend_sum for lend_sum, _ in user_totals],
+            [borrow_sum for _, borrow_sum in user_totals])
+
+        logger.info(
+            "UsersUtility - GetCreditScores - SUCCESS - Executed - %s", len(user_id_keys))
+        return {"credit_scores": dict(zip(user_id_keys, scores)), "code": 200}
+
+    def calculate_borrow_score(self, borrow_sum: int):
+        '''According total borrowing amount in minor units it returns borrowing score'''
+
+        logger.debug(
+            "UsersUtility - GetCreditScore - CalculateBorrowScore - BorrowSum - %s", borrow_sum)
+        return get_credit_score_engine().borrow_table.score(borrow_sum)
+
+    def calculate_lend_score(self, lend_sum: int):
+        '''According total lending amount in minor units it returns lending score'''
+
+        logger.debug(
+            "UsersUtility - GetCreditScore - CalculateLendScore - LendSum - %s", lend_sum)
+        return get_credit_score_engine().lend_table.score(lend_sum)
 
 
 class TransactionUtility:
@@ -177,66 +338,436 @@ class TransactionUtility:
         '''
 
         logger.info(
-            "TransactionUtility - GetTransactionsByUserId - Invoked - {}".format(user_id))
+            "TransactionUtility - GetTransactionsByUserId - Invoked - %s", user_id)
         if not user_id:
             logger.error(
                 "TransactionUtility - GetTransactionsByUserId - ERROR - UserId is blank")
             return {"message": "Please provide user id", "code": 400}
 
-        result = []
-
-        transactions_lend = self.get_lend_transactions_by_user_id(
+        rows = self.get_history_rows_by_user_id(
             user_id, "TransactionUtility - GetTransactionsByUserId")
+        result = self.serialize_history_rows(
+            user_id, (row[:-1] for row in rows))
 
-        for transaction in transactions_lend:
-            temp_dict = transaction.__dict__
-            result.append({
-                "transaction_id": str(temp_dict["id"]),
-                "transaction_date": self.format_datetime(
-                    temp_dict["transaction_date"]),
-                "transaction_from": str(
-                    temp_dict["transaction_from_id"]),
-                "transaction_with": str(
-                    temp_dict["transaction_with_id"]),
-                "transaction_status": temp_dict["transaction_status"],
-                "transaction_amount": temp_dict["transaction_amount"],
-                "transaction_type": "lend",
-                "reason": temp_dict["reason"]
-            })
+        if len(result) == 0:
+            logger.error(
+                "TransactionUtility - GetTransactionsByUserId - ERROR - No transaction for given UserId")
+            return {"message": "There is no transactions for given user id", "code": 404}
 
-        transactions_borrow = self.get_borrow_transactions_by_user_id(
-            user_id, "TransactionUtility - GetTransactionsByUserId")
+        logger.info(
+            "TransactionUtility - GetTransactionsByUserId - SUCCESS - Executed %s", user_id)
+        return {"user_id": user_id, "transactions": result, "code": 200}
 
-        for transaction in transactions_borrow:
-            temp_dict = transaction.__dict__
-            result.append({
-                "transaction_id": str(temp_dict["id"]),
-                "transaction_date": self.format_datetime(
-                    temp_dict["transaction_date"]),
-                "transaction_from": str(
-                    temp_dict["transaction_with_id"]),
-                "transaction_with": str(
-                    temp_dict["transaction_from_id"]),
-                "transaction_status": temp_dict["transaction_status"],
-                "transaction_amount": temp_dict["transaction_amount"],
-                "transaction_type": "borrow",
-                "reason": temp_dict["reason"]
-            })
+    async def aget_transactions_by_user_id(self, user_id: str):
+        '''Async get_transactions_by_user_id for ASGI views, cache and DB are read without blocking the event loop'''
+
+        logger.info(
+            "TransactionUtility - AGetTransactionsByUserId - Invoked - %s", user_id)
+        if not user_id:
+            logger.error(
+                "TransactionUtility - AGetTransactionsByUserId - ERROR - UserId is blank")
+            return {"message": "Please provide user id", "code": 400}
+
+        rows = await self.aget_history_rows_by_user_id(
+            user_id, "TransactionUtility - AGetTransactionsByUserId")
+        result = self.serialize_history_rows(
+            user_id, (row[:-1] for row in rows))
 
         if len(result) == 0:
             logger.error(
-                "TransactionUtility - GetTransactionsByUserId - ERROR - No transaction for given UserId")
+                "TransactionUtility - AGetTransactionsByUserId - ERROR - No transaction for given UserId")
             return {"message": "There is no transactions for given user id", "code": 404}
 
         logger.info(
-            "TransactionUtility - GetTransactionsByUserId - SUCCESS - Executed {}".format(user_id))
+            "TransactionUtility - AGetTransactionsByUserId - SUCCESS - Executed %s", user_id)
         return {"user_id": user_id, "transactions": result, "code": 200}
 
+    def export_transactions_by_user_id(self, user_id: str, export_format: str = "ndjson"):
+        '''
+        Exports all the transactions for the user as a stream of NDJSON or CSV lines
+
+        Rows are read with a server side chunked iterator and written as they
+        arrive, so memory use does not depend on the length of the history.
+
+        Parameters:
+        user_id (str): User id from Users model
+        export_format (str): ndjson/csv
+
+        Returns:
+        Dict: Iterator of export chunks and their content type
+
+        '''
+
+        logger.info(
+            "TransactionUtility - ExportTransactionsByUserId - Invoked - %s", user_id)
+        if not user_id:
+            logger.error(
+                "TransactionUtility - ExportTransactionsByUserId - ERROR - UserId is blank")
+            return {"message": "Please provide user id", "code": 400}
+        if export_format not in EXPORT_CONTENT_TYPES:
+            logger.error(
+                "TransactionUtility - ExportTransactionsByUserId - ERROR - Invalid format")
+            return {"message": "Please provide valid format (ndjson/csv)", "code": 400}
+
+        return {
+            "lines": self.iter_export_chunks(user_id, export_format),
+            "content_type": EXPORT_CONTENT_TYPES[export_format],
+            "code": 200
+        }
+
+    async def aexport_transactions_by_user_id(self, user_id: str, export_format: str = "ndjson"):
+        '''Async export_transactions_by_user_id for ASGI views, lines are an async iterator of the same chunks'''
+
+        payload = self.export_transactions_by_user_id(user_id, export_format)
+        if payload["code"] == 200:
+            payload["lines"] = self.aiter_chunks(payload["lines"])
+        return payload
+
+    async def aiter_chunks(self, chunks):
+        '''
+        Yields chunks of a sync export iterator, each one fetched with its own sync_to_async call
+
+        Handing the sync iterator to an ASGI StreamingHttpResponse would read it
+        whole with sync_to_async(list). Every step runs in the thread sensitive
+        executor of the request, the thread that owns the iterator's DB cursor.
+
+        '''
+
+        next_chunk = sync_to_async(next)
+        try:
+            while True:
+                chunk = await next_chunk(chunks, None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            # Stops the DB iterator in its thread when the client disconnects early
+            await sync_to_async(chunks.close)()
+
+    def iter_export_chunks(self, user_id: str, export_format: str):
+        '''Yields transactions of user ordered by (transaction_date, id), one string per chunk of rows'''
+
+        chunk_size = getattr(settings, "LEDGER_EXPORT_CHUNK_SIZE", 2000)
+        if is_sharded():
+            rows = ShardUtility().iter_history_rows(user_id, chunk_size)
+        else:
+            # A generator can not hold read_from across yields, the alias is set on the querysets instead
+            alias = get_read_database([user_id])
+            rows = (row[:-1] for row in heapq.merge(*(
+                self.get_history_branch_queryset(user_id, direction).using(alias).iterator(chunk_size=chunk_size)
+                for direction in TRANSACTION_DIRECTIONS), key=lambda row: (row[-1], row[0].hex)))
+
+        if export_format == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(EXPORT_FIELDS)
+            yield buffer.getvalue()
+
+        count = 0
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            count += len(chunk)
+            transactions = self.serialize_history_rows(
+                user_id, chunk, group_by_direction=False)
+
+            if export_format == "csv":
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                writer.writerows([transaction[field] for field in EXPORT_FIELDS]
+                                 for transaction in transactions)
+                yield buffer.getvalue()
+            else:
+                yield "".join(json.dumps(transaction) + "\n" for transaction in transactions)
+
+        logger.info(
+            "TransactionUtility - ExportTransactionsByUserId - SUCCESS - Executed - %s - %s rows", user_id, count)
+
+    def get_transactions_page(self, user_id: str, page_size=None, cursor: str = None, date_from: str = None, date_to: str = None, transaction_status: str = None, counterparty: str = None, direction: str = None):
+        '''
+        Fetches one page of transactions for the user ordered by (transaction_date, id)
+
+        Pages are located with a keyset condition instead of OFFSET, so every page
+        costs the same as the first one. Lend and borrow transactions are read with
+        two index ordered queries limited to the page size and merged in Python.
+
+        Parameters:
+        user_id (str): User id from Users model
+        page_size (int): Number of transactions per page
+        cursor (str): Opaque cursor returned as next_cursor by the previous page
+        date_from (str): Only transactions on or after this YYYY-MM-DD date
+        date_to (str): Only transactions on or before this YYYY-MM-DD date
+        transaction_status (str): Only transactions with this status (paid/unpaid)
+        counterparty (str): Only transactions with this user id
+        direction (str): Only transactions of this type (lend/borrow)
+
+        Returns:
+        Dict: Page of transactions and cursor of the next page (null on last page)
+
+        '''
+
+        logger.info(
+            "TransactionUtility - GetTransactionsPage - Invoked - %s", user_id)
+        if not user_id:
+            logger.error(
+                "TransactionUtility - GetTransactionsPage - ERROR - UserId is blank")
+            return {"message": "Please provide user id", "code": 400}
+
+        max_page_size = getattr(
+            settings, "LEDGER_TRANSACTIONS_MAX_PAGE_SIZE", 500)
+        if page_size is None:
+            page_size = getattr(settings, "LEDGER_TRANSACTIONS_PAGE_SIZE", 50)
+        try:
+            page_size = int(page_size)
+        except (TypeError, ValueError):
+            page_size = 0
+        if page_size <= 0 or page_size > max_page_size:
+            logger.error(
+                "TransactionUtility - GetTransactionsPage - ERROR - Invalid page size")
+            return {"message": "Page size should be between 1 and {}".format(max_page_size), "code": 400}
+
+        filters = Q()
+        if cursor:
+            position = self.decode_cursor(cursor)
+            if not position:
+                logger.error(
+                    "TransactionUtility - GetTransactionsPage - ERROR - Invalid cursor")
+                return {"message": "Please provide valid cursor", "code": 400}
+            filters &= Q(transaction_date__gt=position[0]) | Q(
+                transaction_date=position[0], id__gt=position[1])
+        if date_from:
+            date_from_obj = self.parse_date(date_from)
+            if not date_from_obj:
+                logger.error(
+                    "TransactionUtility - GetTransactionsPage - ERROR - Invalid date from")
+                return {"message": "Please provide date from in YYYY-MM-DD format", "code": 400}
+            filters &= Q(transaction_date__gte=date_from_obj)
+        if date_to:
+            date_to_obj = self.parse_date(date_to)
+            if not date_to_obj:
+                logger.error(
+                    "TransactionUtility - GetTransactionsPage - ERROR - Invalid date to")
+                return {"message": "Please provide date to in YYYY-MM-DD format", "code": 400}
+            filters &= Q(transaction_date__lt=date_to_obj + timedelta(days=1))
+        if transaction_status:
+            if transaction_status not in dict(TRANSACTION_STATUS_CHOICES):
+                logger.error(
+                    "TransactionUtility - GetTransactionsPage - ERROR - Invalid transaction status")
+                return {"message": "Please provide valid transaction status", "code": 400}
+            filters &= Q(transaction_status=transaction_status)
+        if counterparty:
+            try:
+                counterparty = uuid.UUID(str(counterparty))
+            except ValueError:
+                logger.error(
+                    "TransactionUtility - GetTransactionsPage - ERROR - Invalid counterparty")
+                return {"message": "Please provide valid counterparty user id", "code": 400}
+        if direction and direction not in TRANSACTION_DIRECTIONS:
+            logger.error(
+                "TransactionUtility - GetTransactionsPage - ERROR - Invalid direction")
+            return {"message": "Please provide valid direction (lend/borrow)", "code": 400}
+
+        branches = []
+        with read_from(get_read_database([user_id])):
+            for branch_direction in TRANSACTION_DIRECTIONS:
+                if direction and direction != branch_direction:
+                    continue
+                queryset = self.get_history_branch_queryset(
+                    user_id, branch_direction, counterparty).filter(filters)
+                if not is_sharded():
+                    branches.append(list(queryset[:page_size + 1]))
+                elif branch_direction == "lend":
+                    # Lent transactions are all on the home shard of the lender
+                    with on_shard(ShardUtility().get_home_shard(user_id)):
+                        branches.append(list(queryset[:page_size + 1]))
+                else:
+                    branches.extend(fan_out(
+                        lambda alias: list(queryset[:page_size + 1]), get_shards()))
+
+        rows = list(heapq.merge(
+            *branches, key=lambda row: (row[-1], row[0].hex)))[:page_size + 1]
+
+        next_cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursor = self.encode_cursor(rows[-1][-1], rows[-1][0])
+
+        result = self.serialize_history_rows(
+            user_id, [row[:-1] for row in rows], group_by_direction=False)
+
+        logger.info(
+            "TransactionUtility - GetTransactionsPage - SUCCESS - Executed %s", user_id)
+        return {"user_id": user_id, "transactions": result, "next_cursor": next_cursor, "code": 200}
+
+    def get_history_branch_queryset(self, user_id: str, direction: str, counterparty: uuid.UUID = None):
+        '''
+        Returns lend or borrow transactions of user ordered by (transaction_date, id)
+
+        Parameters:
+        user_id (str): User id from Users model
+        direction (str): lend/borrow
+        counterparty (UUID): Optional user id of the other party
+
+        Returns:
+        Queryset: Values list of HISTORY_FIELDS followed by transaction_date
+
+        '''
+
+        if direction == "lend":
+            user_field, counterparty_field = "transaction_from_id", "transaction_with_id"
+        else:
+            user_field, counterparty_field = "transaction_with_id", "transaction_from_id"
+
+        queryset = Transactions.objects.filter(**{user_field: user_id})
+        if counterparty:
+            queryset = queryset.filter(**{counterparty_field: counterparty})
+
+        return queryset.annotate(
+            date_str=Cast(TruncDate("transaction_date"),
+                          output_field=models.CharField()),
+            counterparty=F(counterparty_field),
+            direction=Value(direction, output_field=models.CharField()),
+        ).order_by("transaction_date", "id").values_list(*HISTORY_FIELDS, "transaction_date")
+
+    def encode_cursor(self, transaction_date: datetime, transaction_id: uuid.UUID):
+        '''Returns opaque pagination cursor for position (transaction_date, id)'''
+
+        position = "{}|{}".format(
+            transaction_date.isoformat(), transaction_id.hex)
+        return base64.urlsafe_b64encode(position.encode()).decode()
+
+    def decode_cursor(self, cursor: str):
+        '''Returns (transaction_date, id) position from cursor, None if cursor is invalid'''
+
+        try:
+            date_str, id_hex = base64.urlsafe_b64decode(
+                cursor.encode()).decode().split("|")
+            return datetime.fromisoformat(date_str), uuid.UUID(hex=id_hex)
+        except (AttributeError, TypeError, ValueError):
+            return None
+
+    def get_history_querysets(self, user_id: str):
+        '''
+        Returns lend and borrow transactions of user as two projections, lend first
+
+        Each direction is ordered by (transaction_date, id) and read in that
+        order from its (party, transaction_date, id) index, so neither query
+        sorts the history. A single OR query of both parties would read two
+        indexes and sort their union, so the history takes two queries.
+        Direction, counterparty and date string are computed by the database
+        so rows can be serialized without instantiating Transactions models.
+
+        Parameters:
+        user_id (str): User id from Users model
+
+        Returns:
+        List: Values lists of HISTORY_FIELDS followed by transaction_date
+
+        '''
+
+        return [self.get_history_branch_queryset(user_id, direction) for direction in TRANSACTION_DIRECTIONS]
+
+    def get_history_rows_by_user_id(self, user_id: str, parent_util_function: str):
+        '''
+        Returns flat transaction history rows of user, cached
+
+        Parameters:
+        user_id (str): User id from Users model
+        parent_util_function (str): From which parent function this function called
+
+        Returns:
+        List: Tuples in HISTORY_FIELDS order followed by transaction_date
+
+        '''
+
+        logger.info(
+            "%s - GetHistoryRowsByUserId - Invoked - %s", parent_util_function, user_id)
+
+        with read_from(get_read_database([user_id])):
+            rows = LedgerCache().get_or_compute(
+                "trans_history", user_id, lambda: ShardUtility().get_history_rows(user_id) if is_sharded() else [
+                    row for queryset in self.get_history_querysets(user_id) for row in queryset],
+                CACHE_TTL, ROW_CODEC)
+        logger.info(
+            "%s - GetHistoryRowsByUserId - Executed - %s", parent_util_function, user_id)
+
+        return rows
+
+    async def aget_history_rows_by_user_id(self, user_id: str, parent_util_function: str):
+        '''Async get_history_rows_by_user_id, a miss iterates the history with the async ORM'''
+
+        logger.info(
+            "%s - AGetHistoryRowsByUserId - Invoked - %s", parent_util_function, user_id)
+
+        async def compute():
+            if is_sharded():
+                return await sync_to_async(ShardUtility().get_history_rows, thread_sensitive=False)(user_id)
+            return [row for queryset in self.get_history_querysets(user_id) async for row in queryset]
+
+        with read_from(await aget_read_database([user_id])):
+            rows = await LedgerCache().aget_or_compute(
+                "trans_history", user_id, compute, CACHE_TTL, ROW_CODEC)
+        logger.info(
+            "%s - AGetHistoryRowsByUserId - Executed - %s", parent_util_function, user_id)
+
+        return rows
+
+    def serialize_history_rows(self, user_id: str, rows, group_by_direction: bool = True):
+        '''
+        Serializes history rows to response dicts in a single pass
+
+        When grouped by direction, lend transactions are listed before borrow
+        transactions, otherwise rows keep the order they are given in.
+
+        Parameters:
+        user_id (str): User id from Users model
+        rows (iterable): Tuples in HISTORY_FIELDS order
+        group_by_direction (bool): List lend transactions before borrow transactions
+
+        Returns:
+        List: Transaction dicts
+
+        '''
+
+        user_str = str(uuid.UUID(str(user_id)))
+        counterparties = {}
+        lend = []
+        borrow = lend if not group_by_direction else []
+
+        for transaction_id, date_str, counterparty, status, amount, direction, reason in rows:
+            counterparty_str = counterparties.get(counterparty)
+            if counterparty_str is None:
+                counterparty_str = counterparties[counterparty] = str(
+                    counterparty)
+            (lend if direction == "lend" else borrow).append({
+                "transaction_id": str(transaction_id),
+                "transaction_date": date_str,
+                "transaction_from": user_str,
+                "transaction_with": counterparty_str,
+                "transaction_status": status,
+                "transaction_amount": to_major_units(amount),
+                "transaction_type": direction,
+                "reason": reason
+            })
+
+        if borrow is not lend:
+            lend.extend(borrow)
+        return lend
+
     def format_datetime(self, datetime_obj: datetime):
         '''Format datetime object to YYYY-MM-DD string format'''
 
         return datetime_obj.strftime("%Y-%m-%d")
 
+    def parse_date(self, date_str: str):
+        '''Returns datetime obj from string date format YYYY-MM-DD, None if date is invalid'''
+
+        try:
+            return datetime.strptime(date_str, "%Y-%m-%d")
+        except (TypeError, ValueError):
+            return None
+
     def get_datetime_obj(self, date_str: str):
         '''Returns datetime obj from string date format YYYY-MM-DD'''
 
@@ -253,7 +784,7 @@ class TransactionUtility:
         Parameters:
         transaction_from (str): User responsible for transaction
         transaction_with (str): With whom transaction is done
-        amount (float): Transaction amount(negative, positive)
+        amount (float): Transaction amount in major units, at most 2 decimal places
         transaction_type (str): It can be lend/borrow
         status (str): Status of transaction like paid/unpaid
         transaction_date (str): Date and time of transaction
@@ -266,111 +797,334 @@ class TransactionUtility:
 
         logger.info("TransactionUtility - AddTransaction - Invoked")
 
+        error = self.validate_transaction(
+            transaction_from, transaction_with, amount, transaction_type, status, "TransactionUtility - AddTransaction")
+        if error:
+            return error
+
+        try:
+            user_ids = {uuid.UUID(str(transaction_from)),
+                        uuid.UUID(str(transaction_with))}
+        except ValueError:
+            user_ids = set()
+        found_user_ids = ShardUtility().find_user_ids(user_ids)
+
+        if not self.is_user_found(transaction_from, found_user_ids):
+            logger.error(
+                "TransactionUtility - AddTransaction - ERROR - Transaction FROM user does not exists in DB")
+            return {"message": "Transaction From User does not exist", "code": 404}
+        if not self.is_user_found(transaction_with, found_user_ids):
+            logger.error(
+                "TransactionUtility - AddTransaction - ERROR - Transaction WITH user does not exists in DB")
+            return {"message": "Transaction With User does not exist", "code": 404}
+
+        if transaction_type == "borrow":
+            lender_id, borrower_id = transaction_with, transaction_from
+        else:
+            lender_id, borrower_id = transaction_from, transaction_with
+        amount = to_minor_units(amount)
+
+        # Stored on the lender's shard, None if the ledger is not sharded
+        alias = ShardUtility().get_home_shard(lender_id)
+        try:
+            with db_transaction.atomic(using=alias), on_shard(alias):
+                logger.debug(
+                    "TransactionUtility - AddTransaction - %s - Create Transaction", transaction_type.capitalize())
+                ShardUtility().ensure_shadow_users(alias, [borrower_id])
+                transaction = Transactions.objects.create(
+                    transaction_from_id=lender_id,
+                    transaction_with_id=borrower_id,
+                    transaction_amount=amount,
+                    transaction_status=status,
+                    transaction_date=self.get_datetime_obj(transaction_date),
+                    reason=reason
+                )
+
+                logger.debug(
+                    "TransactionUtility - AddTransaction - Update Aggregates And Balances")
+                transfer_ids = ShardUtility().apply_deltas(
+                    alias, AggregatesUtility().get_transaction_deltas(
+                        lender_id, borrower_id, amount, status),
+                    {lender_id: -amount, borrower_id: amount} if status == "paid" else {}, create_missing=True)
+
+                db_transaction.on_commit(lambda: self.on_write_committed(
+                    [transaction.id], [lender_id, borrower_id], "TransactionUtility - AddTransaction",
+                    alias, transfer_ids), using=alias)
+
+            logger.info(
+                "TransactionUtility - AddTransaction - SUCCESS - Executed")
+            return {"message": "Transaction successfully added - {}".format(transaction.id), "code": 200}
+
+        except Exception as e:
+            logger.error(
+                "TransactionUtility - AddTransaction - ERROR - Exception - %s", e)
+            return {"message": "Error occured while adding transaction", "code": 500}
+
+    def add_transactions(self, transactions: list):
+        '''
+        Adds batch of transactions in database
+
+        All transactions are validated and their users fetched with one query
+        before anything is written. The batch is then inserted with bulk_create
+        and every affected user's summed balance and aggregate deltas are applied
+        with one statement, all in a single DB transaction. If any transaction is
+        invalid nothing is added.
+
+        Parameters:
+        transactions (list): Dicts with the add_transaction parameters (transaction_from, transaction_with, transaction_amount, transaction_type, transaction_status, transaction_date, reason)
+
+        Returns:
+        Dict: Result of create transactions operation with result of every transaction
+
+        '''
+
+        logger.info("TransactionUtility - AddTransactions - Invoked")
+
+        max_batch_size = getattr(settings, "LEDGER_BATCH_MAX_SIZE", 1000)
+        if not transactions or not isinstance(transactions, list):
+            logger.error(
+                "TransactionUtility - AddTransactions - ERROR - Transactions are blank")
+            return {"message": "Please provide transactions", "code": 400}
+        if len(transactions) > max_batch_size:
+            logger.error(
+                "TransactionUtility - AddTransactions - ERROR - Too many transactions")
+            return {"message": "Please provide at most {} transactions".format(max_batch_size), "code": 400}
+
+        results = []
+        user_ids = set()
+        for item in transactions:
+            if not isinstance(item, dict):
+                results.append(
+                    {"message": "Please provide transaction details", "code": 400})
+                continue
+            result = self.validate_transaction(
+                item.get("transaction_from"), item.get("transaction_with"), item.get("transaction_amount"),
+                item.get("transaction_type"), item.get("transaction_status"), "TransactionUtility - AddTransactions")
+            if not result:
+                try:
+                    user_ids.add(uuid.UUID(str(item["transaction_from"])))
+                    user_ids.add(uuid.UUID(str(item["transaction_with"])))
+                except ValueError:
+                    pass
+            results.append(result)
+
+        found_user_ids = ShardUtility().find_user_ids(user_ids)
+
+        for index, item in enumerate(transactions):
+            if results[index]:
+                continue
+            if not self.is_user_found(item["transaction_from"], found_user_ids):
+                results[index] = {
+                    "message": "Transaction From User does not exist", "code": 404}
+            elif not self.is_user_found(item["transaction_with"], found_user_ids):
+                results[index] = {
+                    "message": "Transaction With User does not exist", "code": 404}
+
+        if any(results):
+            logger.error(
+                "TransactionUtility - AddTransactions - ERROR - Batch has invalid transactions")
+            return {
+                "message": "No transactions added, please fix invalid transactions",
+                "results": [result or {"message": "Transaction is valid", "code": 200} for result in results],
+                "code": 400
+            }
+
+        new_transactions = []
+        # Written per lender shard, a single group keyed None if the ledger is not sharded
+        groups = {}
+        for item in transactions:
+            lender_id, borrower_id = str(uuid.UUID(str(item["transaction_from"]))), str(
+                uuid.UUID(str(item["transaction_with"])))
+            if item["transaction_type"] == "borrow":
+                lender_id, borrower_id = borrower_id, lender_id
+            amount = to_minor_units(item["transaction_amount"])
+            status = item["transaction_status"]
+
+            transaction = Transactions(
+                transaction_from_id=lender_id,
+                transaction_with_id=borrower_id,
+                transaction_amount=amount,
+                transaction_status=status,
+                transaction_date=self.get_datetime_obj(
+                    item.get("transaction_date")),
+                reason=item.get("reason")
+            )
+            new_transactions.append(transaction)
+            group = groups.setdefault(ShardUtility().get_home_shard(lender_id), {
+                "transactions": [], "aggregate_deltas": {}, "balance_deltas": {}})
+            group["transactions"].append(transaction)
+            aggregate_deltas = group["aggregate_deltas"]
+            balance_deltas = group["balance_deltas"]
+
+            for user_id, side in ((lender_id, "lent"), (borrower_id, "borrowed")):
+                fields = aggregate_deltas.setdefault(user_id, {})
+                total_field = "{}_{}_total".format(status, side)
+                count_field = "{}_{}_count".format(status, side)
+                fields[total_field] = fields.get(total_field, 0) + amount
+                fields[count_field] = fields.get(count_field, 0) + 1
+
+            if status == "paid":
+                balance_deltas[lender_id] = balance_deltas.get(
+                    lender_id, 0) - amount
+                balance_deltas[borrower_id] = balance_deltas.get(
+                    borrower_id, 0) + amount
+
+        try:
+            # Groups of several lender shards commit one after another, the batch was validated before
+            for alias, group in groups.items():
+                with db_transaction.atomic(using=alias), on_shard(alias):
+                    logger.debug(
+                        "TransactionUtility - AddTransactions - Create %s Transactions", len(group["transactions"]))
+                    ShardUtility().ensure_shadow_users(alias, {
+                        transaction.transaction_with_id for transaction in group["transactions"]})
+                    Transactions.objects.bulk_create(
+                        group["transactions"], batch_size=BULK_BATCH_SIZE)
+
+                    logger.debug(
+                        "TransactionUtility - AddTransactions - Update Users Balance")
+                    transfer_ids = ShardUtility().apply_deltas(
+                        alias, group["aggregate_deltas"], group["balance_deltas"], create_missing=True)
+
+                    db_transaction.on_commit(lambda group=group, alias=alias, transfer_ids=transfer_ids: self.on_write_committed(
+                        [transaction.id for transaction in group["transactions"]], list(
+                            group["aggregate_deltas"]),
+                        "TransactionUtility - AddTransactions", alias, transfer_ids), using=alias)
+        except Exception as e:
+            logger.error(
+                "TransactionUtility - AddTransactions - ERROR - Exception - %s", e)
+            return {"message": "Error occured while adding transactions", "code": 500}
+
+        logger.info(
+            "TransactionUtility - AddTransactions - SUCCESS - Executed - %s", len(new_transactions))
+        return {
+            "message": "Transactions successfully added - {}".format(len(new_transactions)),
+            "results": [{"message": "Transaction successfully added - {}".format(transaction.id), "code": 200}
+                        for transaction in new_transactions],
+            "code": 200
+        }
+
+    def validate_transaction(self, transaction_from: str, transaction_with: str, amount: float, transaction_type: str, status: str, parent_util_function: str):
+        '''
+        Validates transaction parameters that do not need a DB lookup
+
+        Parameters:
+        transaction_from (str): User responsible for transaction
+        transaction_with (str): With whom transaction is done
+        amount (float): Transaction amount in major units
+        transaction_type (str): It can be lend/borrow
+        status (str): Status of transaction like paid/unpaid
+        parent_util_function (str): From which parent function this function called
+
+        Returns:
+        Dict: Error details, None if transaction is valid
+
+        '''
+
         if not transaction_from:
             logger.error(
-                "TransactionUtility - AddTransaction - ERROR - Transaction FROM UserID is blank")
+                "%s - ERROR - Transaction FROM UserID is blank", parent_util_function)
             return {"message": "Please provide transaction from user id", "code": 400}
         if not transaction_with:
             logger.error(
-                "TransactionUtility - AddTransaction - ERROR - Transaction WITH UserID is blank")
+                "%s - ERROR - Transaction WITH UserID is blank", parent_util_function)
             return {"message": "Please provide transaction with user id", "code": 400}
         if not amount:
             logger.error(
-                "TransactionUtility - AddTransaction - ERROR - Transaction amount is blank")
+                "%s - ERROR - Transaction amount is blank", parent_util_function)
             return {"message": "Please provide transaction amount", "code": 400}
         if not transaction_type:
             logger.error(
-                "TransactionUtility - AddTransaction - ERROR - Transaction type is blank")
+                "%s - ERROR - Transaction type is blank", parent_util_function)
             return {"message": "Please provide transaction type", "code": 400}
         if not status:
             logger.error(
-                "TransactionUtility - AddTransaction - ERROR - Transaction status is blank")
+                "%s - ERROR - Transaction status is blank", parent_util_function)
             return {"message": "Please provide transaction status", "code": 400}
-        if amount <= 0:
+        if status not in dict(TRANSACTION_STATUS_CHOICES):
+            logger.error(
+                "%s - ERROR - Transaction status is invalid", parent_util_function)
+            return {"message": "Please provide valid transaction status", "code": 400}
+        if isinstance(amount, bool) or not isinstance(amount, (int, float)) or amount <= 0:
             logger.error(
-                "TransactionUtility - AddTransaction - ERROR - Transaction amount is negative/zero")
+                "%s - ERROR - Transaction amount is negative/zero", parent_util_function)
             return {"message": "Please provide postive non-zero transaction amount", "code": 400}
-        if transaction_from == transaction_with:
+        if to_minor_units(amount) is None:
             logger.error(
-                "TransactionUtility - AddTransaction - ERROR - Transaction from user and transaction with user are same")
+                "%s - ERROR - Transaction amount is not a whole number of cents", parent_util_function)
+            return {"message": "Please provide transaction amount with at most 2 decimal places", "code": 400}
+        # Every spelling of the same UUID is the same user
+        if normalize_user_id(transaction_from) == normalize_user_id(transaction_with):
+            logger.error(
+                "%s - ERROR - Transaction from user and transaction with user are same", parent_util_function)
             return {"message": "The transaction can not be placed between the same users", "code": 400}
 
+        return None
 
-        try:
-            transaction_from_user = Users.objects.get(id=transaction_from)
-        except Users.DoesNotExist:
-            logger.error(
-                "TransactionUtility - AddTransaction - ERROR - Transaction FROM user does not exists in DB")
-            return {"message": "Transaction From User does not exist", "code": 404}
+    def is_user_found(self, user_id: str, found_user_ids: set):
+        '''Returns True if user id string is one of found user ids'''
 
         try:
-            transaction_with_user = Users.objects.get(id=transaction_with)
-        except Users.DoesNotExist:
-            logger.error(
-                "TransactionUtility - AddTransaction - ERROR - Transaction WITH user does not exists in DB")
-            return {"message": "Transaction With User does not exist", "code": 404}
+            return uuid.UUID(str(user_id)) in found_user_ids
+        except ValueError:
+            return False
 
-        try:
-            if transaction_type == "borrow":
-                logger.info(
-                    "TransactionUtility - AddTransaction - Borrow - Create Transaction")
-                transaction = Transactions.objects.create(
-                    transaction_from=transaction_with_user,
-                    transaction_with=transaction_from_user,
-                    transaction_amount=amount,
-                    transaction_status=status,
-                    transaction_date=self.get_datetime_obj(transaction_date),
-                    reason=reason
-                )
-                self.delete_transaction_cache(
-                    [transaction_from_user.id, transaction_with_user.id], "TransactionUtility - AddTransaction")
+    def apply_balance_deltas(self, deltas: dict):
+        '''
+        Adds amounts to balances of several users with a single UPDATE statement
 
-                if status == "paid":
-                    logger.info(
-                        "TransactionUtility - AddTransaction - Borrow x Paid - Update Users Balance")
-                    transaction_with_user.balance = transaction_with_user.balance - amount
-                    transaction_with_user.save()
+        The increment is evaluated by the database, so concurrent writers can not
+        lose each other's updates, and all rows are locked by one statement in
+        index order, so transfers in opposite directions can not deadlock.
 
-                    transaction_from_user.balance = transaction_from_user.balance + amount
-                    transaction_from_user.save()
-            else:
-                logger.info(
-                    "TransactionUtility - AddTransaction - Lend - Create Transaction")
-                transaction = Transactions.objects.create(
-                    transaction_from=transaction_from_user,
-                    transaction_with=transaction_with_user,
-                    transaction_amount=amount,
-                    transaction_status=status,
-                    transaction_date=self.get_datetime_obj(transaction_date),
-                    reason=reason
-                )
-                self.delete_transaction_cache(
-                    [transaction_from_user.id, transaction_with_user.id], "TransactionUtility - AddTransaction")
+        Parameters:
+        deltas (dict): Balance delta in minor units keyed by user id
 
-                if status == "paid":
-                    logger.info(
-                        "TransactionUtility - AddTransaction - Lend x Paid - Update Users Balance")
-                    transaction_with_user.balance = transaction_with_user.balance + amount
-                    transaction_with_user.save()
+        '''
 
-                    transaction_from_user.balance = transaction_from_user.balance - amount
-                    transaction_from_user.save()
+        if not deltas:
+            return
 
-            logger.info(
-                "TransactionUtility - AddTransaction - SUCCESS - Executed")
-            return {"message": "Transaction successfully added - {}".format(transaction.id), "code": 200}
+        items = list(deltas.items())
+        for start in range(0, len(items), BULK_BATCH_SIZE):
+            chunk = items[start:start + BULK_BATCH_SIZE]
+            Users.objects.filter(id__in=[user_id for user_id, _ in chunk]).update(balance=F("balance") + Case(
+                *[When(id=user_id, then=Value(delta))
+                  for user_id, delta in chunk],
+                default=Value(0),
+                output_field=models.BigIntegerField()))
 
-        except Exception as e:
-            logger.error(
-                "TransactionUtility - AddTransaction - ERROR - Exception - {}".format(e))
-            return {"message": "Error occured while adding transaction", "code": 500}
+    def recompute_balances(self):
+        '''
+        Recomputes balance of every user from paid Transactions, used after bulk loads that bypass add_transaction
+
+        Returns:
+        Int: Number of users with non-zero balance
+
+        '''
+
+        logger.info("TransactionUtility - RecomputeBalances - Invoked")
+        balances = {}
+        for party_field, sign in (("transaction_from", -1), ("transaction_with", 1)):
+            rows = Transactions.objects.filter(transaction_status="paid").values_list(
+                party_field).annotate(total=Sum("transaction_amount")).order_by()
+            for user_id, total in rows:
+                balances[user_id] = balances.get(user_id, 0) + sign * total
 
-    def mark_transaction_paid(self, transaction_id: str):
+        with db_transaction.atomic():
+            Users.objects.exclude(balance=0).update(balance=0)
+            self.apply_balance_deltas(balances)
+
+        logger.info(
+            "TransactionUtility - RecomputeBalances - SUCCESS - Executed - %s", len(balances))
+        return len(balances)
+
+    def mark_transaction_paid(self, transaction_id: str, user_id: str = None):
         '''
         Changes transacrtion status to paid
 
         Parameters:
         transaction_id (str): Transaction id from Transactions model
+        user_id (str): User id of the token of the request, only a party of the transaction may mark it paid
 
         Returns:
         Dict: Result of update transaction status
@@ -378,48 +1132,62 @@ class TransactionUtility:
         '''
 
         logger.info(
-            "TransactionUtility - MarkTransactionPaid - Invoked - {}".format(transaction_id))
+            "TransactionUtility - MarkTransactionPaid - Invoked - %s", transaction_id)
         if not transaction_id:
             logger.error(
                 "TransactionUtility - MarkTransactionPaid - ERROR - TransactionId is blank")
             return {"message": "Please provide transaction id", "code": 400}
 
+        fields = ("transaction_from_id", "transaction_with_id",
+                  "transaction_amount", "transaction_status")
+        alias = None
         try:
-            transaction = Transactions.objects.get(
-                id=transaction_id)
-        except Transactions.DoesNotExist:
+            if is_sharded():
+                alias, transaction = ShardUtility().find_transaction(transaction_id, fields)
+            else:
+                transaction = Transactions.objects.filter(
+                    id=transaction_id).values_list(*fields).first()
+        except ValidationError:
+            transaction = None
+        if not transaction:
             logger.error(
                 "TransactionUtility - MarkTransactionPaid - ERROR - Exception - TransactionId does not exists in DB")
             return {"message": "Given transaction id does not exists", "code": 404}
 
-        try:
-            logger.info(
-                "TransactionUtility - MarkTransactionPaid - Update transaction status to paid")
-            transaction.transaction_status = "paid"
-            transaction.save()
-
-            transaction_from_user = transaction.transaction_from
-            transaction_with_user = transaction.transaction_with
-
-            self.delete_transaction_cache(
-                [transaction_from_user.id, transaction_with_user.id], "TransactionUtility - MarkTransactionPaid")
-
-            logger.info(
-                "TransactionUtility - MarkTransactionPaid - Update Users Balance")
-            transaction_with_user.balance = transaction_with_user.balance + \
-                transaction.transaction_amount
-            transaction_with_user.save()
+        lender_id, borrower_id, amount, transaction_status = transaction
+        if user_id is not None and not TokenUtility().is_party(user_id, (lender_id, borrower_id)):
+            logger.error(
+                "TransactionUtility - MarkTransactionPaid - ERROR - User is not a party of the transaction - %s", user_id)
+            return {"message": "You are not allowed to access this transaction", "code": 403}
 
-            transaction_from_user.balance = transaction_from_user.balance - \
-                transaction.transaction_amount
-            transaction_from_user.save()
+        try:
+            with db_transaction.atomic(using=alias), on_shard(alias):
+                logger.debug(
+                    "TransactionUtility - MarkTransactionPaid - Update transaction status to paid")
+                # Only the writer that flips unpaid to paid applies the balance change
+                updated = transaction_status != "paid" and Transactions.objects.filter(
+                    id=transaction_id, transaction_status="unpaid").update(transaction_status="paid")
+
+                if updated:
+                    logger.debug(
+                        "TransactionUtility - MarkTransactionPaid - Update Users Balance")
+                    transfer_ids = ShardUtility().apply_deltas(
+                        alias, AggregatesUtility().get_paid_deltas(lender_id, borrower_id, amount),
+                        {lender_id: -amount, borrower_id: amount})
+
+                    db_transaction.on_commit(lambda: self.on_write_committed(
+                        [transaction_id], [lender_id, borrower_id], "TransactionUtility - MarkTransactionPaid",
+                        alias, transfer_ids), using=alias)
+                else:
+                    logger.info(
+                        "TransactionUtility - MarkTransactionPaid - Transaction is already paid - %s", transaction_id)
 
             logger.info(
-                "TransactionUtility - MarkTransactionPaid - SUCCESS - Executed - {}".format(transaction_id))
+                "TransactionUtility - MarkTransactionPaid - SUCCESS - Executed - %s", transaction_id)
             return {"message": "Transaction successfully updated - {}".format(transaction_id), "code": 200}
         except Exception as e:
             logger.error(
-                "TransactionUtility - MarkTransactionPaid - ERROR - Exception - {}".format(e))
+                "TransactionUtility - MarkTransactionPaid - ERROR - Exception - %s", e)
             return {"message": "Error occured while updating transaction", "code": 500}
 
     def get_lend_transactions_by_user_id(self, user_id: str, parent_util_function: str):
@@ -431,29 +1199,21 @@ class TransactionUtility:
         parent_util_function (str): From which parent function this function called
 
         Returns:
-        Queryset: All lend transactions for given user id
+        List: All lend transactions for given user id
 
         '''
 
         logger.info(
-            "{} - GetLendTransactionsByUserId - Invoked - {}".format(parent_util_function, user_id))
-
-        transactions_lend = cache.get("trans_lend_user_id_{}".format(user_id))
-        logger.info(
-            "{} - GetLendTransactionsByUserId - Cache - GET".format(parent_util_function))
+            "%s - GetLendTransactionsByUserId - Invoked - %s", parent_util_function, user_id)
 
-        if not transactions_lend:
-            logger.info(
-                "{} - GetLendTransactionsByUserId - Cache - MISS".format(parent_util_function))
-            transactions_lend = Transactions.objects.filter(
-                transaction_from__id=user_id)
-            cache.set("trans_lend_user_id_{}".format(
-                user_id), transactions_lend, CACHE_TTL)
-            logger.info(
-                "{} - GetLendTransactionsByUserId - Cache - SET".format(parent_util_function))
+        rows = LedgerCache().get_or_compute(
+            "trans_lend", user_id, lambda: list(Transactions.objects.filter(
+                transaction_from__id=user_id).values_list(*TRANSACTION_ROW_FIELDS)), CACHE_TTL, ROW_CODEC)
+        transactions_lend = [Transactions.from_db(
+            None, TRANSACTION_ROW_FIELDS, row) for row in rows]
 
         logger.info(
-            "{} - GetLendTransactionsByUserId - Executed - {}".format(parent_util_function, user_id))
+            "%s - GetLendTransactionsByUserId - Executed - %s", parent_util_function, user_id)
 
         return transactions_lend
 
@@ -466,42 +1226,588 @@ class TransactionUtility:
         parent_util_function (str): From which parent function this function called
 
         Returns:
-        Queryset: All borrow transactions for given user id
+        List: All borrow transactions for given user id
 
         '''
 
         logger.info(
-            "{} - GetBorrowTransactionsByUserId - Invoked - {}".format(parent_util_function, user_id))
+            "%s - GetBorrowTransactionsByUserId - Invoked - %s", parent_util_function, user_id)
+
+        rows = LedgerCache().get_or_compute(
+            "trans_borrow", user_id, lambda: list(Transactions.objects.filter(
+                transaction_with__id=user_id).values_list(*TRANSACTION_ROW_FIELDS)), CACHE_TTL, ROW_CODEC)
+        transactions_borrow = [Transactions.from_db(
+            None, TRANSACTION_ROW_FIELDS, row) for row in rows]
 
-        transactions_borrow = cache.get(
-            "trans_borrow_user_id_{}".format(user_id))
         logger.info(
-            "{} - GetBorrowTransactionsByUserId - Cache - GET".format(parent_util_function))
+            "%s - GetBorrowTransactionsByUserId - Executed - %s", parent_util_function, user_id)
 
-        if not transactions_borrow:
-            logger.info(
-                "{} - GetBorrowTransactionsByUserId - Cache - MISS".format(parent_util_function))
-            print("cache miss")
-            transactions_borrow = Transactions.objects.filter(
-                transaction_with__id=user_id)
-            cache.set("trans_borrow_user_id_{}".format(
-                user_id), transactions_borrow, CACHE_TTL)
-            logger.info(
-                "{} - GetBorrowTransactionsByUserId - Cache - SET".format(parent_util_function))
+        return transactions_borrow
+
+    def on_write_committed(self, transaction_ids: list, user_ids: list, parent_util_function: str,
+                           alias: str = None, transfer_ids: list = ()):
+        '''
+        Finishes a committed write
+
+        Applies the shard transfers of the write, pins reads of both
+        counterparties to the primary and refreshes their cache.
+
+        '''
+
+        if transfer_ids:
+            ShardUtility().apply_transfers(alias, transfer_ids)
+        pin_to_primary(user_ids)
+        if is_sharded():
+            # Write-through reads the rows back from default only, sharded writes invalidate instead
+            return self.delete_transaction_cache(user_ids, parent_util_function)
+        self.refresh_transaction_cache(
+            transaction_ids, user_ids, parent_util_function)
+
+    def refresh_transaction_cache(self, transaction_ids: list, user_ids: list, parent_util_function: str):
+        '''
+        Writes committed transactions through to the cached entries of their users
+
+        Called after commit, so nothing is published for a rolled back write.
+        The transactions are read back with one query and upserted by id into
+        the cached history, lend and borrow rows of both counterparties in one
+        batch, so the reads that follow a write are cache hits. Without
+        write-through, for writes touching more than
+        LEDGER_CACHE_WRITE_THROUGH_MAX_USERS users, or if an entry can not be
+        updated safely, the users' caches are invalidated.
+
+        Parameters:
+        transaction_ids (list): Ids of added or updated transactions
+        user_ids (list): User ids of both counterparties of the transactions
+        parent_util_function (str): From which parent function this function called
+
+        '''
+
+        if not getattr(settings, "LEDGER_CACHE_WRITE_THROUGH", True):
+            return self.delete_transaction_cache(user_ids, parent_util_function)
+        # Bulk writes invalidate with one set_many, the users' next reads rebuild their entries lazily
+        if len(set(user_ids)) > getattr(settings, "LEDGER_CACHE_WRITE_THROUGH_MAX_USERS", 20):
+            return self.delete_transaction_cache(user_ids, parent_util_function)
 
         logger.info(
-            "{} - GetBorrowTransactionsByUserId - Executed - {}".format(parent_util_function, user_id))
+            "%s - RefreshTransactionCache - Invoked - %s", parent_util_function, user_ids)
+        try:
+            rows = list(Transactions.objects.filter(id__in=transaction_ids).annotate(
+                date_str=Cast(TruncDate("transaction_date"),
+                              output_field=models.CharField())
+            ).values_list(*TRANSACTION_ROW_FIELDS, "date_str"))
+        except Exception as e:
+            # The write is already committed, it must not fail because of the cache
+            logger.error(
+                "%s - RefreshTransactionCache - ERROR - Exception - %s", parent_util_function, e)
+            return self.delete_transaction_cache(user_ids, parent_util_function)
 
-        return transactions_borrow
+        transactions = [dict(zip(TRANSACTION_ROW_FIELDS + ("date_str",), row)) for row in rows]
+
+        user_updates = {}
+        for user_id in user_ids:
+            user_uuid = uuid.UUID(str(user_id))
+            lend_rows, borrow_rows, history_rows = {}, {}, {}
+            for row, transaction in zip(rows, transactions):
+                if transaction["transaction_from_id"] == user_uuid:
+                    direction, counterparty = "lend", transaction["transaction_with_id"]
+                    lend_rows[transaction["id"]] = row[:-1]
+                elif transaction["transaction_with_id"] == user_uuid:
+                    direction, counterparty = "borrow", transaction["transaction_from_id"]
+                    borrow_rows[transaction["id"]] = row[:-1]
+                else:
+                    continue
+                history_rows[transaction["id"]] = (
+                    transaction["id"], transaction["date_str"], counterparty, transaction["transaction_status"],
+                    transaction["transaction_amount"], direction, transaction["reason"], transaction["transaction_date"])
+
+            # Same order as get_history_querysets, lend first, each direction by (transaction_date, id)
+            user_updates[user_id] = {
+                "trans_history": lambda cached, history_rows=history_rows: sorted(
+                    self.upsert_rows(cached, history_rows), key=lambda row: (row[5] != "lend", row[7], row[0])),
+                "trans_lend": lambda cached, lend_rows=lend_rows: self.upsert_rows(cached, lend_rows),
+                "trans_borrow": lambda cached, borrow_rows=borrow_rows: self.upsert_rows(cached, borrow_rows),
+            }
+        LedgerCache().update_entries_many(user_updates, CACHE_TTL, ROW_CODEC)
+
+        logger.info(
+            "%s - RefreshTransactionCache - SUCCESS - Executed - %s", parent_util_function, user_ids)
+
+    def upsert_rows(self, rows: list, new_rows: dict):
+        '''Returns rows with rows of the same id replaced by new_rows and the remaining new_rows appended'''
+
+        new_rows = dict(new_rows)
+        result = [new_rows.pop(row[0], row) for row in rows]
+        result.extend(new_rows.values())
+        return result
 
     def delete_transaction_cache(self, user_ids: list, parent_util_function: str):
-        '''Deletes tranaction details of user from cache'''
+        '''Invalidates all cached tranaction details of users by bumping their cache generation'''
 
         logger.info(
-            "{} - DeleteTransactionCache - Invoked - {}".format(parent_util_function, user_ids))
-        for user_id in user_ids:
-            cache.delete("trans_lend_user_id_{}".format(user_id))
-            cache.delete("trans_borrow_user_id_{}".format(user_id))
+            "%s - DeleteTransactionCache - Invoked - %s", parent_util_function, user_ids)
+        LedgerCache().bump_generations(user_ids)
+
+        logger.info(
+            "%s - DeleteTransactionCache - SUCCESS - Executed - %s", parent_util_function, user_ids)
+
+
+class AggregatesUtility:
+    def apply_transaction(self, transaction_from: str, transaction_with: str, amount: int, status: str):
+        '''
+        Adds new transaction to lender and borrower aggregates, must run in the same DB transaction as the insert
+
+        Parameters:
+        transaction_from (str): User id of lender
+        transaction_with (str): User id of borrower
+        amount (int): Transaction amount in minor units
+        status (str): Status of transaction like paid/unpaid
+
+        '''
+
+        self.apply_deltas(self.get_transaction_deltas(
+            transaction_from, transaction_with, amount, status), create_missing=True)
+
+    def get_transaction_deltas(self, transaction_from: str, transaction_with: str, amount: int, status: str):
+        '''Returns aggregate deltas of lender and borrower for a new transaction'''
+
+        return {
+            transaction_from: {
+                "{}_lent_total".format(status): amount,
+                "{}_lent_count".format(status): 1,
+            },
+            transaction_with: {
+                "{}_borrowed_total".format(status): amount,
+                "{}_borrowed_count".format(status): 1,
+            },
+        }
+
+    def apply_paid(self, transaction_from: str, transaction_with: str, amount: int):
+        '''
+        Moves unpaid transaction to paid totals of lender and borrower, must run in the same DB transaction as the status update
+
+        Parameters:
+        transaction_from (str): User id of lender
+        transaction_with (str): User id of borrower
+        amount (int): Transaction amount in minor units
+
+        '''
+
+        self.apply_deltas(self.get_paid_deltas(
+            transaction_from, transaction_with, amount))
+
+    def get_paid_deltas(self, transaction_from: str, transaction_with: str, amount: int):
+        '''Returns aggregate deltas of lender and borrower for a transaction marked paid'''
+
+        return {
+            transaction_from: {
+                "unpaid_lent_total": -amount,
+                "unpaid_lent_count": -1,
+                "paid_lent_total": amount,
+                "paid_lent_count": 1,
+            },
+            transaction_with: {
+                "unpaid_borrowed_total": -amount,
+                "unpaid_borrowed_count": -1,
+                "paid_borrowed_total": amount,
+                "paid_borrowed_count": 1,
+            },
+        }
+
+    def apply_deltas(self, deltas: dict, create_missing: bool = False):
+        '''
+        Increments aggregates of several users with a single UPDATE statement
+
+        Parameters:
+        deltas (dict): Field deltas keyed by user id, totals in minor units, e.g. {user_id: {"paid_lent_total": 1000}}
+        create_missing (bool): Create empty aggregates rows for users that have none
+
+        '''
+
+        if not deltas:
+            return
+
+        if create_missing:
+            LedgerAggregates.objects.bulk_create(
+                [LedgerAggregates(user_id=user_id) for user_id in deltas],
+                batch_size=BULK_BATCH_SIZE, ignore_conflicts=True)
+
+        items = list(deltas.items())
+        for start in range(0, len(items), BULK_BATCH_SIZE):
+            chunk = items[start:start + BULK_BATCH_SIZE]
+            field_names = {field_name for _, fields in chunk
+                           for field_name in fields}
+            LedgerAggregates.objects.filter(user_id__in=[user_id for user_id, _ in chunk]).update(**{
+                field_name: F(field_name) + Case(
+                    *[When(user_id=user_id, then=Value(fields[field_name]))
+                      for user_id, fields in chunk if field_name in fields],
+                    default=Value(0),
+                    output_field=LedgerAggregates._meta.get_field(field_name))
+                for field_name in field_names
+            })
+
+    def get_paid_totals(self, user_id: str):
+        '''Returns (paid lent total, paid borrowed total) of user with a single primary key lookup'''
+
+        totals = LedgerAggregates.objects.filter(user_id=user_id).values_list(
+            "paid_lent_total", "paid_borrowed_total").first()
+        return totals or (0, 0)
+
+    async def aget_paid_totals(self, user_id: str):
+        '''Async get_paid_totals'''
+
+        totals = await LedgerAggregates.objects.filter(user_id=user_id).values_list(
+            "paid_lent_total", "paid_borrowed_total").afirst()
+        return totals or (0, 0)
+
+    def get_paid_totals_many(self, user_ids):
+        '''
+        Returns (paid lent total, paid borrowed total) of many users
+
+        Parameters:
+        user_ids (iterable): User ids from Users model
+
+        Returns:
+        Dict: Totals keyed by user id (UUID), users without aggregates are missing
+
+        '''
+
+        user_ids = list(user_ids)
+        totals = {}
+        for start in range(0, len(user_ids), BULK_BATCH_SIZE):
+            rows = LedgerAggregates.objects.filter(user_id__in=user_ids[start:start + BULK_BATCH_SIZE]).values_list(
+                "user_id", "paid_lent_total", "paid_borrowed_total")
+            for user_id, lend_sum, borrow_sum in rows:
+                totals[user_id] = (lend_sum, borrow_sum)
+
+        return totals
+
+    def compute_aggregates(self):
+        '''
+        Computes aggregates of every user from scratch out of Transactions
+
+        Returns:
+        Dict: LedgerAggregates field values keyed by user id
+
+        '''
+
+        aggregates = {}
+        for party_field, side in (("transaction_from", "lent"), ("transaction_with", "borrowed")):
+            rows = Transactions.objects.values(party_field, "transaction_status").annotate(
+                total=Sum("transaction_amount"), count=Count("id")).order_by()
+            for row in rows:
+                fields = aggregates.setdefault(row[party_field], {})
+                fields["{}_{}_total".format(
+                    row["transaction_status"], side)] = row["total"]
+                fields["{}_{}_count".format(
+                    row["transaction_status"], side)] = row["count"]
+
+        return aggregates
+
+    def rebuild(self):
+        '''
+        Replaces all aggregates with values computed from Transactions
+
+        Returns:
+        Int: Number of users with aggregates
+
+        '''
+
+        logger.info("AggregatesUtility - Rebuild - Invoked")
+        aggregates = self.compute_aggregates()
+        with db_transaction.atomic():
+            LedgerAggregates.objects.all().delete()
+            LedgerAggregates.objects.bulk_create(
+                [LedgerAggregates(user_id=user_id, **fields) for user_id, fields in aggregates.items()], batch_size=1000)
+
+        logger.info(
+            "AggregatesUtility - Rebuild - SUCCESS - Executed - %s", len(aggregates))
+        return len(aggregates)
+
+    def verify(self):
+        '''
+        Compares stored aggregates with values computed from Transactions
+
+        Returns:
+        List: User ids whose stored aggregates differ
+
+        '''
+
+        logger.info("AggregatesUtility - Verify - Invoked")
+        expected = self.compute_aggregates()
+        field_names = [field.name for field in LedgerAggregates._meta.fields
+                       if field.name != "user"]
+        mismatches = []
+
+        stored = {row["user"]: row for row in LedgerAggregates.objects.values(
+            "user", *field_names)}
+        for user_id in set(stored) | set(expected):
+            row = stored.get(user_id, {})
+            fields = expected.get(user_id, {})
+            for field_name in field_names:
+                if row.get(field_name, 0) != fields.get(field_name, 0):
+                    mismatches.append(user_id)
+                    break
 
         logger.info(
-            "{} - DeleteTransactionCache - SUCCESS - Executed - {}".format(parent_util_function, user_ids))
+            "AggregatesUtility - Verify - SUCCESS - Executed - %s mismatches", len(mismatches))
+        return mismatches
+
+
+class ShardUtility:
+    '''
+    Reads and writes of the ledger sharded over LEDGER_SHARDS by user
+
+    A user lives on the home shard picked by the consistent hash of their
+    UUID, with their balance, aggregates and outgoing (lent) transactions.
+    The borrower of a transaction is referenced on the lender's shard by a
+    shadow Users row. Deltas of users homed on another shard are stored as a
+    ShardTransfer in the same DB transaction as the write, then applied on
+    their shard after commit. Applying is idempotent, so a transfer left
+    pending by a crash is safely redone by recover_transfers.
+
+    Without LEDGER_SHARDS every method works on the default database alone.
+
+    '''
+
+    def get_home_shard(self, user_id):
+        '''Returns home shard alias of user, None if the ledger is not sharded or the user id is invalid'''
+
+        if not is_sharded():
+            return None
+        try:
+            return get_shard(user_id)
+        except ValueError:
+            return None
+
+    def find_user_by_username(self, username: str, fields: tuple):
+        '''Returns values of fields of user with username, reading all shards concurrently when sharded'''
+
+        if not is_sharded():
+            return Users.objects.filter(username=username).values_list(*fields).first()
+        users = fan_out(lambda alias: Users.objects.filter(
+            username=username).values_list(*fields).first(), get_shards())
+        return next((user for user in users if user), None)
+
+    def find_user_ids(self, user_ids: set):
+        '''Returns the user ids (UUID) that exist, each looked up on its home shard when sharded'''
+
+        if not is_sharded():
+            return set(Users.objects.filter(id__in=user_ids).values_list("id", flat=True))
+        groups = group_by_shard(user_ids)
+        found = fan_out(lambda alias: list(Users.objects.filter(id__in=groups[alias]).exclude(
+            username__startswith=SHADOW_USERNAME_PREFIX).values_list("id", flat=True)), list(groups))
+        return {user_id for user_ids in found for user_id in user_ids}
+
+    def get_paid_totals_many(self, user_ids):
+        '''AggregatesUtility.get_paid_totals_many, each user read on their home shard when sharded'''
+
+        if not is_sharded():
+            return AggregatesUtility().get_paid_totals_many(user_ids)
+        groups = group_by_shard(user_ids)
+        totals = {}
+        for shard_totals in fan_out(lambda alias: AggregatesUtility().get_paid_totals_many(groups[alias]), list(groups)):
+            totals.update(shard_totals)
+        return totals
+
+    def get_history_rows(self, user_id: str):
+        '''
+        Returns flat transaction history rows of user from every shard
+
+        Shards are read concurrently. Lend rows come before borrow rows, like
+        the rows of TransactionUtility.get_history_querysets, and the rows of
+        each direction are merged across shards in (transaction_date, id) order.
+
+        '''
+
+        shard_rows = fan_out(lambda alias: [list(queryset) for queryset in TransactionUtility(
+        ).get_history_querysets(user_id)], get_shards())
+        return [row for index in range(len(TRANSACTION_DIRECTIONS)) for row in heapq.merge(
+            *(rows[index] for rows in shard_rows), key=lambda row: (row[-1], row[0]))]
+
+    def iter_history_rows(self, user_id: str, chunk_size: int):
+        '''Yields history rows of user from every shard in (transaction_date, id) order, for exports'''
+
+        iterators = [TransactionUtility().get_history_branch_queryset(user_id, direction).using(alias).iterator(
+            chunk_size=chunk_size) for alias in get_shards() for direction in TRANSACTION_DIRECTIONS]
+        for row in heapq.merge(*iterators, key=lambda row: (row[-1], row[0])):
+            yield row[:-1]
+
+    def find_transaction(self, transaction_id: str, fields: tuple):
+        '''Returns (shard alias, values of fields) of transaction, reading all shards concurrently'''
+
+        rows = fan_out(lambda alias: Transactions.objects.filter(
+            id=transaction_id).values_list(*fields).first(), get_shards())
+        for alias, row in zip(get_shards(), rows):
+            if row:
+                return alias, row
+        return None, None
+
+    def ensure_shadow_users(self, alias: str, user_ids):
+        '''Creates shadow rows on shard alias for users without a row there, must run in a transaction on alias'''
+
+        if not alias:
+            return
+        # Users that have a row already, real or shadow, conflict on id and are skipped
+        Users.objects.using(alias).bulk_create([
+            Users(id=user_id, name="", username=SHADOW_USERNAME.format(user_id), password="!")
+            for user_id in user_ids], ignore_conflicts=True)
+
+    def apply_deltas(self, alias: str, aggregate_deltas: dict, balance_deltas: dict, create_missing: bool = False):
+        '''
+        Applies aggregate and balance deltas of the users of a write, must run in its transaction
+
+        Deltas of users homed on shard alias are applied there, the others are
+        stored as one pending ShardTransfer per target shard.
+
+        Parameters:
+        alias (str): Shard of the write, None if the ledger is not sharded
+        aggregate_deltas (dict): Field deltas keyed by user id
+        balance_deltas (dict): Balance delta keyed by user id
+        create_missing (bool): Create empty aggregates rows for users that have none
+
+        Returns:
+        List: Ids of the pending transfers, to be applied after commit
+
+        '''
+
+        if not alias:
+            AggregatesUtility().apply_deltas(aggregate_deltas, create_missing=create_missing)
+            TransactionUtility().apply_balance_deltas(balance_deltas)
+            return []
+
+        remote = {}
+        local_aggregates, local_balances = {}, {}
+        for deltas, local, kind in ((aggregate_deltas, local_aggregates, "aggregates"),
+                                    (balance_deltas, local_balances, "balances")):
+            for user_id, delta in deltas.items():
+                shard = get_shard(user_id)
+                if shard == alias:
+                    local[user_id] = delta
+                else:
+                    remote.setdefault(shard, {"aggregates": {}, "balances": {}})[
+                        kind][str(user_id)] = delta
+
+        with on_shard(alias):
+            AggregatesUtility().apply_deltas(local_aggregates, create_missing=create_missing)
+            TransactionUtility().apply_balance_deltas(local_balances)
+            return [ShardTransfer.objects.create(target_shard=shard, deltas=deltas).id
+                    for shard, deltas in remote.items()]
+
+    def apply_transfers(self, alias: str, transfer_ids: list):
+        '''Applies pending transfers of shard alias on their target shards, called after commit'''
+
+        for transfer_id in transfer_ids:
+            try:
+                self.apply_transfer(alias, transfer_id)
+            except Exception as e:
+                # The write is already committed, recover_transfers applies the transfer later
+                logger.error(
+                    "ShardUtility - ApplyTransfers - ERROR - Exception - %s - %s", transfer_id, e)
+
+    def apply_transfer(self, alias: str, transfer_id):
+        '''Applies pending transfer of shard alias on its target shard once, then deletes it'''
+
+        transfer = ShardTransfer.objects.using(alias).filter(
+            id=transfer_id, state="pending").first()
+        if not transfer:
+            return False
+
+        with db_transaction.atomic(using=transfer.target_shard), on_shard(transfer.target_shard):
+            # The applied marker makes a redo after a crash a no-op
+            if not ShardTransfer.objects.filter(id=transfer.id).exists():
+                AggregatesUtility().apply_deltas(
+                    transfer.deltas["aggregates"], create_missing=True)
+                TransactionUtility().apply_balance_deltas(transfer.deltas["balances"])
+                ShardTransfer.objects.create(
+                    id=transfer.id, target_shard=transfer.target_shard, deltas=transfer.deltas, state="applied")
+
+        ShardTransfer.objects.using(alias).filter(id=transfer.id).delete()
+        logger.debug("ShardUtility - ApplyTransfer - %s - %s to %s",
+                     transfer.id, alias, transfer.target_shard)
+        return True
+
+    def recover_transfers(self, aliases: list = None):
+        '''
+        Applies every transfer left pending on any shard, like after a crash between commit and apply
+
+        Parameters:
+        aliases (list): Shards to look for pending transfers on, LEDGER_SHARDS by default
+
+        Returns:
+        Int: Number of applied transfers
+
+        '''
+
+        logger.info("ShardUtility - RecoverTransfers - Invoked")
+        count = 0
+        for alias in aliases or get_shards():
+            for transfer_id in ShardTransfer.objects.using(alias).filter(
+                    state="pending").order_by("created_at").values_list("id", flat=True):
+                count += self.apply_transfer(alias, transfer_id)
+            # A marker is only needed until its pending row is deleted, right after it is applied
+            ShardTransfer.objects.using(alias).filter(
+                state="applied", created_at__lt=timezone.now() - timedelta(hours=1)).delete()
+
+        logger.info(
+            "ShardUtility - RecoverTransfers - SUCCESS - Executed - %s", count)
+        return count
+
+    def get_misplaced_users(self, aliases: list = None):
+        '''
+        Returns (user id, current shard, home shard) of users that are not on their home shard
+
+        Parameters:
+        aliases (list): Shards to look for users on, LEDGER_SHARDS by default. Shards
+        removed from LEDGER_SHARDS must be listed too until their users moved
+
+        '''
+
+        misplaced = []
+        for alias in aliases or get_shards():
+            for user_id in Users.objects.using(alias).exclude(
+                    username__startswith=SHADOW_USERNAME_PREFIX).values_list("id", flat=True):
+                home = get_shard(user_id)
+                if home != alias:
+                    misplaced.append((user_id, alias, home))
+        return misplaced
+
+    def move_user(self, user_id, source: str, target: str):
+        '''
+        Moves user with their aggregates and outgoing transactions from shard source to shard target
+
+        The target is written first and every write there is an upsert, so a
+        move interrupted before the source is cleaned up is completed by
+        running it again. Writes must be paused while users move.
+
+        '''
+
+        logger.info(
+            "ShardUtility - MoveUser - Invoked - %s - %s to %s", user_id, source, target)
+        user = Users.objects.using(source).get(id=user_id)
+        aggregates = LedgerAggregates.objects.using(
+            source).filter(user_id=user_id).first()
+        transactions = list(Transactions.objects.using(
+            source).filter(transaction_from_id=user_id).order_by("transaction_date", "id"))
+
+        with db_transaction.atomic(using=target), on_shard(target):
+            Users.objects.update_or_create(id=user.id, defaults={
+                "name": user.name, "username": user.username, "password": user.password, "balance": user.balance})
+            self.ensure_shadow_users(target, {transaction.transaction_with_id for transaction in transactions})
+            Transactions.objects.bulk_create(
+                transactions, batch_size=BULK_BATCH_SIZE, ignore_conflicts=True)
+            if aggregates:
+                LedgerAggregates.objects.update_or_create(user_id=user.id, defaults={
+                    field.attname: getattr(aggregates, field.attname)
+                    for field in LedgerAggregates._meta.concrete_fields if field.attname != "user_id"})
+
+        with db_transaction.atomic(using=source), on_shard(source):
+            Transactions.objects.filter(transaction_from_id=user_id).delete()
+            LedgerAggregates.objects.filter(user_id=user_id).delete()
+            if Transactions.objects.filter(transaction_with_id=user_id).exists():
+                # Still the borrower of transactions lent from this shard
+                Users.objects.filter(id=user_id).update(
+                    name="", username=SHADOW_USERNAME.format(user_id), password="!", balance=0)
+            else:
+                Users.objects.filter(id=user_id).delete()
+
+        logger.info("ShardUtility - MoveUser - SUCCESS - Executed - %s", user_id)
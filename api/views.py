@@ -1,17 +1,61 @@
 import json
 import time
+from functools import wraps
+
+from asgiref.sync import sync_to_async
 
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views import View
 
+from .metrics import METRICS
 from .utils import *
 
 import logging
 logger = logging.getLogger(__name__)
 
+# Any of these in the request body switches get_transactions to paginated mode
+PAGINATION_PARAMS = ("page_size", "cursor", "date_from", "date_to",
+                     "transaction_status", "counterparty", "direction")
+
+
+def authenticate_request(request):
+    '''Sets request.token_user_id from the "Authorization: Bearer <token>" header, returns 401 response if it is not valid'''
+
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    user_id = TokenUtility().verify_token(
+        token.strip()) if scheme.lower() == "bearer" else None
+    if user_id is None:
+        logger.error("TokenRequired - ERROR - Invalid or expired token")
+        return HttpResponse(json.dumps({"message": "Invalid or expired token"}),
+                            content_type="application/json", status=401)
+    request.token_user_id = user_id
+    return None
+
+
+def forbid_other_users(request, user_ids):
+    '''Returns 403 response unless the token user is one of user_ids, blank user ids are left to the utilities to reject'''
+
+    user_ids = [user_id for user_id in user_ids if user_id]
+    if not user_ids or TokenUtility().is_party(request.token_user_id, user_ids):
+        return None
+    logger.error(
+        "TokenRequired - ERROR - Token user is not a party - %s", request.token_user_id)
+    return HttpResponse(json.dumps({"message": "You are not allowed to access this user"}),
+                        content_type="application/json", status=403)
+
+
+def token_required(view_func):
+    '''Rejects requests without a valid "Authorization: Bearer <token>" header, verified by HMAC only'''
+
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        return authenticate_request(request) or view_func(request, *args, **kwargs)
+
+    return wrapper
+
 
 @method_decorator(csrf_exempt, name='dispatch')
 class UserView(View):
@@ -19,7 +63,7 @@ class UserView(View):
     This class handles Users model related API endpoints
 
     GET: Return credit score of User
-    POST: User login(this can be GET call also, but preferred way to do sign in and sign out is POST call)
+    POST: User login(this can be GET call also, but preferred way to do sign in and sign out is POST call), returns token for the other endpoints
 
     '''
 
@@ -31,29 +75,99 @@ class UserView(View):
             "username"), request_body.get("password"))
         code = payload.pop("code", 500)
         logger.info(
-            "UserView - POST - Login - Executed - {}".format(time.time() - start_time))
+            "UserView - POST - Login - Executed - %s", time.time() - start_time)
 
         return HttpResponse(json.dumps(payload), content_type="application/json", status=code)
 
+    @method_decorator(token_required)
     def get(self, request, *args, **kwargs):
         logger.info("UserView - GET - GetCreditScore - Invoked")
         start_time = time.time()
         request_body = json.loads(request.body.decode('utf-8'))
+        forbidden = forbid_other_users(request, [request_body.get("user_id")])
+        if forbidden:
+            return forbidden
         payload = UsersUtility().get_credit_score(request_body.get(
             "user_id"))
         code = payload.pop("code", 500)
         logger.info(
-            "UserView - GET - GetCreditScore - Executed - {}".format(time.time() - start_time))
+            "UserView - GET - GetCreditScore - Executed - %s", time.time() - start_time)
 
         return HttpResponse(json.dumps(payload), content_type="application/json", status=code)
 
 
 @method_decorator(csrf_exempt, name='dispatch')
+class AsyncUserView(View):
+    '''
+    Async UserView served under ASGI, see LEDGER_ASYNC_VIEWS
+
+    GET: Return credit score of User
+    POST: User login, returns token for the other endpoints
+
+    '''
+
+    async def post(self, request, *args, **kwargs):
+        logger.info("AsyncUserView - POST - Login - Invoked")
+        start_time = time.time()
+        request_body = json.loads(request.body.decode('utf-8'))
+        payload = await UsersUtility().alogin(request_body.get(
+            "username"), request_body.get("password"))
+        code = payload.pop("code", 500)
+        logger.info(
+            "AsyncUserView - POST - Login - Executed - %s", time.time() - start_time)
+
+        return HttpResponse(json.dumps(payload), content_type="application/json", status=code)
+
+    async def get(self, request, *args, **kwargs):
+        # token_required wraps sync views only, an async handler has to return its 401 itself
+        unauthorized = authenticate_request(request)
+        if unauthorized:
+            return unauthorized
+        logger.info("AsyncUserView - GET - GetCreditScore - Invoked")
+        start_time = time.time()
+        request_body = json.loads(request.body.decode('utf-8'))
+        forbidden = forbid_other_users(request, [request_body.get("user_id")])
+        if forbidden:
+            return forbidden
+        payload = await UsersUtility().aget_credit_score(request_body.get(
+            "user_id"))
+        code = payload.pop("code", 500)
+        logger.info(
+            "AsyncUserView - GET - GetCreditScore - Executed - %s", time.time() - start_time)
+
+        return HttpResponse(json.dumps(payload), content_type="application/json", status=code)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+@method_decorator(token_required, name='dispatch')
+class CreditScoreBatchView(View):
+    '''
+    This class handles batch Users credit score API endpoints
+
+    GET: Returns credit scores of many users
+
+    '''
+
+    def get(self, request, *args, **kwargs):
+        logger.info("CreditScoreBatchView - GET - GetCreditScores - Invoked")
+        start_time = time.time()
+        request_body = json.loads(request.body.decode('utf-8'))
+        payload = UsersUtility().get_credit_scores(request_body.get(
+            "user_ids"))
+        code = payload.pop("code", 500)
+        logger.info(
+            "CreditScoreBatchView - GET - GetCreditScores - Executed - %s", time.time() - start_time)
+
+        return HttpResponse(json.dumps(payload), content_type="application/json", status=code)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+@method_decorator(token_required, name='dispatch')
 class TransactionView(View):
     '''
     This class handles Transactions model related API endpoints
 
-    GET: Returns transactions history of user
+    GET: Returns transactions history of user (paginated when page/filter parameters are given)
     POST: Adds transaction
     PATCH: Marks transaction as paid
 
@@ -63,11 +177,26 @@ class TransactionView(View):
         logger.info("TransactionView - GET - GetTransactionsByUserId - Invoked")
         start_time = time.time()
         request_body = json.loads(request.body.decode('utf-8'))
-        payload = TransactionUtility().get_transactions_by_user_id(
-            request_body.get("user_id"))
+        forbidden = forbid_other_users(request, [request_body.get("user_id")])
+        if forbidden:
+            return forbidden
+        if any(param in request_body for param in PAGINATION_PARAMS):
+            payload = TransactionUtility().get_transactions_page(
+                request_body.get("user_id"),
+                request_body.get("page_size"),
+                request_body.get("cursor"),
+                request_body.get("date_from"),
+                request_body.get("date_to"),
+                request_body.get("transaction_status"),
+                request_body.get("counterparty"),
+                request_body.get("direction")
+            )
+        else:
+            payload = TransactionUtility().get_transactions_by_user_id(
+                request_body.get("user_id"))
         code = payload.pop("code", 500)
         logger.info(
-            "TransactionView - GET - GetTransactionsByUserId - Executed - {}".format(time.time() - start_time))
+            "TransactionView - GET - GetTransactionsByUserId - Executed - %s", time.time() - start_time)
 
         return HttpResponse(json.dumps(payload), content_type="application/json", status=code)
 
@@ -75,6 +204,10 @@ class TransactionView(View):
         logger.info("TransactionView - POST - AddTransaction - Invoked")
         start_time = time.time()
         request_body = json.loads(request.body.decode('utf-8'))
+        forbidden = forbid_other_users(request, [request_body.get(
+            "transaction_from"), request_body.get("transaction_with")])
+        if forbidden:
+            return forbidden
         payload = TransactionUtility().add_transaction(
             request_body.get("transaction_from"),
             request_body.get("transaction_with"),
@@ -86,7 +219,7 @@ class TransactionView(View):
         )
         code = payload.pop("code", 500)
         logger.info(
-            "TransactionView - POST - AddTransaction - Executed - {}".format(time.time() - start_time))
+            "TransactionView - POST - AddTransaction - Executed - %s", time.time() - start_time)
 
         return HttpResponse(json.dumps(payload), content_type="application/json", status=code)
 
@@ -95,10 +228,182 @@ class TransactionView(View):
         start_time = time.time()
         request_body = json.loads(request.body.decode('utf-8'))
         payload = TransactionUtility().mark_transaction_paid(
-            request_body.get("transaction_id")
+            request_body.get("transaction_id"), request.token_user_id
         )
         code = payload.pop("code", 500)
         logger.info(
-            "TransactionView - PATCH - MarkTransactionPaid - Executed - {}".format(time.time() - start_time))
+            "TransactionView - PATCH - MarkTransactionPaid - Executed - %s", time.time() - start_time)
 
         return HttpResponse(json.dumps(payload), content_type="application/json", status=code)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncTransactionView(View):
+    '''
+    Async TransactionView served under ASGI, see LEDGER_ASYNC_VIEWS
+
+    GET: Returns transactions history of user, the full history is read with
+    the async ORM and cache, pages and writes run the sync utilities in a thread
+    POST: Adds transaction
+    PATCH: Marks transaction as paid
+
+    '''
+
+    async def dispatch(self, request, *args, **kwargs):
+        unauthorized = authenticate_request(request)
+        if unauthorized:
+            return unauthorized
+        return await super().dispatch(request, *args, **kwargs)
+
+    async def get(self, request,  *args, **kwargs):
+        logger.info("AsyncTransactionView - GET - GetTransactionsByUserId - Invoked")
+        start_time = time.time()
+        request_body = json.loads(request.body.decode('utf-8'))
+        forbidden = forbid_other_users(request, [request_body.get("user_id")])
+        if forbidden:
+            return forbidden
+        if any(param in request_body for param in PAGINATION_PARAMS):
+            payload = await sync_to_async(TransactionUtility().get_transactions_page)(
+                request_body.get("user_id"),
+                request_body.get("page_size"),
+                request_body.get("cursor"),
+                request_body.get("date_from"),
+                request_body.get("date_to"),
+                request_body.get("transaction_status"),
+                request_body.get("counterparty"),
+                request_body.get("direction")
+            )
+        else:
+            payload = await TransactionUtility().aget_transactions_by_user_id(
+                request_body.get("user_id"))
+        code = payload.pop("code", 500)
+        logger.info(
+            "AsyncTransactionView - GET - GetTransactionsByUserId - Executed - %s", time.time() - start_time)
+
+        return HttpResponse(json.dumps(payload), content_type="application/json", status=code)
+
+    # Writes keep the sync handlers, run in the request's DB thread so on_commit hooks see their transaction
+    async def post(self, request,  *args, **kwargs):
+        return await sync_to_async(TransactionView.post)(self, request, *args, **kwargs)
+
+    async def patch(self, request,  *args, **kwargs):
+        return await sync_to_async(TransactionView.patch)(self, request, *args, **kwargs)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+@method_decorator(token_required, name='dispatch')
+class TransactionBatchView(View):
+    '''
+    This class handles batch Transactions API endpoints
+
+    POST: Adds batch of transactions, all or nothing
+
+    '''
+
+    def post(self, request,  *args, **kwargs):
+        logger.info("TransactionBatchView - POST - AddTransactions - Invoked")
+        start_time = time.time()
+        request_body = json.loads(request.body.decode('utf-8'))
+        transactions = request_body.get("transactions")
+        if isinstance(transactions, list):
+            # All or nothing, every transaction of the batch has to be one of the token user
+            for transaction in transactions:
+                if not isinstance(transaction, dict):
+                    continue
+                forbidden = forbid_other_users(request, [transaction.get(
+                    "transaction_from"), transaction.get("transaction_with")])
+                if forbidden:
+                    return forbidden
+        payload = TransactionUtility().add_transactions(transactions)
+        code = payload.pop("code", 500)
+        logger.info(
+            "TransactionBatchView - POST - AddTransactions - Executed - %s", time.time() - start_time)
+
+        return HttpResponse(json.dumps(payload), content_type="application/json", status=code)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+@method_decorator(token_required, name='dispatch')
+class TransactionExportView(View):
+    '''
+    This class handles Transactions export API endpoints
+
+    GET: Streams complete transactions history of user as NDJSON or CSV
+
+    '''
+
+    def get(self, request,  *args, **kwargs):
+        logger.info(
+            "TransactionExportView - GET - ExportTransactionsByUserId - Invoked")
+        start_time = time.time()
+        request_body = json.loads(request.body.decode('utf-8'))
+        export_format = request_body.get("format", "ndjson")
+        forbidden = forbid_other_users(request, [request_body.get("user_id")])
+        if forbidden:
+            return forbidden
+        payload = TransactionUtility().export_transactions_by_user_id(
+            request_body.get("user_id"), export_format)
+        code = payload.pop("code", 500)
+        logger.info(
+            "TransactionExportView - GET - ExportTransactionsByUserId - Started - %s", time.time() - start_time)
+
+        if code != 200:
+            return HttpResponse(json.dumps(payload), content_type="application/json", status=code)
+
+        response = StreamingHttpResponse(
+            payload["lines"], content_type=payload["content_type"])
+        response["Content-Disposition"] = 'attachment; filename="transactions.{}"'.format(
+            export_format)
+        return response
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncTransactionExportView(View):
+    '''
+    Async TransactionExportView served under ASGI, see LEDGER_ASYNC_VIEWS
+
+    GET: Streams complete transactions history of user as NDJSON or CSV, one chunk in memory at a time
+
+    '''
+
+    async def dispatch(self, request, *args, **kwargs):
+        unauthorized = authenticate_request(request)
+        if unauthorized:
+            return unauthorized
+        return await super().dispatch(request, *args, **kwargs)
+
+    async def get(self, request,  *args, **kwargs):
+        logger.info(
+            "AsyncTransactionExportView - GET - ExportTransactionsByUserId - Invoked")
+        start_time = time.time()
+        request_body = json.loads(request.body.decode('utf-8'))
+        export_format = request_body.get("format", "ndjson")
+        forbidden = forbid_other_users(request, [request_body.get("user_id")])
+        if forbidden:
+            return forbidden
+        payload = await TransactionUtility().aexport_transactions_by_user_id(
+            request_body.get("user_id"), export_format)
+        code = payload.pop("code", 500)
+        logger.info(
+            "AsyncTransactionExportView - GET - ExportTransactionsByUserId - Started - %s", time.time() - start_time)
+
+        if code != 200:
+            return HttpResponse(json.dumps(payload), content_type="application/json", status=code)
+
+        response = StreamingHttpResponse(
+            payload["lines"], content_type=payload["content_type"])
+        response["Content-Disposition"] = 'attachment; filename="transactions.{}"'.format(
+            export_format)
+        return response
+
+
+class MetricsView(View):
+    '''
+    This class handles the metrics endpoint
+
+    GET: Returns request, DB and cache metrics of this process in Prometheus text format
+
+    '''
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(METRICS.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -12,5 +12,9 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ledger.settings')
+# ASGI workers serve the read endpoints with async views, see LEDGER_ASYNC_VIEWS
+os.environ.setdefault('LEDGER_ASYNC_VIEWS', '1')
+# Requests run in threads of their own under ASGI, a kept connection would never be reused
+os.environ.setdefault('LEDGER_DB_CONN_MAX_AGE', '0')
 
 application = get_asgi_application()
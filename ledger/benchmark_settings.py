@@ -0,0 +1,24 @@
+"""
+Settings of the servers started by benchmark_servers
+
+Extends the settings module named by LEDGER_BENCHMARK_BASE_SETTINGS, the one
+the command itself runs with, and swaps the cache for an in-memory stand-in
+for a slow remote cache that sleeps LEDGER_SLOW_CACHE_DELAY seconds per call.
+"""
+
+import importlib
+import os
+
+_base = importlib.import_module(os.environ.get(
+    "LEDGER_BENCHMARK_BASE_SETTINGS", "ledger.settings"))
+globals().update({name: value for name, value in vars(_base).items() if name.isupper()})
+
+LEDGER_SLOW_CACHE_DELAY = float(os.environ.get("LEDGER_SLOW_CACHE_DELAY", 0.005))
+CACHES = {
+    "default": {
+        "BACKEND": "api.caching.SlowLocMemCache",
+        "OPTIONS": {"DELAY": LEDGER_SLOW_CACHE_DELAY},
+    }
+}
+# The in-process tier would hide the slow cache
+LEDGER_LOCAL_CACHE_MAX_ENTRIES = 0
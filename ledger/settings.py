@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -41,6 +42,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.RequestMetricsMiddleware',
+    'api.middleware.LogContextMiddleware',
+    'api.middleware.ProfilerMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -77,10 +81,49 @@ WSGI_APPLICATION = 'ledger.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'NAME': os.environ.get('LEDGER_SQLITE_PATH') or BASE_DIR / 'db.sqlite3',
+    },
 }
 
+# Local read replica, only defined when LEDGER_SQLITE_REPLICA_PATH is set.
+# Migrate it with --database replica and fill it with simulate_replication
+if os.environ.get('LEDGER_SQLITE_REPLICA_PATH'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ['LEDGER_SQLITE_REPLICA_PATH'],
+    }
+
+# Local SQLite shards shard_1 to shard_<N-1>, default is the first of the N shards.
+# One shard by default, so only default is defined
+for shard_index in range(1, int(os.environ.get("LEDGER_SQLITE_SHARDS", 1))):
+    DATABASES['shard_{}'.format(shard_index)] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db_shard_{}.sqlite3'.format(shard_index),
+    }
+
+# Seconds a thread keeps its connection for later requests, 0 opens one per request.
+# Reused connections are health checked before every request
+LEDGER_DB_CONN_MAX_AGE = int(os.environ.get("LEDGER_DB_CONN_MAX_AGE", 60))
+for database in DATABASES.values():
+    database['CONN_MAX_AGE'] = LEDGER_DB_CONN_MAX_AGE
+    database['CONN_HEALTH_CHECKS'] = True
+
+# Pragmas run on every new SQLite connection by api.sqlite, LEDGER_SQLITE_TUNING=0 keeps SQLite defaults.
+# WAL lets readers run while a writer commits, NORMAL sync is durable in WAL mode except on power loss
+LEDGER_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    # Negative sizes are KiB, 64 MB page cache per connection
+    'cache_size': -64000,
+    'mmap_size': 256 * 1024 * 1024,
+    # Milliseconds a connection waits for a lock before failing with database is locked
+    'busy_timeout': 5000,
+    'temp_store': 'MEMORY',
+} if os.environ.get("LEDGER_SQLITE_TUNING", "1") == "1" else {}
+
+# Writes go to default or the user's shard, history and credit score reads to LEDGER_READ_REPLICAS
+DATABASE_ROUTERS = ['api.routers.LedgerRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -129,6 +172,64 @@ CACHES = {
     }
 }
 
+# Ledger
+LEDGER_TRANSACTIONS_PAGE_SIZE = 50
+LEDGER_TRANSACTIONS_MAX_PAGE_SIZE = 500
+LEDGER_BATCH_MAX_SIZE = 1000
+LEDGER_EXPORT_CHUNK_SIZE = 2000
+LEDGER_CREDIT_SCORE_BATCH_MAX_SIZE = 1000
+# Per-user cache: seconds a recompute lock is held, seconds other workers wait
+# for its result, and XFetch early refresh aggressiveness (0 disables it)
+LEDGER_CACHE_LOCK_TIMEOUT = 10
+LEDGER_CACHE_LOCK_WAIT = 2.0
+LEDGER_CACHE_EARLY_REFRESH_BETA = 1.0
+# Cached row payloads larger than this many bytes are zlib compressed
+LEDGER_CACHE_COMPRESS_THRESHOLD = 4096
+# In-process cache tier in front of the shared cache, 0 entries disables it
+LEDGER_LOCAL_CACHE_MAX_ENTRIES = 1024
+LEDGER_LOCAL_CACHE_TTL = 5
+# Seconds a worker trusts its local generation stamps, bounds staleness of writes made by other workers
+LEDGER_LOCAL_CACHE_GENERATION_TTL = 1.0
+# Seconds generation stamps stay in the shared cache, an expired stamp just starts a new generation
+LEDGER_CACHE_GENERATION_TTL = 86400
+# Writes update cached entries of both users after commit instead of invalidating them
+LEDGER_CACHE_WRITE_THROUGH = True
+# Writes touching more users than this invalidate their caches instead, the next reads rebuild them
+LEDGER_CACHE_WRITE_THROUGH_MAX_USERS = 20
+# Database aliases serving history and credit score reads, empty sends them to default
+LEDGER_READ_REPLICAS = [alias for alias in os.environ.get(
+    "LEDGER_READ_REPLICAS", "").split(",") if alias]
+# Seconds the reads of users stick to default after their write, covers replication lag
+LEDGER_READ_YOUR_WRITES_WINDOW = 5
+# Database aliases the ledger is sharded over by user, empty keeps everything on default.
+# Changing them moves users, run rebalance_shards afterwards
+LEDGER_SHARDS = [alias for alias in os.environ.get(
+    "LEDGER_SHARDS", "").split(",") if alias]
+# Points per shard on the consistent hash ring
+LEDGER_SHARD_VNODES = 64
+# Threads reading shards concurrently for history, login and batch credit scores
+LEDGER_SHARD_FANOUT_WORKERS = 8
+# Seconds a login token stays valid
+LEDGER_TOKEN_MAX_AGE = 12 * 60 * 60
+# Record request, DB and cache metrics served on /metrics
+LEDGER_METRICS_ENABLED = True
+# Serve login, credit score and transaction history with async views, set by ledger/asgi.py
+LEDGER_ASYNC_VIEWS = os.environ.get("LEDGER_ASYNC_VIEWS") == "1"
+# "text" logs to the console synchronously, "json" logs structured JSON lines written by a background thread
+LEDGER_LOG_MODE = os.environ.get("LEDGER_LOG_MODE", "text")
+LEDGER_LOG_LEVEL = os.environ.get("LEDGER_LOG_LEVEL", "INFO")
+# Share of requests per route (like "api/get_transactions", "*" for the others) whose DEBUG lines are kept
+LEDGER_LOG_DEBUG_SAMPLE_RATES = {"*": 1.0}
+# Per-request profiling, read the reports with the show_profiles command
+LEDGER_PROFILER_ENABLED = os.environ.get("LEDGER_PROFILER_ENABLED") == "1"
+LEDGER_PROFILER_HEADER = "X-Ledger-Profile"
+# Values of LEDGER_PROFILER_HEADER that turn profiling on for a request
+LEDGER_PROFILER_TOKENS = [token for token in os.environ.get(
+    "LEDGER_PROFILER_TOKENS", "").split(",") if token]
+LEDGER_PROFILER_SAMPLE_RATE = 0.0
+LEDGER_PROFILER_DIR = BASE_DIR / 'profiles'
+LEDGER_PROFILER_MAX_ENTRIES = 100
+
 LOGGING = {
     'version': 1,
     # The version number of our log
@@ -148,17 +249,28 @@ LOGGING = {
         },
         'console': {
             'class': 'logging.StreamHandler',
-            'formatter': 'simple'
+            'formatter': 'simple',
+            'filters': ['route_context'],
+        },
+    },
+    'filters': {
+        'route_context': {
+            '()': 'api.log.RouteContextFilter',
         },
     },
     # A logger for WARNING which has a handler called 'file'. A logger can have multiple handler
     'loggers': {
         '': {
             # notice how file variable is called in handler which has been defined above
-            'handlers': ['console'],
-            'level': 'INFO',
+            'handlers': ['queue' if LEDGER_LOG_MODE == 'json' else 'console'],
+            'level': LEDGER_LOG_LEVEL,
             'propagate': True,
         },
     },
 }
 
+if LEDGER_LOG_MODE == 'json':
+    LOGGING['handlers']['queue'] = {
+        '()': 'api.log.QueueLogHandler',
+        'filters': ['route_context'],
+    }
@@ -0,0 +1,26 @@
+"""
+Settings of the test suite, python manage.py test --settings=ledger.settings_test
+
+Adds the local read replica and the two SQLite shards the replication and
+sharding tests run against. Production settings only define them when
+LEDGER_SQLITE_REPLICA_PATH and LEDGER_SQLITE_SHARDS are set. The module name
+does not match the test* discovery pattern, so a test run never imports it
+as a test module.
+"""
+
+from ledger.settings import *  # noqa: F401,F403
+
+
+def _sqlite_database(name: str):
+    return {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / name,
+        'CONN_MAX_AGE': LEDGER_DB_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+    }
+
+
+# A copy, so the DATABASES of ledger.settings are left as they are. Aliases set by env win
+DATABASES = dict(DATABASES)
+for _alias in ('replica', 'shard_1', 'shard_2'):
+    DATABASES.setdefault(_alias, _sqlite_database('db_{}.sqlite3'.format(_alias)))